@@ -1,19 +1,50 @@
 import os
+import io
 import uuid
 import json
 import zipfile
 import tempfile
 import shutil
 import re
+import time
+import random
+import fcntl
+import hmac
+import cProfile
+import tracemalloc
+import hashlib
+import contextlib
+import functools
+import threading
+import heapq
+import itertools
+import fnmatch
+import glob
+import math
+import signal
+import csv
+import collections
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from timesketch_api_client import client as timesketch_client
 import sys 
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, has_app_context, abort, send_file, send_from_directory
 
 from openrelik_api_client.api_client import APIClient
 from openrelik_api_client.folders import FoldersAPI
 from openrelik_api_client.workflows import WorkflowsAPI
 
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
 # --------------------------------------------------------------------------------
 # Configuration
 # --------------------------------------------------------------------------------
@@ -22,6 +53,140 @@ API_URL = os.getenv("OPENRELIK_API_URL", "")
 TIMESKETCH_PASSWORD = os.getenv("TIMESKETCH_PASSWORD", "")
 TIMESKETCH_URL = os.getenv("TIMESKETCH_URL", "")
 
+# Tracing and on-demand profiling (the /debug/profile endpoint is disabled without DEBUG_TOKEN)
+TRACE_SPANS = os.getenv("TRACE_SPANS", "true").lower() == "true"
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/openrelik-pipeline-profiles")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+# Upstream resilience: retries for idempotent stages and per-upstream circuit breakers
+UPSTREAM_RETRY_ATTEMPTS = int(os.getenv("UPSTREAM_RETRY_ATTEMPTS", "4"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "10"))
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_THRESHOLD", "5"))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.getenv("CIRCUIT_BREAKER_RESET_TIMEOUT", "30"))
+
+# Adaptive concurrency: AIMD limit on the uploads, workflow creations and runs in
+# flight to each OpenRelik backend, driven by their latency and errors
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+ADAPTIVE_INITIAL_LIMIT = int(os.getenv("ADAPTIVE_INITIAL_LIMIT", "8"))
+ADAPTIVE_MIN_LIMIT = int(os.getenv("ADAPTIVE_MIN_LIMIT", "1"))
+ADAPTIVE_MAX_LIMIT = int(os.getenv("ADAPTIVE_MAX_LIMIT", "64"))
+ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv("ADAPTIVE_LATENCY_TOLERANCE", "2.0"))
+ADAPTIVE_BACKOFF = float(os.getenv("ADAPTIVE_BACKOFF", "0.7"))
+
+# Admission control: uploads handled at once per worker process before answering
+# 503 with Retry-After (0 means unlimited)
+MAX_INFLIGHT_UPLOADS = int(os.getenv("MAX_INFLIGHT_UPLOADS", "0"))
+SATURATED_RETRY_AFTER = int(os.getenv("SATURATED_RETRY_AFTER", "30"))
+# Seconds an upload may wait for a slot; waiting uploads are served by priority
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0"))
+
+# Priorities: uploads are "high" priority when asked for (?priority=high or an
+# X-Priority header) or when their label matches HIGH_PRIORITY_LABELS (comma separated
+# glob patterns). High-priority tasks go to "<queue><HIGH_PRIORITY_QUEUE_SUFFIX>", for
+# all queues or only those listed in HIGH_PRIORITY_QUEUES.
+HIGH_PRIORITY_LABELS = [p.strip() for p in os.getenv("HIGH_PRIORITY_LABELS", "").split(",") if p.strip()]
+HIGH_PRIORITY_QUEUE_SUFFIX = os.getenv("HIGH_PRIORITY_QUEUE_SUFFIX", "-high")
+HIGH_PRIORITY_QUEUES = [q.strip() for q in os.getenv("HIGH_PRIORITY_QUEUES", "").split(",") if q.strip()]
+
+# Fair share: token buckets per label and per client (uploads per minute, 0 disables
+# a limit) and weights for label/client patterns, as JSON like {"label:ir-*": 4}
+LABEL_RATE_LIMIT = float(os.getenv("LABEL_RATE_LIMIT", "0"))
+LABEL_BURST = float(os.getenv("LABEL_BURST", "10"))
+CLIENT_RATE_LIMIT = float(os.getenv("CLIENT_RATE_LIMIT", "0"))
+CLIENT_BURST = float(os.getenv("CLIENT_BURST", "20"))
+FAIR_SHARE_WEIGHTS = json.loads(os.getenv("FAIR_SHARE_WEIGHTS", "") or "{}")
+
+# Graceful drain and resume: on SIGTERM new uploads get 503 + Retry-After while
+# in-flight ones finish. With JOURNAL_DIR set, uploads are spooled there and every
+# pipeline stage is journaled, so runs cut short by a restart are resumed.
+DRAIN_RETRY_AFTER = int(os.getenv("DRAIN_RETRY_AFTER", "30"))
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "")
+JOURNAL_RESUME_INTERVAL = float(os.getenv("JOURNAL_RESUME_INTERVAL", "30"))
+JOURNAL_MAX_RESUMES = int(os.getenv("JOURNAL_MAX_RESUMES", "3"))
+# Uploads cut short before they were answered are left for their sender's retry to
+# take over, and only resumed here once it didn't come for this many seconds
+JOURNAL_RETRY_WINDOW = float(os.getenv("JOURNAL_RETRY_WINDOW", "21600"))
+
+# Drop-folder ingestion, disabled unless INGEST_DIR is set
+INGEST_DIR = os.getenv("INGEST_DIR", "")
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "5"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+
+# Backend pool: a JSON list of OpenRelik (+ Timesketch) backends, see README.
+# Unset means a single backend built from the settings above.
+OPENRELIK_BACKENDS = os.getenv("OPENRELIK_BACKENDS", "")
+BACKEND_MAX_CONCURRENCY = int(os.getenv("BACKEND_MAX_CONCURRENCY", "0"))
+
+# Lookup cache: folder and sketch lookups are cached in this process, or with a
+# redis:// URL in Redis, shared by all workers and pipeline instances
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_PREFIX = os.getenv("CACHE_PREFIX", "openrelik-pipeline:")
+CACHE_LOCK_TIMEOUT = float(os.getenv("CACHE_LOCK_TIMEOUT", "120"))
+
+# Folder layout: "upload" creates a new root folder per upload, "case" reuses one
+# root folder per label with a subfolder per host
+FOLDER_MODE = os.getenv("FOLDER_MODE", "upload")
+FOLDER_CACHE_TTL = float(os.getenv("FOLDER_CACHE_TTL", "3600"))
+FOLDER_LOOKUP_LIMIT = int(os.getenv("FOLDER_LOOKUP_LIMIT", "10000"))
+
+# Sketch rollover: once a label's sketch holds this many timelines or events, new
+# timelines go into <label>-2, <label>-3, ... (0 disables a limit)
+SKETCH_MAX_TIMELINES = int(os.getenv("SKETCH_MAX_TIMELINES", "0"))
+SKETCH_MAX_EVENTS = int(os.getenv("SKETCH_MAX_EVENTS", "0"))
+SKETCH_CACHE_TTL = float(os.getenv("SKETCH_CACHE_TTL", "300"))
+
+# Incremental re-triage: only send members of a re-collected host's zip that changed
+# since the host was last processed. Manifests should live on a persistent volume.
+INCREMENTAL_TRIAGE = os.getenv("INCREMENTAL_TRIAGE", "false").lower() == "true"
+MANIFEST_DIR = os.getenv("MANIFEST_DIR", "/tmp/openrelik-pipeline-manifests")
+
+# Hayabusa profiles: named rule-set, minimum-level and output presets for the Hayabusa
+# task, picked per request (?profile=) or per label, see README
+HAYABUSA_PROFILE = os.getenv("HAYABUSA_PROFILE", "full")
+HAYABUSA_PROFILES = json.loads(os.getenv("HAYABUSA_PROFILES", "") or "{}")
+HAYABUSA_LABEL_PROFILES = json.loads(os.getenv("HAYABUSA_LABEL_PROFILES", "") or "{}")
+
+# Event deduplication: Hayabusa to Timesketch runs upload only the events their
+# sketch doesn't hold yet. Seen events are recorded per sketch in DEDUP_DIR.
+DEDUP_EVENTS = os.getenv("DEDUP_EVENTS", "false").lower() == "true"
+DEDUP_DIR = os.getenv("DEDUP_DIR", "/tmp/openrelik-pipeline-dedup")
+DEDUP_POLL_INTERVAL = float(os.getenv("DEDUP_POLL_INTERVAL", "30"))
+DEDUP_MAX_WAIT = float(os.getenv("DEDUP_MAX_WAIT", "86400"))
+
+# Timeline merging: Hayabusa to Timesketch runs of labels matching MERGE_LABELS (comma
+# separated globs, all labels when unset) are merged per sketch into time-sorted
+# timelines of up to MERGE_MAX_HOSTS hosts, once no host was added for MERGE_WINDOW seconds
+MERGE_TIMELINES = os.getenv("MERGE_TIMELINES", "false").lower() == "true"
+MERGE_LABELS = [p.strip() for p in os.getenv("MERGE_LABELS", "").split(",") if p.strip()]
+MERGE_DIR = os.getenv("MERGE_DIR", "/tmp/openrelik-pipeline-merge")
+MERGE_WINDOW = float(os.getenv("MERGE_WINDOW", "900"))
+MERGE_MAX_HOSTS = int(os.getenv("MERGE_MAX_HOSTS", "100"))
+MERGE_POLL_INTERVAL = float(os.getenv("MERGE_POLL_INTERVAL", "30"))
+MERGE_MAX_WAIT = float(os.getenv("MERGE_MAX_WAIT", "86400"))
+
+# Multi-host archives: zips bundling the collections of several hosts in top-level
+# directories are split into one archive, workflow and timeline per host
+SPLIT_MULTI_HOST = os.getenv("SPLIT_MULTI_HOST", "false").lower() == "true"
+SPLIT_MIN_HOSTS = int(os.getenv("SPLIT_MIN_HOSTS", "2"))
+SPLIT_WORKERS = int(os.getenv("SPLIT_WORKERS", "4"))
+
+# Upload compression: raw .evtx uploads to the Hayabusa routes are deflated into a
+# zip while they are saved and run through the extract variant of the workflow
+COMPRESS_UPLOADS = os.getenv("COMPRESS_UPLOADS", "false").lower() == "true"
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+
+# Compact workflow specs: only send task names, queues, UUIDs and the config values
+# that are set, without the labels, descriptions and choices the OpenRelik UI uses
+COMPACT_WORKFLOW_SPEC = os.getenv("COMPACT_WORKFLOW_SPEC", "false").lower() == "true"
+
+# Result retrieval: output files fetched through /api/workflows/<id>/results are kept
+# in an LRU disk cache, evicted least recently used first above RESULTS_CACHE_MAX_BYTES
+RESULTS_CACHE_DIR = os.getenv("RESULTS_CACHE_DIR", "/tmp/openrelik-pipeline-results")
+RESULTS_CACHE_MAX_BYTES = int(os.getenv("RESULTS_CACHE_MAX_BYTES", str(10 * 1024**3)))
+
 # Initialize API clients
 api_client = APIClient(API_URL, API_KEY)
 folders_api = FoldersAPI(api_client)
@@ -38,797 +203,1357 @@ ts_client = timesketch_client.TimesketchApi(
 
 
 # --------------------------------------------------------------------------------
-# Helper functions
-# --------------------------------------------------------------------------------        
-def create_folder(folder_name):
+# Tracing and profiling
+# --------------------------------------------------------------------------------
+def current_request_id():
     """
-    Create a new root folder with the given folder name.
+    Return the ID of the request or ingest job being handled, if any.
     """
-    response = folders_api.create_root_folder(folder_name)
-    return response
+    if has_app_context():
+        return g.get("request_id")
+    return None
 
 
-def upload_file(file_path, folder_id):
+def log_event(event, **fields):
     """
-    Upload a file to the specified folder.
+    Emit one structured JSON log line tagged with the current request ID.
     """
-    response = api_client.upload_file(file_path, folder_id)
-    return response
+    record = {"ts": round(time.time(), 3), "event": event, "request_id": current_request_id()}
+    record.update(fields)
+    print(json.dumps(record, default=str), flush=True)
 
 
-def create_workflow(folder_id, file_ids):
+@contextlib.contextmanager
+def span(name, **fields):
     """
-    Create a new workflow in the specified folder with the given file IDs.
-    Returns the workflow ID and the workflow's folder ID.
+    Time a block and log it as a span of the current request.
     """
-    response = workflows_api.create_workflow(folder_id, file_ids)
-    workflow_id = response
-    workflow = workflows_api.get_workflow(folder_id, workflow_id)
-    return workflow_id, workflow["folder"]["id"]
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        if TRACE_SPANS:
+            duration_ms = round((time.perf_counter() - started) * 1000, 2)
+            log_event("span", span=name, duration_ms=duration_ms, status=status, **fields)
 
 
-def rename_folder(folder_id, new_name):
+def native_thread_api():
     """
-    Rename an existing folder.
+    Return (get_ident, start_new_thread, allocate_lock) for real OS threads, even
+    when gevent has monkey-patched threading into greenlets.
     """
-    return folders_api.update_folder(folder_id, {"display_name": new_name})
+    try:
+        from gevent import monkey
 
+        if monkey.is_module_patched("threading"):
+            return (
+                monkey.get_original("_thread", "get_ident"),
+                monkey.get_original("_thread", "start_new_thread"),
+                monkey.get_original("_thread", "allocate_lock"),
+            )
+    except ImportError:
+        pass
+    import _thread
 
-def rename_workflow(folder_id, workflow_id, new_name):
+    return _thread.get_ident, _thread.start_new_thread, _thread.allocate_lock
+
+
+def run_off_event_loop(func, *args):
     """
-    Rename an existing workflow.
+    Run CPU-bound work in gevent's pool of real threads when gevent has
+    monkey-patched threading, so the event loop keeps serving the worker's other
+    requests meanwhile. Runs it inline otherwise.
     """
-    return workflows_api.update_workflow(
-        folder_id, workflow_id, {"display_name": new_name}
-    )
+    try:
+        from gevent import monkey, get_hub
 
+        if monkey.is_module_patched("threading"):
+            return get_hub().threadpool.apply(func, args)
+    except ImportError:
+        pass
+    return func(*args)
 
-def add_plaso_tasks_to_workflow(folder_id, workflow_id):
+
+class SamplingProfiler:
     """
-    Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
+    Periodically sample the stack of one thread from a native side thread and
+    count collapsed stacks, ready for flamegraph.pl or speedscope.
     """
-    plaso_task_uuid = str(uuid.uuid4()).replace("-", "")
-    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
 
-    workflow_spec = {
-        "spec_json": json.dumps(
-            {
-                "workflow": {
-                    "type": "chain",
-                    "isRoot": True,
-                    "tasks": [
-                        {
-                            "task_name": "openrelik-worker-plaso.tasks.log2timeline",
-                            "queue_name": "openrelik-worker-plaso",
-                            "display_name": "Plaso: Log2Timeline",
-                            "description": "Super timelining",
-                            "task_config": [
-                                {
-                                    "name": "artifacts",
-                                    "label": "Select artifacts to parse",
-                                    "description": (
-                                        "Select one or more forensic artifact definitions "
-                                        "from the ForensicArtifacts project. These definitions "
-                                        "specify files and data relevant to digital forensic "
-                                        "investigations. Only the selected artifacts will be "
-                                        "parsed."
-                                    ),
-                                    "type": "artifacts",
-                                    "required": False,
-                                },
-                                {
-                                    "name": "parsers",
-                                    "label": "Select parsers to use",
-                                    "description": (
-                                        "Select one or more Plaso parsers. These parsers specify "
-                                        "how to interpret files and data. Only data identified by "
-                                        "the selected parsers will be processed."
-                                    ),
-                                    "type": "autocomplete",
-                                    "items": [
-                                        "winreg/amcache",
-                                        "sqlite/dropbox",
-                                        "text/skydrive_log_v2",
-                                        "winreg/ccleaner",
-                                        "sqlite/twitter_android",
-                                        "plist/macos_login_window_plist",
-                                        "text/cri_log",
-                                        "text/powershell_transcript",
-                                        "winevt",
-                                        "olecf/olecf_automatic_destinations",
-                                        "text/viminfo",
-                                        "plist/ipod_device",
-                                        "czip/oxml",
-                                        "plist/airport",
-                                        "plist/time_machine",
-                                        "wincc_sys",
-                                        "text",
-                                        "text/xchatscrollback",
-                                        "utmpx",
-                                        "jsonl/aws_cloudtrail_log",
-                                        "plist/macos_install_history",
-                                        "pls_recall",
-                                        "plist/macos_bluetooth",
-                                        "sqlite/chrome_8_history",
-                                        "sqlite/hangouts_messages",
-                                        "winreg/bam",
-                                        "text/android_logcat",
-                                        "text/setupapi",
-                                        "winreg/mrulist_shell_item_list",
-                                        "winreg/windows_task_cache",
-                                        "winpca_dic",
-                                        "winreg/mrulistex_shell_item_list",
-                                        "winreg/mstsc_rdp",
-                                        "winreg/microsoft_outlook_mru",
-                                        "sqlite/android_calls",
-                                        "sqlite/windows_push_notification",
-                                        "winreg/windows_run",
-                                        "text/winfirewall",
-                                        "spotlight_storedb",
-                                        "sqlite/safari_historydb",
-                                        "text/gdrive_synclog",
-                                        "esedb",
-                                        "text/teamviewer_connections_incoming",
-                                        "text/mac_appfirewall_log",
-                                        "sqlite/ios_screentime",
-                                        "winevtx",
-                                        "sqlite/appusage",
-                                        "text/confluence_access",
-                                        "mft",
-                                        "winreg/windows_version",
-                                        "onedrive_log",
-                                        "text/popularity_contest",
-                                        "winreg/windows_services",
-                                        "windefender_history",
-                                        "winreg/windows_usbstor_devices",
-                                        "plist/ios_identityservices",
-                                        "usnjrnl",
-                                        "trendmicro_vd",
-                                        "prefetch",
-                                        "text/aws_elb_access",
-                                        "mac_keychain",
-                                        "sqlite/edge_load_statistics",
-                                        "filestat",
-                                        "jsonl/azure_activity_log",
-                                        "sqlite/android_webviewcache",
-                                        "sqlite/imessage",
-                                        "sqlite/chrome_17_cookies",
-                                        "plist/safari_history",
-                                        "msiecf",
-                                        "sqlite/ios_powerlog",
-                                        "sqlite/firefox_history",
-                                        "locate_database",
-                                        "text/snort_fastlog",
-                                        "esedb/msie_webcache",
-                                        "jsonl/docker_container_log",
-                                        "trendmicro_url",
-                                        "sqlite/mac_document_versions",
-                                        "text/ios_lockdownd",
-                                        "winreg/bagmru",
-                                        "chrome_preferences",
-                                        "sqlite/ls_quarantine",
-                                        "sqlite/ios_datausage",
-                                        "sqlite",
-                                        "simatic_s7",
-                                        "czip",
-                                        "plist/macos_login_items_plist",
-                                        "plist/plist_default",
-                                        "winreg/mrulist_string",
-                                        "sqlite/firefox_118_downloads",
-                                        "text/teamviewer_application_log",
-                                        "firefox_cache",
-                                        "sqlite/android_webview",
-                                        "winreg",
-                                        "winpca_db0",
-                                        "text/teamviewer_connections_outgoing",
-                                        "sqlite/twitter_ios",
-                                        "olecf",
-                                        "bsm_log",
-                                        "opera_global",
-                                        "text/googlelog",
-                                        "android_app_usage",
-                                        "mcafee_protection",
-                                        "winreg/microsoft_office_mru",
-                                        "sqlite/windows_eventtranscript",
-                                        "asl_log",
-                                        "fish_history",
-                                        "winreg/explorer_mountpoints2",
-                                        "sqlite/kodi",
-                                        "winreg/mrulistex_string",
-                                        "winreg/networks",
-                                        "text/winiis",
-                                        "sqlite/android_sms",
-                                        "cups_ipp",
-                                        "winreg/winrar_mru",
-                                        "lnk",
-                                        "bencode/bencode_utorrent",
-                                        "jsonl",
-                                        "plist/launchd_plist",
-                                        "winreg/windows_sam_users",
-                                        "plist/macuser",
-                                        "text/skydrive_log_v1",
-                                        "text/mac_wifi",
-                                        "plist/spotlight",
-                                        "symantec_scanlog",
-                                        "text/ios_sysdiag_log",
-                                        "winreg/msie_zone",
-                                        "winreg/userassist",
-                                        "jsonl/ios_application_privacy",
-                                        "sqlite/chrome_27_history",
-                                        "text/vsftpd",
-                                        "bencode/bencode_transmission",
-                                        "fseventsd",
-                                        "olecf/olecf_default",
-                                        "jsonl/microsoft_audit_log",
-                                        "unified_logging",
-                                        "java_idx",
-                                        "sqlite/chrome_extension_activity",
-                                        "sqlite/kik_ios",
-                                        "opera_typed_history",
-                                        "sqlite/windows_timeline",
-                                        "text/sccm",
-                                        "sqlite/tango_android_profile",
-                                        "sqlite/firefox_10_cookies",
-                                        "sqlite/macostcc",
-                                        "text/macos_launchd_log",
-                                        "chrome_cache",
-                                        "custom_destinations",
-                                        "winreg/network_drives",
-                                        "plist/ios_carplay",
-                                        "olecf/olecf_summary",
-                                        "sqlite/tango_android_tc",
-                                        "utmp",
-                                        "sqlite/chrome_autofill",
-                                        "sqlite/firefox_downloads",
-                                        "bodyfile",
-                                        "sqlite/android_app_usage",
-                                        "text/selinux",
-                                        "plist/macos_software_update",
-                                        "pe",
-                                        "plist/apple_id",
-                                        "text/syslog_traditional",
-                                        "winreg/windows_boot_execute",
-                                        "systemd_journal",
-                                        "firefox_cache2",
-                                        "text/apache_access",
-                                        "plist/macos_background_items_plist",
-                                        "jsonl/docker_layer_config",
-                                        "winreg/windows_boot_verify",
-                                        "text/ios_logd",
-                                        "networkminer_fileinfo",
-                                        "winreg/mrulistex_string_and_shell_item",
-                                        "esedb/file_history",
-                                        "sqlite/mac_notes",
-                                        "sqlite/chrome_66_cookies",
-                                        "text/sophos_av",
-                                        "esedb/srum",
-                                        "bencode",
-                                        "winreg/winreg_default",
-                                        "text/xchatlog",
-                                        "sqlite/zeitgeist",
-                                        "text/postgresql",
-                                        "sqlite/firefox_2_cookies",
-                                        "winreg/windows_usb_devices",
-                                        "winreg/windows_timezone",
-                                        "binary_cookies",
-                                        "winjob",
-                                        "recycle_bin_info2",
-                                        "plist/safari_downloads",
-                                        "sqlite/ios_netusage",
-                                        "text/apt_history",
-                                        "plist/spotlight_volume",
-                                        "sqlite/skype",
-                                        "sqlite/google_drive",
-                                        "winreg/windows_typed_urls",
-                                        "jsonl/docker_container_config",
-                                        "text/dpkg",
-                                        "text/zsh_extended_history",
-                                        "text/syslog",
-                                        "sqlite/mackeeper_cache",
-                                        "winreg/mstsc_rdp_mru",
-                                        "winreg/windows_shutdown",
-                                        "olecf/olecf_document_summary",
-                                        "winreg/appcompatcache",
-                                        "winreg/mrulistex_string_and_shell_item_list",
-                                        "text/santa",
-                                        "winreg/winlogon",
-                                        "text/bash_history",
-                                        "text/mac_securityd",
-                                        "recycle_bin",
-                                        "sqlite/android_turbo",
-                                        "jsonl/azure_application_gateway_access_log",
-                                        "rplog",
-                                        "winreg/explorer_programscache",
-                                        "esedb/user_access_logging",
-                                        "jsonl/gcp_log",
-                                        "sqlite/mac_knowledgec",
-                                        "plist/macos_startup_item_plist",
-                                        "plist",
-                                    ],
-                                    "required": False,
-                                },
-                                {
-                                    "name": "archives",
-                                    "label": "Archives",
-                                    "description": (
-                                        "Select one or more Plaso archive types. "
-                                        "Files inside these archive types will be processed."
-                                    ),
-                                    "type": "autocomplete",
-                                    "items": ["iso9660", "modi", "tar", "vhdi", "zip"],
-                                    "required": False,
-                                },
-                            ],
-                            "type": "task",
-                            "uuid": f"{plaso_task_uuid}",
-                            "tasks": [],
-                        }
-                    ],
-                }
-            }
-        )
-    }
+    def __init__(self, interval):
+        get_ident, self.start_new_thread, allocate_lock = native_thread_api()
+        self.thread_id = get_ident()
+        self.interval = interval
+        self.stacks = {}
+        self.running = False
+        # Held by the sampler thread until it stopped sampling
+        self.sampling = allocate_lock()
 
-    return workflows_api.update_workflow(folder_id, workflow_id, workflow_spec)
+    def start(self):
+        self.running = True
+        self.sampling.acquire()
+        self.start_new_thread(self.sample, ())
 
+    def sample(self):
+        try:
+            while self.running:
+                frame = sys._current_frames().get(self.thread_id)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if names:
+                    stack = ";".join(reversed(names))
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                time.sleep(self.interval)
+        finally:
+            self.sampling.release()
 
-def add_plaso_ts_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name):
+    def stop(self, path):
+        self.running = False
+        # Wait for the sampler to finish its last sample before reading the stacks
+        with self.sampling:
+            stacks = dict(self.stacks)
+        with open(path, "w") as fh:
+            for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+                fh.write(f"{stack} {count}\n")
+
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+profile_lock = threading.Lock()
+tracemalloc_lock = threading.Lock()
+tracemalloc_users = 0
+
+
+def claim_profile_slot():
     """
-    Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
+    Take one of the requests armed through /debug/profile, if any are left.
+
+    The control file is shared by all Gunicorn workers and guarded with flock,
+    so N armed requests are profiled once in total, whichever worker serves them.
     """
-    plaso_task_uuid = str(uuid.uuid4()).replace("-", "")
-    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
+    control_path = os.path.join(PROFILE_DIR, "control.json")
+    if not os.path.exists(control_path):
+        return None
+    with open(control_path, "r+") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            control = json.load(fh)
+        except ValueError:
+            return None
+        if control.get("remaining", 0) <= 0:
+            return None
+        control["remaining"] -= 1
+        fh.seek(0)
+        fh.truncate()
+        json.dump(control, fh)
+    return control
 
-    task_config = [
-        {
-            "name": "sketch_name",
-            "label": "Create a new sketch",
-            "description": "Create a new sketch",
-            "type": "text",
-            "required": False,
-            "value": f"{sketch_name}",
-        },
-        {
-            "name": "timeline_name",
-            "label": "Name of the timeline to create",
-            "description": "Timeline name",
-            "type": "text",
-            "required": False,
-            "value": f"{timeline_name}"
-        }
-    ]
-    if sketch_id != "":
-        task_config = [
-            {
-                "name": "sketch_id",
-                "label": "Add to existing sketch",
-                "description": "Add to existing sketch",
-                "type": "text",
-                "required": False,
-                "value": f"{sketch_id}",
-            },
-            {
-                "name": "timeline_name",
-                "label": "Name of the timeline to create",
-                "description": "Timeline name",
-                "type": "text",
-                "required": False,
-                "value": f"{timeline_name}"
-            }
-        ]
-        
-    workflow_spec = {
-        "spec_json": json.dumps(
-            {
-                "workflow": {
-                    "type": "chain",
-                    "isRoot": True,
-                    "tasks": [
-                        {
-                            "task_name": "openrelik-worker-plaso.tasks.log2timeline",
-                            "queue_name": "openrelik-worker-plaso",
-                            "display_name": "Plaso: Log2Timeline",
-                            "description": "Super timelining",
-                            "task_config": [
-                                {
-                                    "name": "artifacts",
-                                    "label": "Select artifacts to parse",
-                                    "description": (
-                                        "Select one or more forensic artifact definitions "
-                                        "from the ForensicArtifacts project. These definitions "
-                                        "specify files and data relevant to digital forensic "
-                                        "investigations. Only the selected artifacts will be "
-                                        "parsed."
-                                    ),
-                                    "type": "artifacts",
-                                    "required": False,
-                                },
-                                {
-                                    "name": "parsers",
-                                    "label": "Select parsers to use",
-                                    "description": (
-                                        "Select one or more Plaso parsers. These parsers specify "
-                                        "how to interpret files and data. Only data identified by "
-                                        "the selected parsers will be processed."
-                                    ),
-                                    "type": "autocomplete",
-                                    "items": [
-                                        "winreg/amcache",
-                                        "sqlite/dropbox",
-                                        "text/skydrive_log_v2",
-                                        "winreg/ccleaner",
-                                        "sqlite/twitter_android",
-                                        "plist/macos_login_window_plist",
-                                        "text/cri_log",
-                                        "text/powershell_transcript",
-                                        "winevt",
-                                        "olecf/olecf_automatic_destinations",
-                                        "text/viminfo",
-                                        "plist/ipod_device",
-                                        "czip/oxml",
-                                        "plist/airport",
-                                        "plist/time_machine",
-                                        "wincc_sys",
-                                        "text",
-                                        "text/xchatscrollback",
-                                        "utmpx",
-                                        "jsonl/aws_cloudtrail_log",
-                                        "plist/macos_install_history",
-                                        "pls_recall",
-                                        "plist/macos_bluetooth",
-                                        "sqlite/chrome_8_history",
-                                        "sqlite/hangouts_messages",
-                                        "winreg/bam",
-                                        "text/android_logcat",
-                                        "text/setupapi",
-                                        "winreg/mrulist_shell_item_list",
-                                        "winreg/windows_task_cache",
-                                        "winpca_dic",
-                                        "winreg/mrulistex_shell_item_list",
-                                        "winreg/mstsc_rdp",
-                                        "winreg/microsoft_outlook_mru",
-                                        "sqlite/android_calls",
-                                        "sqlite/windows_push_notification",
-                                        "winreg/windows_run",
-                                        "text/winfirewall",
-                                        "spotlight_storedb",
-                                        "sqlite/safari_historydb",
-                                        "text/gdrive_synclog",
-                                        "esedb",
-                                        "text/teamviewer_connections_incoming",
-                                        "text/mac_appfirewall_log",
-                                        "sqlite/ios_screentime",
-                                        "winevtx",
-                                        "sqlite/appusage",
-                                        "text/confluence_access",
-                                        "mft",
-                                        "winreg/windows_version",
-                                        "onedrive_log",
-                                        "text/popularity_contest",
-                                        "winreg/windows_services",
-                                        "windefender_history",
-                                        "winreg/windows_usbstor_devices",
-                                        "plist/ios_identityservices",
-                                        "usnjrnl",
-                                        "trendmicro_vd",
-                                        "prefetch",
-                                        "text/aws_elb_access",
-                                        "mac_keychain",
-                                        "sqlite/edge_load_statistics",
-                                        "filestat",
-                                        "jsonl/azure_activity_log",
-                                        "sqlite/android_webviewcache",
-                                        "sqlite/imessage",
-                                        "sqlite/chrome_17_cookies",
-                                        "plist/safari_history",
-                                        "msiecf",
-                                        "sqlite/ios_powerlog",
-                                        "sqlite/firefox_history",
-                                        "locate_database",
-                                        "text/snort_fastlog",
-                                        "esedb/msie_webcache",
-                                        "jsonl/docker_container_log",
-                                        "trendmicro_url",
-                                        "sqlite/mac_document_versions",
-                                        "text/ios_lockdownd",
-                                        "winreg/bagmru",
-                                        "chrome_preferences",
-                                        "sqlite/ls_quarantine",
-                                        "sqlite/ios_datausage",
-                                        "sqlite",
-                                        "simatic_s7",
-                                        "czip",
-                                        "plist/macos_login_items_plist",
-                                        "plist/plist_default",
-                                        "winreg/mrulist_string",
-                                        "sqlite/firefox_118_downloads",
-                                        "text/teamviewer_application_log",
-                                        "firefox_cache",
-                                        "sqlite/android_webview",
-                                        "winreg",
-                                        "winpca_db0",
-                                        "text/teamviewer_connections_outgoing",
-                                        "sqlite/twitter_ios",
-                                        "olecf",
-                                        "bsm_log",
-                                        "opera_global",
-                                        "text/googlelog",
-                                        "android_app_usage",
-                                        "mcafee_protection",
-                                        "winreg/microsoft_office_mru",
-                                        "sqlite/windows_eventtranscript",
-                                        "asl_log",
-                                        "fish_history",
-                                        "winreg/explorer_mountpoints2",
-                                        "sqlite/kodi",
-                                        "winreg/mrulistex_string",
-                                        "winreg/networks",
-                                        "text/winiis",
-                                        "sqlite/android_sms",
-                                        "cups_ipp",
-                                        "winreg/winrar_mru",
-                                        "lnk",
-                                        "bencode/bencode_utorrent",
-                                        "jsonl",
-                                        "plist/launchd_plist",
-                                        "winreg/windows_sam_users",
-                                        "plist/macuser",
-                                        "text/skydrive_log_v1",
-                                        "text/mac_wifi",
-                                        "plist/spotlight",
-                                        "symantec_scanlog",
-                                        "text/ios_sysdiag_log",
-                                        "winreg/msie_zone",
-                                        "winreg/userassist",
-                                        "jsonl/ios_application_privacy",
-                                        "sqlite/chrome_27_history",
-                                        "text/vsftpd",
-                                        "bencode/bencode_transmission",
-                                        "fseventsd",
-                                        "olecf/olecf_default",
-                                        "jsonl/microsoft_audit_log",
-                                        "unified_logging",
-                                        "java_idx",
-                                        "sqlite/chrome_extension_activity",
-                                        "sqlite/kik_ios",
-                                        "opera_typed_history",
-                                        "sqlite/windows_timeline",
-                                        "text/sccm",
-                                        "sqlite/tango_android_profile",
-                                        "sqlite/firefox_10_cookies",
-                                        "sqlite/macostcc",
-                                        "text/macos_launchd_log",
-                                        "chrome_cache",
-                                        "custom_destinations",
-                                        "winreg/network_drives",
-                                        "plist/ios_carplay",
-                                        "olecf/olecf_summary",
-                                        "sqlite/tango_android_tc",
-                                        "utmp",
-                                        "sqlite/chrome_autofill",
-                                        "sqlite/firefox_downloads",
-                                        "bodyfile",
-                                        "sqlite/android_app_usage",
-                                        "text/selinux",
-                                        "plist/macos_software_update",
-                                        "pe",
-                                        "plist/apple_id",
-                                        "text/syslog_traditional",
-                                        "winreg/windows_boot_execute",
-                                        "systemd_journal",
-                                        "firefox_cache2",
-                                        "text/apache_access",
-                                        "plist/macos_background_items_plist",
-                                        "jsonl/docker_layer_config",
-                                        "winreg/windows_boot_verify",
-                                        "text/ios_logd",
-                                        "networkminer_fileinfo",
-                                        "winreg/mrulistex_string_and_shell_item",
-                                        "esedb/file_history",
-                                        "sqlite/mac_notes",
-                                        "sqlite/chrome_66_cookies",
-                                        "text/sophos_av",
-                                        "esedb/srum",
-                                        "bencode",
-                                        "winreg/winreg_default",
-                                        "text/xchatlog",
-                                        "sqlite/zeitgeist",
-                                        "text/postgresql",
-                                        "sqlite/firefox_2_cookies",
-                                        "winreg/windows_usb_devices",
-                                        "winreg/windows_timezone",
-                                        "binary_cookies",
-                                        "winjob",
-                                        "recycle_bin_info2",
-                                        "plist/safari_downloads",
-                                        "sqlite/ios_netusage",
-                                        "text/apt_history",
-                                        "plist/spotlight_volume",
-                                        "sqlite/skype",
-                                        "sqlite/google_drive",
-                                        "winreg/windows_typed_urls",
-                                        "jsonl/docker_container_config",
-                                        "text/dpkg",
-                                        "text/zsh_extended_history",
-                                        "text/syslog",
-                                        "sqlite/mackeeper_cache",
-                                        "winreg/mstsc_rdp_mru",
-                                        "winreg/windows_shutdown",
-                                        "olecf/olecf_document_summary",
-                                        "winreg/appcompatcache",
-                                        "winreg/mrulistex_string_and_shell_item_list",
-                                        "text/santa",
-                                        "winreg/winlogon",
-                                        "text/bash_history",
-                                        "text/mac_securityd",
-                                        "recycle_bin",
-                                        "sqlite/android_turbo",
-                                        "jsonl/azure_application_gateway_access_log",
-                                        "rplog",
-                                        "winreg/explorer_programscache",
-                                        "esedb/user_access_logging",
-                                        "jsonl/gcp_log",
-                                        "sqlite/mac_knowledgec",
-                                        "plist/macos_startup_item_plist",
-                                        "plist",
-                                    ],
-                                    "required": False,
-                                },
-                                {
-                                    "name": "archives",
-                                    "label": "Archives",
-                                    "description": (
-                                        "Select one or more Plaso archive types. "
-                                        "Files inside these archive types will be processed."
-                                    ),
-                                    "type": "autocomplete",
-                                    "items": ["iso9660", "modi", "tar", "vhdi", "zip"],
-                                    "required": False,
-                                },
-                            ],
-                            "type": "task",
-                            "uuid": f"{plaso_task_uuid}",
-                            "tasks": [
-                                {
-                                    "task_name": "openrelik-worker-timesketch.tasks.upload",
-                                    "queue_name": "openrelik-worker-timesketch",
-                                    "display_name": "Upload to Timesketch",
-                                    "description": "Upload resulting file to Timesketch",
-                                    "task_config": task_config,
-                                    "type": "task",
-                                    "uuid": f"{timesketch_task_uuid}",
-                                    "tasks": [],
-                                }
-                            ],
-                        }
-                    ],
-                }
-            }
-        )
-    }
 
-    return workflows_api.update_workflow(folder_id, workflow_id, workflow_spec)
+def start_profiling(control):
+    """
+    Start the profilers requested in `control` for the current request.
+    Only one CPU profile runs per process at a time; if one is already running
+    this request is profiled for memory only.
+    """
+    global tracemalloc_users
+    profile = {"control": control, "cpu": None}
+    if profile_lock.acquire(blocking=False):
+        if control.get("mode") == "sampling":
+            profile["cpu"] = SamplingProfiler(PROFILE_SAMPLE_INTERVAL)
+            profile["cpu"].start()
+        else:
+            profile["cpu"] = cProfile.Profile()
+            profile["cpu"].enable()
+    if control.get("tracemalloc"):
+        with tracemalloc_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+            tracemalloc_users += 1
+    return profile
 
 
-def add_hayabusa_tasks_to_workflow(folder_id, workflow_id):
+def stop_profiling(profile):
     """
-    Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
+    Stop the profilers of the current request and write their output to PROFILE_DIR.
     """
-    hayabusa_task_uuid = str(uuid.uuid4()).replace("-", "")
-    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
+    global tracemalloc_users
+    prefix = os.path.join(PROFILE_DIR, f"{int(time.time())}-{current_request_id()}")
+    written = []
+    cpu = profile["cpu"]
+    if cpu is not None:
+        if isinstance(cpu, SamplingProfiler):
+            cpu.stop(f"{prefix}.collapsed")
+            written.append(f"{prefix}.collapsed")
+        else:
+            cpu.disable()
+            cpu.dump_stats(f"{prefix}.prof")
+            written.append(f"{prefix}.prof")
+        profile_lock.release()
+    if profile["control"].get("tracemalloc"):
+        tracemalloc.take_snapshot().dump(f"{prefix}.tracemalloc")
+        written.append(f"{prefix}.tracemalloc")
+        with tracemalloc_lock:
+            tracemalloc_users -= 1
+            if tracemalloc_users == 0:
+                tracemalloc.stop()
+    log_event("profile", files=[os.path.basename(path) for path in written])
 
-    workflow_spec = {
-        "spec_json": json.dumps(
-            {
-                "workflow": {
-                    "type": "chain",
-                    "isRoot": True,
-                    "tasks": [
-                        {
-                            "task_name": "openrelik-worker-hayabusa.tasks.csv_timeline",
-                            "queue_name": "openrelik-worker-hayabusa",
-                            "display_name": "Hayabusa CSV timeline",
-                            "description": "Windows event log triage",
-                            "type": "task",
-                            "uuid": f"{hayabusa_task_uuid}",
-                            "tasks": [],
-                        }
-                    ],
-                }
-            }
+
+@app.before_request
+def start_request_trace():
+    """
+    Assign a request ID (honouring an incoming X-Request-ID) and start profiling if armed.
+    """
+    request_id = request.headers.get("X-Request-ID", "")
+    g.request_id = request_id if REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+    g.profile = None
+    if DEBUG_TOKEN and not request.path.startswith("/debug/"):
+        control = claim_profile_slot()
+        if control:
+            g.profile = start_profiling(control)
+
+
+@app.after_request
+def finish_request_trace(response):
+    """
+    Log the request span and echo the request ID back to the caller.
+    """
+    response.headers["X-Request-ID"] = g.get("request_id", "")
+    if TRACE_SPANS and g.get("request_started") is not None:
+        duration_ms = round((time.perf_counter() - g.request_started) * 1000, 2)
+        log_event(
+            "span", span="request", method=request.method, path=request.path,
+            duration_ms=duration_ms, status=response.status_code,
         )
-    }
+    return response
 
-    return workflows_api.update_workflow(folder_id, workflow_id, workflow_spec)
 
+@app.teardown_request
+def finish_request_profile(error):
+    """
+    Write out any profile captured for the request.
+    """
+    if g.get("profile") is not None:
+        stop_profiling(g.profile)
+        g.profile = None
 
-def add_hayabusa_ts_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name):
+
+# --------------------------------------------------------------------------------
+# Upstream resilience
+# --------------------------------------------------------------------------------
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailable(Exception):
     """
-    Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
+    Raised when an upstream is known to be down, either because its circuit
+    breaker is open or because a stage kept failing after all retries.
     """
-    hayabusa_task_uuid = str(uuid.uuid4()).replace("-", "")
-    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
 
-    task_config = [
-        {
-            "name": "sketch_name",
-            "label": "Create a new sketch",
-            "description": "Create a new sketch",
-            "type": "text",
-            "required": False,
-            "value": f"{sketch_name}",
-        },
-        {
-            "name": "timeline_name",
-            "label": "Name of the timeline to create",
-            "description": "Timeline name",
-            "type": "text",
-            "required": False,
-            "value": f"{timeline_name}"
-        }
-    ]
-    if sketch_id != "":
-        task_config = [
-            {
-                "name": "sketch_id",
-                "label": "Add to existing sketch",
-                "description": "Add to existing sketch",
-                "type": "text",
-                "required": False,
-                "value": f"{sketch_id}",
-            },
-            {
-                "name": "timeline_name",
-                "label": "Name of the timeline to create",
-                "description": "Timeline name",
-                "type": "text",
-                "required": False,
-                "value": f"{timeline_name}"
-            }
-        ]
+    def __init__(self, upstream, retry_after):
+        super().__init__(f"{upstream} is unavailable")
+        self.upstream = upstream
+        self.retry_after = retry_after
 
-    workflow_spec = {
-        "spec_json": json.dumps(
-            {
-                "workflow": {
-                    "type": "chain",
-                    "isRoot": True,
-                    "tasks": [
-                        {
-                            "task_name": "openrelik-worker-hayabusa.tasks.csv_timeline",
-                            "queue_name": "openrelik-worker-hayabusa",
-                            "display_name": "Hayabusa CSV timeline",
-                            "description": "Windows event log triage",
-                            "type": "task",
-                            "uuid": f"{hayabusa_task_uuid}",
-                            "tasks": [
-                                {
-                                    "task_name": "openrelik-worker-timesketch.tasks.upload",
-                                    "queue_name": "openrelik-worker-timesketch",
-                                    "display_name": "Upload to Timesketch",
-                                    "description": "Upload resulting file to Timesketch",
-                                    "task_config": task_config,
-                                    "type": "task",
-                                    "uuid": f"{timesketch_task_uuid}",
-                                    "tasks": [],
-                                }
-                            ],
-                        }
-                    ],
-                }
+
+class CircuitBreaker:
+    """
+    Fail fast while an upstream is down.
+
+    The breaker opens after `threshold` consecutive transient failures. Once
+    `reset_timeout` seconds have passed a single probe call is let through;
+    its outcome closes the breaker again or re-opens it.
+    """
+
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def retry_after(self):
+        """
+        Seconds until the breaker lets the next probe through.
+        """
+        if self.opened_at is None:
+            return 1
+        remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        return max(1, int(remaining + 0.5))
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise UpstreamUnavailable(self.name, self.retry_after())
+            self.probing = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release_probe(self):
+        """
+        End a probe whose outcome says nothing about the upstream's health,
+        so the next call can probe again.
+        """
+        with self.lock:
+            self.probing = False
+
+
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(upstream):
+    """
+    Return the circuit breaker for the given upstream, creating it on first use.
+    """
+    with circuit_breakers_lock:
+        if upstream not in circuit_breakers:
+            circuit_breakers[upstream] = CircuitBreaker(
+                upstream, CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT
+            )
+        return circuit_breakers[upstream]
+
+
+def is_transient_error(error):
+    """
+    Return True for errors worth retrying: connection problems, timeouts and
+    5xx/429 responses. Anything else means the upstream answered properly.
+    """
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+# Stages whose calls count against the adaptive concurrency limit of their upstream
+ADAPTIVE_STAGES = ("upload_file", "create_workflow", "run_workflow")
+# Weight of a new sample in the moving average a call's time is compared with
+ADAPTIVE_BASELINE_WEIGHT = 0.05
+
+
+class AdaptiveLimiter:
+    """
+    Cap the calls in flight to an upstream with additive increase and
+    multiplicative decrease (AIMD).
+
+    Every call is timed per unit of `cost` (e.g. per MiB uploaded) and compared
+    with a moving average of the calls of its stage and size. Sizes are bucketed
+    by powers of two, so small uploads, whose time is mostly fixed overhead, are
+    only compared with each other. The average follows lasting changes within a
+    few dozen calls. A call that fails with a transient error (see is_transient_error),
+    a failed upload (the OpenRelik client raises RuntimeError for those, 429 and
+    503 included) or takes more than `tolerance` times that baseline shrinks the
+    limit by `backoff`. Other errors, such as a 404, leave it alone. Calls in
+    flight at that point can't shrink it again. Healthy calls made while at least half the
+    limit is in use grow it by about one per limit's worth of calls.
+    """
+
+    def __init__(self, name, initial, minimum, maximum, tolerance, backoff):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.baselines = {}
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def slot(self, stage, cost=1.0):
+        """
+        Wait until the call fits under the limit, then time it.
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            busy = self.in_flight >= self.limit / 2
+        started = time.monotonic()
+        outcome = "ok"
+        try:
+            yield
+        except Exception as e:
+            outcome = "overload" if is_transient_error(e) or isinstance(e, RuntimeError) else "error"
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            with self.condition:
+                self.in_flight -= 1
+                if outcome != "error":
+                    cost = max(cost, 1.0)
+                    key = f"{stage}:{2 ** int(math.log2(cost))}"
+                    self.record(key, started, elapsed / cost, outcome == "overload", busy)
+                self.condition.notify_all()
+
+    def record(self, key, started, sample, overloaded, busy):
+        """
+        Adjust the limit after a call, `key` being its stage and size bucket.
+        Called with the condition held.
+        """
+        baseline = self.baselines.get(key)
+        slow = baseline is not None and sample > self.tolerance * baseline
+        if overloaded:
+            pass
+        elif baseline is None:
+            self.baselines[key] = sample
+        else:
+            self.baselines[key] = baseline + (sample - baseline) * ADAPTIVE_BASELINE_WEIGHT
+
+        previous = int(self.limit)
+        if overloaded or slow:
+            if started < self.last_decrease:
+                return
+            self.limit = max(self.minimum, self.limit * self.backoff)
+            self.last_decrease = time.monotonic()
+        elif busy:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        if int(self.limit) != previous:
+            log_event(
+                "adaptive_limit", upstream=self.name, stage=key, limit=int(self.limit),
+                previous=previous, reason="overload" if overloaded else "slow" if slow else "healthy",
+            )
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "baselines_s": {key: round(value, 4) for key, value in self.baselines.items()},
             }
+
+
+adaptive_limiters = {}
+adaptive_limiters_lock = threading.Lock()
+
+
+def get_adaptive_limiter(upstream):
+    """
+    Return the adaptive limiter for the given upstream, creating it on first use.
+    """
+    with adaptive_limiters_lock:
+        if upstream not in adaptive_limiters:
+            adaptive_limiters[upstream] = AdaptiveLimiter(
+                upstream, ADAPTIVE_INITIAL_LIMIT, ADAPTIVE_MIN_LIMIT, ADAPTIVE_MAX_LIMIT,
+                ADAPTIVE_LATENCY_TOLERANCE, ADAPTIVE_BACKOFF,
+            )
+        return adaptive_limiters[upstream]
+
+
+def call_upstream(upstream, stage, func, *args, idempotent=True, cost=1.0, **kwargs):
+    """
+    Call `func` against `upstream` through its circuit breaker.
+
+    Idempotent stages are retried on transient errors with full-jitter
+    exponential backoff. Stages that create something upstream (folders,
+    files, workflows, runs) are attempted once so a blip never duplicates them.
+    With ADAPTIVE_CONCURRENCY, ADAPTIVE_STAGES against OpenRelik wait for a slot
+    under the upstream's adaptive limit; `cost` scales their expected latency.
+    """
+    breaker = get_circuit_breaker(upstream)
+    attempts = max(1, UPSTREAM_RETRY_ATTEMPTS) if idempotent else 1
+    limiter = None
+    if ADAPTIVE_CONCURRENCY and stage in ADAPTIVE_STAGES and upstream.startswith("openrelik:"):
+        limiter = get_adaptive_limiter(upstream)
+
+    for attempt in range(1, attempts + 1):
+        breaker.before_call()
+        try:
+            with span(stage, upstream=upstream, attempt=attempt):
+                if limiter is None:
+                    result = func(*args, **kwargs)
+                else:
+                    with limiter.slot(stage, cost):
+                        result = func(*args, **kwargs)
+        except Exception as e:
+            if not is_transient_error(e):
+                # Not a sign of health either: the OpenRelik client reports
+                # failed uploads as RuntimeError.
+                breaker.release_probe()
+                raise
+            breaker.record_failure()
+            if attempt == attempts:
+                raise UpstreamUnavailable(upstream, breaker.retry_after()) from e
+            delay = random.uniform(
+                0, min(UPSTREAM_RETRY_MAX_DELAY, UPSTREAM_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            )
+            print(
+                "%s against %s failed (attempt %d/%d): %s, retrying in %.1fs"
+                % (stage, upstream, attempt, attempts, e, delay)
+            )
+            time.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+# --------------------------------------------------------------------------------
+# Backend pool
+# --------------------------------------------------------------------------------
+class Backend:
+    """
+    One OpenRelik instance and the Timesketch instance its workers push to.
+
+    `max_concurrency` caps how many pipeline runs talk to this backend at
+    once (0 means unlimited); `in_flight` is the number currently doing so.
+    """
+
+    def __init__(self, name, api_client, ts_client_factory, max_concurrency=0):
+        self.name = name
+        self.api_client = api_client
+        self.folders_api = FoldersAPI(api_client)
+        self.workflows_api = WorkflowsAPI(api_client)
+        self.ts_client_factory = ts_client_factory
+        self._ts_client = None
+        self.max_concurrency = max_concurrency
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def openrelik_upstream(self):
+        return f"openrelik:{self.name}"
+
+    @property
+    def timesketch_upstream(self):
+        return f"timesketch:{self.name}"
+
+    @property
+    def ts_client(self):
+        """
+        The Timesketch client, connected on first use.
+        """
+        with self.lock:
+            if self._ts_client is None:
+                self._ts_client = self.ts_client_factory()
+            return self._ts_client
+
+    def is_healthy(self):
+        return get_circuit_breaker(self.openrelik_upstream).state != "open"
+
+    def load(self):
+        """
+        Fraction of the concurrency limit in use, or the raw in-flight count when unlimited.
+        """
+        if self.max_concurrency:
+            return self.in_flight / self.max_concurrency
+        return self.in_flight
+
+
+def load_backends():
+    """
+    Build the backend pool from OPENRELIK_BACKENDS, or a single backend from the
+    OPENRELIK_API_URL/TIMESKETCH_URL settings and the module-level clients.
+    """
+    if not OPENRELIK_BACKENDS:
+        return [Backend("default", api_client, lambda: ts_client, BACKEND_MAX_CONCURRENCY)]
+
+    pool = []
+    for index, config in enumerate(json.loads(OPENRELIK_BACKENDS)):
+        timesketch_url = config.get("timesketch_url", TIMESKETCH_URL)
+        timesketch_password = config.get("timesketch_password", TIMESKETCH_PASSWORD)
+        pool.append(
+            Backend(
+                config.get("name", f"backend-{index}"),
+                APIClient(config["openrelik_url"], config.get("openrelik_api_key", API_KEY)),
+                lambda url=timesketch_url, password=timesketch_password: (
+                    timesketch_client.TimesketchApi(host_uri=url, username="admin", password=password)
+                ),
+                int(config.get("max_concurrency", BACKEND_MAX_CONCURRENCY)),
+            )
         )
-    }
+    return pool
+
+
+def select_backend(label=None):
+    """
+    Pick the backend for a pipeline run.
+
+    Runs with a label are routed by rendezvous hashing, so every upload of a
+    case lands on the same backend for as long as it is healthy. Runs without
+    a label go to the least loaded healthy backend.
+    """
+    healthy = [backend for backend in backends if backend.is_healthy()] or backends
+    if label:
+        return max(
+            healthy,
+            key=lambda backend: hashlib.sha256(f"{label}:{backend.name}".encode()).digest(),
+        )
+    return min(healthy, key=lambda backend: backend.load())
+
+
+@contextlib.contextmanager
+def use_backend(backend):
+    """
+    Make `backend` the current backend and hold one of its concurrency slots.
+    """
+    if backend.slots is not None:
+        backend.slots.acquire()
+    with backend.lock:
+        backend.in_flight += 1
+    previous = g.get("backend")
+    g.backend = backend
+    try:
+        yield backend
+    finally:
+        g.backend = previous
+        with backend.lock:
+            backend.in_flight -= 1
+        if backend.slots is not None:
+            backend.slots.release()
+
+
+@contextlib.contextmanager
+def backend_slot_released(backend):
+    """
+    Give the concurrency slot the current run holds on `backend` back while its
+    work runs elsewhere under slots of its own, and take it again afterwards.
+    """
+    with backend.lock:
+        backend.in_flight -= 1
+    if backend.slots is not None:
+        backend.slots.release()
+    try:
+        yield
+    finally:
+        if backend.slots is not None:
+            backend.slots.acquire()
+        with backend.lock:
+            backend.in_flight += 1
+
+
+def current_backend():
+    """
+    Return the backend selected for the current pipeline run, or the first one.
+    """
+    if has_app_context() and g.get("backend") is not None:
+        return g.backend
+    return backends[0]
+
+
+backends = load_backends()
+
+
+# --------------------------------------------------------------------------------
+# Caching
+# --------------------------------------------------------------------------------
+key_locks = {}
+key_locks_lock = threading.Lock()
+
+
+def key_lock(key):
+    """
+    Return a lock dedicated to `key`, so concurrent cache misses for the same key
+    resolve it once while other keys proceed.
+    """
+    with key_locks_lock:
+        if key not in key_locks:
+            key_locks[key] = threading.Lock()
+        return key_locks[key]
+
+
+# How often a file lock held by another process is retried
+FLOCK_POLL_INTERVAL = 0.5
+
+
+def flock_polling(fh):
+    """
+    Take an exclusive flock on `fh`, retrying instead of blocking. A blocking
+    flock would stall every greenlet of a gevent worker, not just the caller,
+    for as long as another process holds the lock.
+    """
+    while True:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            time.sleep(FLOCK_POLL_INTERVAL)
+
+
+class MemoryCache:
+    """
+    An in-process cache whose entries expire `ttl` seconds after being set.
+    Beyond `max_entries`, the least recently used entries are dropped.
+    """
+
+    def __init__(self, name, ttl, max_entries=CACHE_MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() >= entry[1]:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def update(self, key, value):
+        """
+        Replace the value of an entry without extending its lifetime.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = (value, self.entries[key][1])
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def key_lock(self, key):
+        """
+        A lock for resolving `key` once per process.
+        """
+        return key_lock((self.name, key))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": "memory",
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class RedisCache:
+    """
+    A cache in Redis, shared by every worker and instance pointed at it. Values
+    are stored as JSON and expire after `ttl` seconds; Redis' maxmemory policy
+    bounds the total size. Key locks are Redis locks, so a key is resolved once
+    across all workers. When Redis can't be reached, lookups miss and locks fall
+    back to this process.
+    """
+
+    def __init__(self, name, ttl, client):
+        self.name = name
+        self.ttl = ttl
+        self.client = client
+        self.hits = 0
+        self.misses = 0
+
+    def redis_key(self, key):
+        return f"{CACHE_PREFIX}{self.name}:{json.dumps(key, default=str)}"
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.redis_key(key))
+        except redis.RedisError as e:
+            print("Error reading %s from the cache: %s" % (key, e))
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.redis_key(key), json.dumps(value), px=int(self.ttl * 1000))
+        except redis.RedisError as e:
+            print("Error writing %s to the cache: %s" % (key, e))
+
+    def update(self, key, value):
+        """
+        Replace the value of an entry without extending its lifetime.
+        """
+        try:
+            self.client.set(self.redis_key(key), json.dumps(value), xx=True, keepttl=True)
+        except redis.RedisError as e:
+            print("Error writing %s to the cache: %s" % (key, e))
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.redis_key(key))
+        except redis.RedisError as e:
+            print("Error deleting %s from the cache: %s" % (key, e))
+
+    @contextlib.contextmanager
+    def key_lock(self, key):
+        """
+        A lock for resolving `key` once across all workers. It expires after
+        CACHE_LOCK_TIMEOUT in case its holder dies.
+        """
+        lock = self.client.lock(self.redis_key(key) + ":lock", timeout=CACHE_LOCK_TIMEOUT)
+        try:
+            lock.acquire()
+        except redis.RedisError as e:
+            print("Error locking %s in the cache: %s" % (key, e))
+            with key_lock((self.name, key)):
+                yield
+            return
+        try:
+            yield
+        finally:
+            with contextlib.suppress(redis.RedisError):
+                lock.release()
+
+    def stats(self):
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
+
+
+def make_cache(name, ttl):
+    """
+    Build the cache for one kind of lookup, in Redis if CACHE_URL is set.
+    """
+    if not CACHE_URL:
+        return MemoryCache(name, ttl)
+    if redis is None:
+        raise RuntimeError("CACHE_URL is set but the redis package is not installed")
+    return RedisCache(name, ttl, redis_client)
+
+
+redis_client = redis.Redis.from_url(CACHE_URL) if CACHE_URL and redis is not None else None
+folder_cache = make_cache("folders", FOLDER_CACHE_TTL)
+sketch_cache = make_cache("sketches", SKETCH_CACHE_TTL)
+
+
+# --------------------------------------------------------------------------------
+# Helper functions
+# --------------------------------------------------------------------------------        
+def create_folder(folder_name):
+    """
+    Create a new root folder with the given folder name.
+    """
+    backend = current_backend()
+    response = call_upstream(
+        backend.openrelik_upstream, "create_folder", backend.folders_api.create_root_folder,
+        folder_name, idempotent=False,
+    )
+    return response
+
+
+def create_subfolder(parent_id, folder_name):
+    """
+    Create a new subfolder with the given folder name.
+    """
+    backend = current_backend()
+    return call_upstream(
+        backend.openrelik_upstream, "create_subfolder", backend.folders_api.create_subfolder,
+        parent_id, folder_name, idempotent=False,
+    )
+
+
+def find_root_folder(folder_name):
+    """
+    Return the ID of the root folder with the given name, or None.
+    """
+    backend = current_backend()
+    folders = call_upstream(
+        backend.openrelik_upstream, "list_root_folders", backend.folders_api.list_root_folders,
+        FOLDER_LOOKUP_LIMIT,
+    )
+    for folder in folders:
+        if folder.get("display_name") == folder_name:
+            return folder["id"]
+    return None
+
+
+def find_subfolder(parent_id, folder_name):
+    """
+    Return the ID of the subfolder of `parent_id` with the given name, or None.
+    """
+    backend = current_backend()
+
+    def list_subfolders():
+        response = backend.api_client.get(f"/folders/{parent_id}/folders/")
+        response.raise_for_status()
+        return response.json()
+
+    for folder in call_upstream(backend.openrelik_upstream, "list_subfolders", list_subfolders):
+        if folder.get("display_name") == folder_name:
+            return folder["id"]
+    return None
+
+
+def resolve_case_folder(label, fqdn):
+    """
+    Return the host subfolder of a case folder, looking both up or creating them
+    on first use. IDs are cached so repeated uploads for a case skip the folder API.
+    """
+    backend = current_backend()
+
+    case_key = ("case-folder", backend.name, label)
+    case_folder_id = folder_cache.get(case_key)
+    if case_folder_id is None:
+        with folder_cache.key_lock(case_key):
+            case_folder_id = folder_cache.get(case_key)
+            if case_folder_id is None:
+                case_folder_id = find_root_folder(label) or create_folder(label)
+                folder_cache.set(case_key, case_folder_id)
+
+    host_key = ("host-folder", backend.name, label, fqdn)
+    host_folder_id = folder_cache.get(host_key)
+    if host_folder_id is None:
+        with folder_cache.key_lock(host_key):
+            host_folder_id = folder_cache.get(host_key)
+            if host_folder_id is None:
+                host_folder_id = (
+                    find_subfolder(case_folder_id, fqdn) or create_subfolder(case_folder_id, fqdn)
+                )
+                folder_cache.set(host_key, host_folder_id)
+
+    return host_folder_id
+
+
+def forget_case_folder(label, fqdn):
+    """
+    Drop the cached folder IDs of a case, e.g. after the folders were deleted in OpenRelik.
+    """
+    backend = current_backend()
+    folder_cache.delete(("case-folder", backend.name, label))
+    folder_cache.delete(("host-folder", backend.name, label, fqdn))
+
+
+def upload_to_folder(file_path, filename, folder_name):
+    """
+    Upload a file into a new root folder named `folder_name`, or with FOLDER_MODE=case
+    into the host subfolder of its case. Returns the folder ID and the file ID.
+    """
+    fqdn, label = extract_fqdn_and_label(filename)
+    if FOLDER_MODE != "case" or not (fqdn and label and label != "Null"):
+        folder_id = create_folder(folder_name)
+        return folder_id, upload_file(file_path, folder_id)
+
+    folder_id = resolve_case_folder(label, fqdn)
+    file_id = upload_file(file_path, folder_id)
+    if file_id is None:
+        # The cached folder no longer exists upstream, resolve it again.
+        forget_case_folder(label, fqdn)
+        folder_id = resolve_case_folder(label, fqdn)
+        file_id = upload_file(file_path, folder_id)
+    return folder_id, file_id
 
-    return workflows_api.update_workflow(folder_id, workflow_id, workflow_spec)
+
+def upload_file(file_path, folder_id):
+    """
+    Upload a file to the specified folder.
+    """
+    backend = current_backend()
+    response = call_upstream(
+        backend.openrelik_upstream, "upload_file", backend.api_client.upload_file,
+        file_path, folder_id, idempotent=False, cost=os.path.getsize(file_path) / 1024**2,
+    )
+    return response
+
+
+def create_workflow(folder_id, file_ids):
+    """
+    Create a new workflow in the specified folder with the given file IDs.
+    Returns the workflow ID and the workflow's folder ID.
+    """
+    backend = current_backend()
+    response = call_upstream(
+        backend.openrelik_upstream, "create_workflow", backend.workflows_api.create_workflow,
+        folder_id, file_ids, idempotent=False,
+    )
+    workflow_id = response
+    workflow = call_upstream(
+        backend.openrelik_upstream, "get_workflow", backend.workflows_api.get_workflow,
+        folder_id, workflow_id,
+    )
+    remember_workflow(workflow_id, folder_id)
+    return workflow_id, workflow["folder"]["id"]
+
+
+def rename_folder(folder_id, new_name):
+    """
+    Rename an existing folder.
+    """
+    backend = current_backend()
+    return call_upstream(
+        backend.openrelik_upstream, "rename_folder", backend.folders_api.update_folder,
+        folder_id, {"display_name": new_name},
+    )
+
+
+def rename_workflow(folder_id, workflow_id, new_name):
+    """
+    Rename an existing workflow.
+    """
+    backend = current_backend()
+    return call_upstream(
+        backend.openrelik_upstream, "rename_workflow", backend.workflows_api.update_workflow,
+        folder_id, workflow_id, {"display_name": new_name},
+    )
 
 
-def add_hayabusa_extract_tasks_to_workflow(folder_id, workflow_id):
+def update_workflow_spec(folder_id, workflow_id, workflow_spec):
+    """
+    Store the task spec of a workflow. For high-priority runs, its tasks are
+    routed to the high-priority worker queues first. With COMPACT_WORKFLOW_SPEC,
+    UI-only metadata is left out.
+    """
+    high_priority = current_priority() == "high"
+    if high_priority or COMPACT_WORKFLOW_SPEC:
+        spec = json.loads(workflow_spec["spec_json"])
+        if high_priority:
+            route_to_priority_queues(spec["workflow"]["tasks"])
+        if COMPACT_WORKFLOW_SPEC:
+            spec["workflow"]["tasks"] = compact_tasks(spec["workflow"]["tasks"])
+            workflow_spec = dict(workflow_spec, spec_json=json.dumps(spec, separators=(",", ":")))
+        else:
+            workflow_spec = dict(workflow_spec, spec_json=json.dumps(spec))
+
+    backend = current_backend()
+    return call_upstream(
+        backend.openrelik_upstream, "add_tasks", backend.workflows_api.update_workflow,
+        folder_id, workflow_id, workflow_spec,
+    )
+
+
+def route_to_priority_queues(tasks):
+    """
+    Point the queue of every task in a spec, nested tasks included, at its
+    high-priority counterpart.
+    """
+    for task in tasks:
+        queue_name = task.get("queue_name")
+        if queue_name and (not HIGH_PRIORITY_QUEUES or queue_name in HIGH_PRIORITY_QUEUES):
+            task["queue_name"] = queue_name + HIGH_PRIORITY_QUEUE_SUFFIX
+        route_to_priority_queues(task.get("tasks", []))
+
+
+# What the workers need from a task. Everything else in a task is for the OpenRelik UI.
+COMPACT_TASK_KEYS = ("task_name", "queue_name", "type", "uuid")
+
+
+def compact_tasks(tasks):
+    """
+    Return tasks, nested tasks included, with only the keys workers use and
+    only the config options that have a value, as name/value pairs.
+    """
+    compacted = []
+    for task in tasks:
+        compact = {key: task[key] for key in COMPACT_TASK_KEYS if key in task}
+        task_config = [
+            {"name": option["name"], "value": option["value"]}
+            for option in task.get("task_config", [])
+            if option.get("value") not in (None, "", [])
+        ]
+        if task_config:
+            compact["task_config"] = task_config
+        compact["tasks"] = compact_tasks(task.get("tasks", []))
+        compacted.append(compact)
+    return compacted
+
+
+# Config of the Plaso log2timeline task, with the UI metadata OpenRelik shows for it.
+# Shared by both Plaso specs, and left out entirely with COMPACT_WORKFLOW_SPEC.
+PLASO_TASK_CONFIG = [
+    {
+        "name": "artifacts",
+        "label": "Select artifacts to parse",
+        "description": (
+            "Select one or more forensic artifact definitions "
+            "from the ForensicArtifacts project. These definitions "
+            "specify files and data relevant to digital forensic "
+            "investigations. Only the selected artifacts will be "
+            "parsed."
+        ),
+        "type": "artifacts",
+        "required": False,
+    },
+    {
+        "name": "parsers",
+        "label": "Select parsers to use",
+        "description": (
+            "Select one or more Plaso parsers. These parsers specify "
+            "how to interpret files and data. Only data identified by "
+            "the selected parsers will be processed."
+        ),
+        "type": "autocomplete",
+        "items": [
+            "winreg/amcache",
+            "sqlite/dropbox",
+            "text/skydrive_log_v2",
+            "winreg/ccleaner",
+            "sqlite/twitter_android",
+            "plist/macos_login_window_plist",
+            "text/cri_log",
+            "text/powershell_transcript",
+            "winevt",
+            "olecf/olecf_automatic_destinations",
+            "text/viminfo",
+            "plist/ipod_device",
+            "czip/oxml",
+            "plist/airport",
+            "plist/time_machine",
+            "wincc_sys",
+            "text",
+            "text/xchatscrollback",
+            "utmpx",
+            "jsonl/aws_cloudtrail_log",
+            "plist/macos_install_history",
+            "pls_recall",
+            "plist/macos_bluetooth",
+            "sqlite/chrome_8_history",
+            "sqlite/hangouts_messages",
+            "winreg/bam",
+            "text/android_logcat",
+            "text/setupapi",
+            "winreg/mrulist_shell_item_list",
+            "winreg/windows_task_cache",
+            "winpca_dic",
+            "winreg/mrulistex_shell_item_list",
+            "winreg/mstsc_rdp",
+            "winreg/microsoft_outlook_mru",
+            "sqlite/android_calls",
+            "sqlite/windows_push_notification",
+            "winreg/windows_run",
+            "text/winfirewall",
+            "spotlight_storedb",
+            "sqlite/safari_historydb",
+            "text/gdrive_synclog",
+            "esedb",
+            "text/teamviewer_connections_incoming",
+            "text/mac_appfirewall_log",
+            "sqlite/ios_screentime",
+            "winevtx",
+            "sqlite/appusage",
+            "text/confluence_access",
+            "mft",
+            "winreg/windows_version",
+            "onedrive_log",
+            "text/popularity_contest",
+            "winreg/windows_services",
+            "windefender_history",
+            "winreg/windows_usbstor_devices",
+            "plist/ios_identityservices",
+            "usnjrnl",
+            "trendmicro_vd",
+            "prefetch",
+            "text/aws_elb_access",
+            "mac_keychain",
+            "sqlite/edge_load_statistics",
+            "filestat",
+            "jsonl/azure_activity_log",
+            "sqlite/android_webviewcache",
+            "sqlite/imessage",
+            "sqlite/chrome_17_cookies",
+            "plist/safari_history",
+            "msiecf",
+            "sqlite/ios_powerlog",
+            "sqlite/firefox_history",
+            "locate_database",
+            "text/snort_fastlog",
+            "esedb/msie_webcache",
+            "jsonl/docker_container_log",
+            "trendmicro_url",
+            "sqlite/mac_document_versions",
+            "text/ios_lockdownd",
+            "winreg/bagmru",
+            "chrome_preferences",
+            "sqlite/ls_quarantine",
+            "sqlite/ios_datausage",
+            "sqlite",
+            "simatic_s7",
+            "czip",
+            "plist/macos_login_items_plist",
+            "plist/plist_default",
+            "winreg/mrulist_string",
+            "sqlite/firefox_118_downloads",
+            "text/teamviewer_application_log",
+            "firefox_cache",
+            "sqlite/android_webview",
+            "winreg",
+            "winpca_db0",
+            "text/teamviewer_connections_outgoing",
+            "sqlite/twitter_ios",
+            "olecf",
+            "bsm_log",
+            "opera_global",
+            "text/googlelog",
+            "android_app_usage",
+            "mcafee_protection",
+            "winreg/microsoft_office_mru",
+            "sqlite/windows_eventtranscript",
+            "asl_log",
+            "fish_history",
+            "winreg/explorer_mountpoints2",
+            "sqlite/kodi",
+            "winreg/mrulistex_string",
+            "winreg/networks",
+            "text/winiis",
+            "sqlite/android_sms",
+            "cups_ipp",
+            "winreg/winrar_mru",
+            "lnk",
+            "bencode/bencode_utorrent",
+            "jsonl",
+            "plist/launchd_plist",
+            "winreg/windows_sam_users",
+            "plist/macuser",
+            "text/skydrive_log_v1",
+            "text/mac_wifi",
+            "plist/spotlight",
+            "symantec_scanlog",
+            "text/ios_sysdiag_log",
+            "winreg/msie_zone",
+            "winreg/userassist",
+            "jsonl/ios_application_privacy",
+            "sqlite/chrome_27_history",
+            "text/vsftpd",
+            "bencode/bencode_transmission",
+            "fseventsd",
+            "olecf/olecf_default",
+            "jsonl/microsoft_audit_log",
+            "unified_logging",
+            "java_idx",
+            "sqlite/chrome_extension_activity",
+            "sqlite/kik_ios",
+            "opera_typed_history",
+            "sqlite/windows_timeline",
+            "text/sccm",
+            "sqlite/tango_android_profile",
+            "sqlite/firefox_10_cookies",
+            "sqlite/macostcc",
+            "text/macos_launchd_log",
+            "chrome_cache",
+            "custom_destinations",
+            "winreg/network_drives",
+            "plist/ios_carplay",
+            "olecf/olecf_summary",
+            "sqlite/tango_android_tc",
+            "utmp",
+            "sqlite/chrome_autofill",
+            "sqlite/firefox_downloads",
+            "bodyfile",
+            "sqlite/android_app_usage",
+            "text/selinux",
+            "plist/macos_software_update",
+            "pe",
+            "plist/apple_id",
+            "text/syslog_traditional",
+            "winreg/windows_boot_execute",
+            "systemd_journal",
+            "firefox_cache2",
+            "text/apache_access",
+            "plist/macos_background_items_plist",
+            "jsonl/docker_layer_config",
+            "winreg/windows_boot_verify",
+            "text/ios_logd",
+            "networkminer_fileinfo",
+            "winreg/mrulistex_string_and_shell_item",
+            "esedb/file_history",
+            "sqlite/mac_notes",
+            "sqlite/chrome_66_cookies",
+            "text/sophos_av",
+            "esedb/srum",
+            "bencode",
+            "winreg/winreg_default",
+            "text/xchatlog",
+            "sqlite/zeitgeist",
+            "text/postgresql",
+            "sqlite/firefox_2_cookies",
+            "winreg/windows_usb_devices",
+            "winreg/windows_timezone",
+            "binary_cookies",
+            "winjob",
+            "recycle_bin_info2",
+            "plist/safari_downloads",
+            "sqlite/ios_netusage",
+            "text/apt_history",
+            "plist/spotlight_volume",
+            "sqlite/skype",
+            "sqlite/google_drive",
+            "winreg/windows_typed_urls",
+            "jsonl/docker_container_config",
+            "text/dpkg",
+            "text/zsh_extended_history",
+            "text/syslog",
+            "sqlite/mackeeper_cache",
+            "winreg/mstsc_rdp_mru",
+            "winreg/windows_shutdown",
+            "olecf/olecf_document_summary",
+            "winreg/appcompatcache",
+            "winreg/mrulistex_string_and_shell_item_list",
+            "text/santa",
+            "winreg/winlogon",
+            "text/bash_history",
+            "text/mac_securityd",
+            "recycle_bin",
+            "sqlite/android_turbo",
+            "jsonl/azure_application_gateway_access_log",
+            "rplog",
+            "winreg/explorer_programscache",
+            "esedb/user_access_logging",
+            "jsonl/gcp_log",
+            "sqlite/mac_knowledgec",
+            "plist/macos_startup_item_plist",
+            "plist",
+        ],
+        "required": False,
+    },
+    {
+        "name": "archives",
+        "label": "Archives",
+        "description": (
+            "Select one or more Plaso archive types. "
+            "Files inside these archive types will be processed."
+        ),
+        "type": "autocomplete",
+        "items": ["iso9660", "modi", "tar", "vhdi", "zip"],
+        "required": False,
+    },
+]
+
+
+def add_plaso_tasks_to_workflow(folder_id, workflow_id):
     """
     Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
     """
-    hayabusa_task_uuid = str(uuid.uuid4()).replace("-", "")
-    extraction_task_uuid = str(uuid.uuid4()).replace("-", "")
+    plaso_task_uuid = str(uuid.uuid4()).replace("-", "")
+    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
 
     workflow_spec = {
         "spec_json": json.dumps(
@@ -838,13 +1563,319 @@ def add_hayabusa_extract_tasks_to_workflow(folder_id, workflow_id):
                     "isRoot": True,
                     "tasks": [
                         {
-                            "task_name": "openrelik-worker-extraction.tasks.extract_archive",
-                            "queue_name": "openrelik-worker-extraction",
-                            "display_name": "Extract Archives",
-                            "description": "Extract different types of archives",
-                            "task_config": [
-                                {
-                                    "name": "file_filter",
+                            "task_name": "openrelik-worker-plaso.tasks.log2timeline",
+                            "queue_name": "openrelik-worker-plaso",
+                            "display_name": "Plaso: Log2Timeline",
+                            "description": "Super timelining",
+                            "task_config": PLASO_TASK_CONFIG,
+                            "type": "task",
+                            "uuid": f"{plaso_task_uuid}",
+                            "tasks": [],
+                        }
+                    ],
+                }
+            }
+        )
+    }
+
+    return update_workflow_spec(folder_id, workflow_id, workflow_spec)
+
+
+def add_plaso_ts_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name):
+    """
+    Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
+    """
+    plaso_task_uuid = str(uuid.uuid4()).replace("-", "")
+    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
+
+    task_config = [
+        {
+            "name": "sketch_name",
+            "label": "Create a new sketch",
+            "description": "Create a new sketch",
+            "type": "text",
+            "required": False,
+            "value": f"{sketch_name}",
+        },
+        {
+            "name": "timeline_name",
+            "label": "Name of the timeline to create",
+            "description": "Timeline name",
+            "type": "text",
+            "required": False,
+            "value": f"{timeline_name}"
+        }
+    ]
+    if sketch_id != "":
+        task_config = [
+            {
+                "name": "sketch_id",
+                "label": "Add to existing sketch",
+                "description": "Add to existing sketch",
+                "type": "text",
+                "required": False,
+                "value": f"{sketch_id}",
+            },
+            {
+                "name": "timeline_name",
+                "label": "Name of the timeline to create",
+                "description": "Timeline name",
+                "type": "text",
+                "required": False,
+                "value": f"{timeline_name}"
+            }
+        ]
+        
+    workflow_spec = {
+        "spec_json": json.dumps(
+            {
+                "workflow": {
+                    "type": "chain",
+                    "isRoot": True,
+                    "tasks": [
+                        {
+                            "task_name": "openrelik-worker-plaso.tasks.log2timeline",
+                            "queue_name": "openrelik-worker-plaso",
+                            "display_name": "Plaso: Log2Timeline",
+                            "description": "Super timelining",
+                            "task_config": PLASO_TASK_CONFIG,
+                            "type": "task",
+                            "uuid": f"{plaso_task_uuid}",
+                            "tasks": [
+                                {
+                                    "task_name": "openrelik-worker-timesketch.tasks.upload",
+                                    "queue_name": "openrelik-worker-timesketch",
+                                    "display_name": "Upload to Timesketch",
+                                    "description": "Upload resulting file to Timesketch",
+                                    "task_config": task_config,
+                                    "type": "task",
+                                    "uuid": f"{timesketch_task_uuid}",
+                                    "tasks": [],
+                                }
+                            ],
+                        }
+                    ],
+                }
+            }
+        )
+    }
+
+    return update_workflow_spec(folder_id, workflow_id, workflow_spec)
+
+
+# Built-in Hayabusa profiles, extended or overridden by HAYABUSA_PROFILES. "full" sets
+# nothing, so the worker runs every rule down to informational hits.
+BUILTIN_HAYABUSA_PROFILES = {
+    "critical-only": {"rule_set": "core", "min_level": "critical", "output_profile": "minimal"},
+    "standard": {"rule_set": "core+", "min_level": "medium", "output_profile": "standard"},
+    "full": {},
+}
+hayabusa_profiles = dict(BUILTIN_HAYABUSA_PROFILES, **HAYABUSA_PROFILES)
+
+
+def check_hayabusa_profiles():
+    """
+    Fail at startup if HAYABUSA_PROFILE or HAYABUSA_LABEL_PROFILES names a profile
+    that doesn't exist, instead of failing runs after their file was uploaded.
+    """
+    unknown = {HAYABUSA_PROFILE, *HAYABUSA_LABEL_PROFILES.values()} - set(hayabusa_profiles)
+    if unknown:
+        raise RuntimeError(
+            "Unknown Hayabusa profile(s) %s, known profiles are: %s"
+            % (", ".join(sorted(map(str, unknown))), ", ".join(sorted(hayabusa_profiles)))
+        )
+
+
+check_hayabusa_profiles()
+
+# Options of the Hayabusa task a profile can set, with the UI metadata OpenRelik shows for them.
+HAYABUSA_TASK_OPTIONS = {
+    "rule_set": ("Rule set", "Detection rules to run: core, core+, core++, all-alerts or all"),
+    "min_level": ("Minimum level", "Lowest alert level to report: informational, low, medium, high or critical"),
+    "output_profile": ("Output profile", "Hayabusa output profile deciding the columns of the timeline"),
+}
+
+
+def resolve_hayabusa_profile(label=None, requested=None):
+    """
+    Return the Hayabusa profile of a run: the requested one if valid, the first
+    HAYABUSA_LABEL_PROFILES glob matching the label, or HAYABUSA_PROFILE.
+    """
+    if requested in hayabusa_profiles:
+        return requested
+    if label:
+        for pattern, profile in HAYABUSA_LABEL_PROFILES.items():
+            if fnmatch.fnmatchcase(label, pattern):
+                return profile
+    return HAYABUSA_PROFILE
+
+
+def hayabusa_task_config(timesketch=False):
+    """
+    Return the Hayabusa task config for the current run's profile. Runs pushing to
+    Timesketch get the timesketch- variant of the profile's output profile.
+    """
+    profile = g.get("hayabusa_profile", HAYABUSA_PROFILE) if has_app_context() else HAYABUSA_PROFILE
+    settings = hayabusa_profiles[profile]
+    task_config = []
+    for name, (label, description) in HAYABUSA_TASK_OPTIONS.items():
+        value = settings.get(name)
+        if value is None:
+            continue
+        if name == "output_profile" and timesketch and not value.startswith("timesketch-"):
+            value = "timesketch-verbose" if "verbose" in value else "timesketch-minimal"
+        task_config.append(
+            {
+                "name": name,
+                "label": label,
+                "description": description,
+                "type": "text",
+                "required": False,
+                "value": value,
+            }
+        )
+    return task_config
+
+
+def add_hayabusa_tasks_to_workflow(folder_id, workflow_id, timesketch_output=False):
+    """
+    Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
+    With `timesketch_output`, Hayabusa writes a timeline Timesketch can import.
+    """
+    hayabusa_task_uuid = str(uuid.uuid4()).replace("-", "")
+    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
+
+    workflow_spec = {
+        "spec_json": json.dumps(
+            {
+                "workflow": {
+                    "type": "chain",
+                    "isRoot": True,
+                    "tasks": [
+                        {
+                            "task_name": "openrelik-worker-hayabusa.tasks.csv_timeline",
+                            "queue_name": "openrelik-worker-hayabusa",
+                            "display_name": "Hayabusa CSV timeline",
+                            "description": "Windows event log triage",
+                            "task_config": hayabusa_task_config(timesketch=timesketch_output),
+                            "type": "task",
+                            "uuid": f"{hayabusa_task_uuid}",
+                            "tasks": [],
+                        }
+                    ],
+                }
+            }
+        )
+    }
+
+    return update_workflow_spec(folder_id, workflow_id, workflow_spec)
+
+
+def add_hayabusa_ts_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name):
+    """
+    Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
+    """
+    hayabusa_task_uuid = str(uuid.uuid4()).replace("-", "")
+    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
+
+    task_config = [
+        {
+            "name": "sketch_name",
+            "label": "Create a new sketch",
+            "description": "Create a new sketch",
+            "type": "text",
+            "required": False,
+            "value": f"{sketch_name}",
+        },
+        {
+            "name": "timeline_name",
+            "label": "Name of the timeline to create",
+            "description": "Timeline name",
+            "type": "text",
+            "required": False,
+            "value": f"{timeline_name}"
+        }
+    ]
+    if sketch_id != "":
+        task_config = [
+            {
+                "name": "sketch_id",
+                "label": "Add to existing sketch",
+                "description": "Add to existing sketch",
+                "type": "text",
+                "required": False,
+                "value": f"{sketch_id}",
+            },
+            {
+                "name": "timeline_name",
+                "label": "Name of the timeline to create",
+                "description": "Timeline name",
+                "type": "text",
+                "required": False,
+                "value": f"{timeline_name}"
+            }
+        ]
+
+    workflow_spec = {
+        "spec_json": json.dumps(
+            {
+                "workflow": {
+                    "type": "chain",
+                    "isRoot": True,
+                    "tasks": [
+                        {
+                            "task_name": "openrelik-worker-hayabusa.tasks.csv_timeline",
+                            "queue_name": "openrelik-worker-hayabusa",
+                            "display_name": "Hayabusa CSV timeline",
+                            "description": "Windows event log triage",
+                            "task_config": hayabusa_task_config(timesketch=True),
+                            "type": "task",
+                            "uuid": f"{hayabusa_task_uuid}",
+                            "tasks": [
+                                {
+                                    "task_name": "openrelik-worker-timesketch.tasks.upload",
+                                    "queue_name": "openrelik-worker-timesketch",
+                                    "display_name": "Upload to Timesketch",
+                                    "description": "Upload resulting file to Timesketch",
+                                    "task_config": task_config,
+                                    "type": "task",
+                                    "uuid": f"{timesketch_task_uuid}",
+                                    "tasks": [],
+                                }
+                            ],
+                        }
+                    ],
+                }
+            }
+        )
+    }
+
+    return update_workflow_spec(folder_id, workflow_id, workflow_spec)
+
+
+def add_hayabusa_extract_tasks_to_workflow(folder_id, workflow_id, timesketch_output=False):
+    """
+    Add tasks to an existing workflow, including a Plaso task and a Timesketch task.
+    With `timesketch_output`, Hayabusa writes a timeline Timesketch can import.
+    """
+    hayabusa_task_uuid = str(uuid.uuid4()).replace("-", "")
+    extraction_task_uuid = str(uuid.uuid4()).replace("-", "")
+
+    workflow_spec = {
+        "spec_json": json.dumps(
+            {
+                "workflow": {
+                    "type": "chain",
+                    "isRoot": True,
+                    "tasks": [
+                        {
+                            "task_name": "openrelik-worker-extraction.tasks.extract_archive",
+                            "queue_name": "openrelik-worker-extraction",
+                            "display_name": "Extract Archives",
+                            "description": "Extract different types of archives",
+                            "task_config": [
+                                {
+                                    "name": "file_filter",
                                     "label": "Select files (glob patterns) to extract",
                                     "description": "A comma separated list of filenames to extract. Glob patterns are supported. Example: *.txt, *.evtx",
                                     "type": "text",
@@ -860,6 +1891,7 @@ def add_hayabusa_extract_tasks_to_workflow(folder_id, workflow_id):
                                     "queue_name": "openrelik-worker-hayabusa",
                                     "display_name": "Hayabusa CSV timeline",
                                     "description": "Windows event log triage",
+                                    "task_config": hayabusa_task_config(timesketch=timesketch_output),
                                     "type": "task",
                                     "uuid": f"{hayabusa_task_uuid}",
                                     "tasks": [],
@@ -872,7 +1904,7 @@ def add_hayabusa_extract_tasks_to_workflow(folder_id, workflow_id):
         )
     }
 
-    return workflows_api.update_workflow(folder_id, workflow_id, workflow_spec)
+    return update_workflow_spec(folder_id, workflow_id, workflow_spec)
 
 
 def add_hayabusa_extract_ts_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name):
@@ -935,6 +1967,7 @@ def add_hayabusa_extract_ts_tasks_to_workflow(folder_id, workflow_id, sketch_nam
                                     "queue_name": "openrelik-worker-hayabusa",
                                     "display_name": "Hayabusa CSV timeline",
                                     "description": "Windows event log triage",
+                                    "task_config": hayabusa_task_config(timesketch=True),
                                     "type": "task",
                                     "uuid": f"{hayabusa_task_uuid}",
                                     "tasks": [
@@ -958,190 +1991,2504 @@ def add_hayabusa_extract_ts_tasks_to_workflow(folder_id, workflow_id, sketch_nam
         )
     }
 
-    return workflows_api.update_workflow(folder_id, workflow_id, workflow_spec)
+    return update_workflow_spec(folder_id, workflow_id, workflow_spec)
+
+
+def add_timesketch_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name):
+    """
+    Add a Timesketch task to an existing workflow, uploading its files as they are.
+    """
+    timesketch_task_uuid = str(uuid.uuid4()).replace("-", "")
+
+    task_config = [
+        {
+            "name": "sketch_name",
+            "label": "Create a new sketch",
+            "description": "Create a new sketch",
+            "type": "text",
+            "required": False,
+            "value": f"{sketch_name}",
+        },
+        {
+            "name": "timeline_name",
+            "label": "Name of the timeline to create",
+            "description": "Timeline name",
+            "type": "text",
+            "required": False,
+            "value": f"{timeline_name}"
+        }
+    ]
+    if sketch_id != "":
+        task_config[0] = {
+            "name": "sketch_id",
+            "label": "Add to existing sketch",
+            "description": "Add to existing sketch",
+            "type": "text",
+            "required": False,
+            "value": f"{sketch_id}",
+        }
+
+    workflow_spec = {
+        "spec_json": json.dumps(
+            {
+                "workflow": {
+                    "type": "chain",
+                    "isRoot": True,
+                    "tasks": [
+                        {
+                            "task_name": "openrelik-worker-timesketch.tasks.upload",
+                            "queue_name": "openrelik-worker-timesketch",
+                            "display_name": "Upload to Timesketch",
+                            "description": "Upload resulting file to Timesketch",
+                            "task_config": task_config,
+                            "type": "task",
+                            "uuid": f"{timesketch_task_uuid}",
+                            "tasks": [],
+                        }
+                    ],
+                }
+            }
+        )
+    }
+
+    return update_workflow_spec(folder_id, workflow_id, workflow_spec)
+
+
+def run_workflow(folder_id, workflow_id):
+    """
+    Trigger the workflow execution.
+    """
+    backend = current_backend()
+    return call_upstream(
+        backend.openrelik_upstream, "run_workflow", backend.workflows_api.run_workflow,
+        folder_id, workflow_id, idempotent=False,
+    )
+
+
+def workflow_output_files(workflow):
+    """
+    Return the output files of a workflow's tasks.
+    """
+    files = []
+    for task in workflow.get("tasks") or []:
+        for output in task.get("output_files") or []:
+            files.append(
+                {
+                    "id": output["id"],
+                    "filename": output.get("display_name"),
+                    "size": output.get("filesize"),
+                    "task": task.get("display_name"),
+                    "status": task.get("status_short"),
+                }
+            )
+    return files
+
+
+def request_output_file(backend, file_id):
+    """
+    Start a streaming download of a file from OpenRelik. The caller closes the response.
+    """
+    response = backend.api_client.get(f"/files/{int(file_id)}/download_stream", stream=True)
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        response.close()
+        raise
+    return response
+
+
+def download_output_file(backend, file_id, directory):
+    """
+    Stream a file from OpenRelik into a new temp file in `directory` and return its path.
+    """
+
+    def download():
+        response = request_output_file(backend, file_id)
+        with tempfile.NamedTemporaryFile("wb", dir=directory, prefix=".tmp-", delete=False) as fh:
+            try:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    fh.write(chunk)
+            except BaseException:
+                os.remove(fh.name)
+                raise
+            finally:
+                response.close()
+        return fh.name
+
+    return call_upstream(backend.openrelik_upstream, "download_file", download)
+
+
+def lookup_sketch_id(sketch_name):
+    """
+    Return the ID of the Timesketch sketch with the given name, or "" if there is none
+    or Timesketch can't be reached.
+    """
+    backend = current_backend()
+    key = ("sketch-id", backend.name, sketch_name)
+    sketch_id = sketch_cache.get(key)
+    if sketch_id is not None:
+        return sketch_id
+
+    sketch_id = ""
+    try:
+        sketches = call_upstream(
+            backend.timesketch_upstream, "list_sketches",
+            lambda: list(backend.ts_client.list_sketches()),
+        )
+        for sketch in sketches:
+            if sketch.name == sketch_name:
+                sketch_id = sketch.id
+    except Exception as e:
+        print("Error communicating with timesketch API: %s" % (e))
+    if sketch_id != "":
+        # Only found sketches are cached, a missing one may be created any moment
+        sketch_cache.set(key, sketch_id)
+    return sketch_id
+
+
+def create_sketch(sketch_name):
+    """
+    Create a new Timesketch sketch and return its ID.
+    """
+    backend = current_backend()
+    sketch = call_upstream(
+        backend.timesketch_upstream, "create_sketch", backend.ts_client.create_sketch,
+        sketch_name, idempotent=False,
+    )
+    sketch_cache.set(("sketch-id", backend.name, sketch_name), sketch.id)
+    return sketch.id
+
+
+def ensure_sketch(sketch_name):
+    """
+    Return the ID of the named sketch, creating it if there is none yet. Callers
+    that would otherwise each create the same sketch take turns.
+    """
+    with sketch_cache.key_lock(("ensure-sketch", current_backend().name, sketch_name)):
+        return lookup_sketch_id(sketch_name) or create_sketch(sketch_name)
+
+
+def get_sketch_stats(sketch_id):
+    """
+    Return the number of timelines and events in a sketch.
+    """
+    backend = current_backend()
+    data = call_upstream(
+        backend.timesketch_upstream, "get_sketch",
+        lambda: backend.ts_client.get_sketch(sketch_id).lazyload_data(),
+    )
+    objects = data.get("objects") or [{}]
+    stats_per_timeline = data.get("meta", {}).get("stats_per_timeline") or {}
+    events = sum(
+        stats.get("count", 0) for stats in stats_per_timeline.values() if isinstance(stats, dict)
+    )
+    return len(objects[0].get("timelines", [])), events
+
+
+def sketch_series_name(label, number):
+    """
+    Name of the `number`th sketch of a label: the label itself, then <label>/2, <label>/3, ...
+    Labels come from filenames, which can't hold a slash, so the sketches of one
+    label's series are never mistaken for another label's, like "hunt-2024" for "hunt".
+    """
+    return label if number == 1 else f"{label}/{number}"
+
+
+def find_latest_sketch(label):
+    """
+    Return the number and ID of the newest existing sketch of a label's series,
+    or (0, "") if there is none.
+    """
+    backend = current_backend()
+    sketches = call_upstream(
+        backend.timesketch_upstream, "list_sketches",
+        lambda: list(backend.ts_client.list_sketches()),
+    )
+    pattern = re.compile(r"^%s(?:/([2-9]|[1-9]\d+))?$" % re.escape(label))
+    latest = (0, "")
+    for sketch in sketches:
+        match = pattern.match(sketch.name)
+        if not match:
+            continue
+        number = int(match.group(1) or 1)
+        if number > latest[0]:
+            latest = (number, sketch.id)
+    return latest
+
+
+def is_sketch_full(timelines, events):
+    return bool(
+        (SKETCH_MAX_TIMELINES and timelines >= SKETCH_MAX_TIMELINES)
+        or (SKETCH_MAX_EVENTS and events >= SKETCH_MAX_EVENTS)
+    )
+
+
+def resolve_active_sketch(label):
+    """
+    Return the name and ID of the sketch that takes the next timeline of a label,
+    rolling over to the next sketch of the series once the current one is full.
+
+    The active sketch and its size are cached for SKETCH_CACHE_TTL. Every call
+    counts one more timeline against the cached size. The real size, including
+    the event count, is fetched again when the entry expires.
+    """
+    backend = current_backend()
+    key = ("active-sketch", backend.name, label)
+    with sketch_cache.key_lock(key):
+        active = sketch_cache.get(key)
+        if active is None:
+            number, sketch_id = find_latest_sketch(label)
+            if number:
+                timelines, events = get_sketch_stats(sketch_id)
+            else:
+                number, sketch_id, timelines, events = 1, create_sketch(label), 0, 0
+            active = {"number": number, "id": sketch_id, "timelines": timelines, "events": events}
+            sketch_cache.set(key, active)
+
+        if is_sketch_full(active["timelines"], active["events"]):
+            number = active["number"] + 1
+            sketch_id = create_sketch(sketch_series_name(label, number))
+            log_event(
+                "sketch_rollover", label=label, sketch=sketch_series_name(label, number),
+                sketch_id=sketch_id, previous_timelines=active["timelines"],
+                previous_events=active["events"],
+            )
+            active = {"number": number, "id": sketch_id, "timelines": 0, "events": 0}
+            sketch_cache.set(key, active)
+
+        active["timelines"] += 1
+        sketch_cache.update(key, active)
+        return sketch_series_name(label, active["number"]), active["id"]
+
+
+def extract_fqdn_and_label(filename):
+    # Check if the filename starts with "vr_kapefiles"
+    if filename.startswith("vr_kapefiles"):
+        # vr_kapefiles_<fqdn>_<label>.zip
+        pattern = r"^vr_kapefiles_([^_]+)_(.+)\.zip$"
+        match = re.match(pattern, filename)
+        if match:
+            fqdn = match.group(1)
+            label = match.group(2)
+            return fqdn, label
+    
+    return None, None
+
+
+# --------------------------------------------------------------------------------
+# Fair-share rate limiting
+# --------------------------------------------------------------------------------
+class RateLimited(Exception):
+    """
+    Raised when a label or client has used up its share for now.
+    """
+
+    def __init__(self, key, retry_after):
+        super().__init__(f"{key} is rate limited, retry in {retry_after:.1f}s")
+        self.key = key
+        self.retry_after = retry_after
+
+
+def fair_share_weight(kind, key):
+    """
+    Return the weight of a label or client: the first FAIR_SHARE_WEIGHTS pattern
+    matching "<kind>:<key>", or 1.
+    """
+    for pattern, weight in FAIR_SHARE_WEIGHTS.items():
+        if fnmatch.fnmatchcase(f"{kind}:{key}", pattern):
+            return float(weight)
+    return 1.0
+
+
+class TokenBucket:
+    """
+    Allow `rate` events per second on average and bursts of up to `burst` events.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """
+        Take a token. Returns 0 if one was available, otherwise the seconds until there is one.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    One token bucket per label or per client, scaled by its fair-share weight,
+    with counters of admitted and throttled uploads per key.
+    """
+
+    def __init__(self, kind, per_minute, burst):
+        self.kind = kind
+        self.per_minute = per_minute
+        self.burst = burst
+        self.buckets = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def take(self, key):
+        """
+        Count one upload for `key`, raising RateLimited if its bucket is empty.
+        """
+        if not self.per_minute or not key:
+            return
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                weight = fair_share_weight(self.kind, key)
+                bucket = TokenBucket(self.per_minute * weight / 60, max(1.0, self.burst * weight))
+                self.buckets[key] = bucket
+            wait = bucket.take()
+            counters = self.counters.setdefault(key, {"admitted": 0, "throttled": 0})
+            if wait:
+                counters["throttled"] += 1
+                counters["last_throttled"] = time.time()
+            else:
+                counters["admitted"] += 1
+        if wait:
+            log_event("rate_limited", kind=self.kind, key=key, retry_after=round(wait, 3))
+            raise RateLimited(f"{self.kind} {key}", wait)
+
+    def snapshot(self):
+        """
+        Return the counters and the tokens left per key.
+        """
+        with self.lock:
+            return {
+                key: dict(counters, tokens=round(self.buckets[key].tokens, 2))
+                for key, counters in self.counters.items()
+            }
+
+
+label_limiter = RateLimiter("label", LABEL_RATE_LIMIT, LABEL_BURST)
+client_limiter = RateLimiter("client", CLIENT_RATE_LIMIT, CLIENT_BURST)
+
+
+def rate_limit_label(filename):
+    """
+    Count an upload against the rate limit of its label, raising RateLimited if the label is over it.
+    """
+    fqdn, label = extract_fqdn_and_label(filename)
+    if label and label != "Null":
+        label_limiter.take(label)
+
+
+# --------------------------------------------------------------------------------
+# Error handlers
+# --------------------------------------------------------------------------------
+@app.errorhandler(400)
+def bad_request(error):
+    """
+    Return a 400 error for a Bad Request.
+    """
+    return "Bad Request!", 400
+
+
+@app.errorhandler(401)
+def unauthorized(error):
+    """
+    Return a 401 error for an Unauthorized request.
+    """
+    return "Unauthorized!", 401
+
+
+@app.errorhandler(403)
+def forbidden(error):
+    """
+    Return a 403 error for a Forbidden request.
+    """
+    return "Forbidden!", 403
+
+
+@app.errorhandler(404)
+def page_not_found(error):
+    """
+    Return a 404 error for a Page Not Found.
+    """
+    return "Page Not Found!", 404
+
+
+@app.errorhandler(405)
+def method_not_allowed(error):
+    """
+    Return a 405 error for Method Not Allowed.
+    """
+    return "Method Not Allowed!", 405
+
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    """
+    Return a 413 error if the file or payload exceeds the maximum allowed size.
+    """
+    return "File is too large!", 413
+
+
+@app.errorhandler(500)
+def internal_server_error(error):
+    """
+    Return a 500 error for Internal Server Error.
+    """
+    return "Internal Server Error!", 500
+
+
+@app.errorhandler(503)
+def service_unavailable(error):
+    """
+    Return a 503 error for Service Unavailable.
+    """
+    return "Service Unavailable!", 503
+
+
+def retry_later(message, retry_after, status=503):
+    """
+    Build a response asking the client to come back later. The delay is sent both
+    as a Retry-After header and in the body, for clients that can't read headers.
+    """
+    response = jsonify({"error": message, "retry_after": retry_after})
+    response.status_code = status
+    response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+@app.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(error):
+    """
+    Return a 503 error with a Retry-After hint while an upstream is down.
+    """
+    return retry_later(f"{error.upstream} is unavailable", error.retry_after)
+
+
+@app.errorhandler(RateLimited)
+def rate_limited(error):
+    """
+    Return a 429 error with a Retry-After hint while a label or client is over its share.
+    """
+    return retry_later(
+        f"Rate limit exceeded for {error.key}", math.ceil(error.retry_after), status=429
+    )
+
+
+# --------------------------------------------------------------------------------
+# Incremental re-triage
+# --------------------------------------------------------------------------------
+def manifest_path(pipeline_name, label, fqdn):
+    """
+    Return where the member manifest of a host is kept for a pipeline. The key is
+    hashed so labels and hostnames never end up as path components.
+    """
+    key = json.dumps([current_backend().name, pipeline_name, label, fqdn])
+    return os.path.join(MANIFEST_DIR, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+
+def load_manifest(path):
+    """
+    Return the members recorded for a host, or an empty dict if it wasn't seen before.
+    """
+    try:
+        with open(path) as fh:
+            return json.load(fh)["members"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return {}
+
+
+def save_manifest(path, members):
+    """
+    Atomically replace the member manifest of a host.
+    """
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=MANIFEST_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as fh:
+        json.dump({"updated": time.time(), "members": members}, fh)
+    os.replace(tmp_path, path)
+
+
+def build_delta_zip(file_path, previous):
+    """
+    Repack the members of a zip that are new or changed since `previous`.
+
+    Members are compared by the size and CRC-32 stored in the central directory,
+    so unchanged members are never decompressed. Changed members are streamed
+    into the delta zip, which gets the same basename as `file_path` in a new
+    temp directory.
+
+    Returns the path to process (None if nothing changed, `file_path` itself if
+    everything changed) and the manifest describing every member of `file_path`.
+    """
+    members = {}
+    changed = []
+    with zipfile.ZipFile(file_path) as source:
+        infos = [info for info in source.infolist() if not info.is_dir()]
+        for info in infos:
+            known = previous.get(info.filename)
+            if known and known["size"] == info.file_size and known["crc"] == info.CRC:
+                members[info.filename] = known
+            else:
+                members[info.filename] = {"size": info.file_size, "crc": info.CRC}
+                changed.append(info)
+
+        if not changed:
+            return None, members
+        if len(changed) == len(infos):
+            return file_path, members
+
+        delta_path = os.path.join(
+            tempfile.mkdtemp(prefix="openrelik-pipeline-delta-"), os.path.basename(file_path)
+        )
+        with zipfile.ZipFile(delta_path, "w") as delta:
+            for info in changed:
+                copy_zip_member(source, info, delta)
+    return delta_path, members
+
+
+def copy_zip_member(source, info, destination, name=None):
+    """
+    Stream one member of `source` into the zip `destination`, under `name` if
+    given, keeping its timestamp, attributes and compression method.
+    """
+    target = zipfile.ZipInfo(name or info.filename, info.date_time)
+    target.compress_type = info.compress_type
+    target.external_attr = info.external_attr
+    with source.open(info) as src, destination.open(target, "w", force_zip64=True) as dst:
+        while chunk := src.read(1024 * 1024):
+            dst.write(chunk)
+
+
+@contextlib.contextmanager
+def manifest_lock(path):
+    """
+    Hold the manifest of a host for the whole run, against other threads and
+    other worker processes. The manifest itself is replaced on save, so the
+    lock is taken on a file next to it.
+    """
+    with key_lock(path):
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        with open(path + ".lock", "a") as fh:
+            flock_polling(fh)
+            yield
+
+
+def run_incremental_pipeline(pipeline_name, file_path, filename, label, fqdn):
+    """
+    Run only the members of a collection that changed since the host was last
+    processed by this pipeline. The manifest is only updated once the pipeline
+    succeeded, so a failed run is retried in full by the next collection.
+    Returns the workflow ID and the run details, or (None, None) if nothing changed.
+    """
+    path = manifest_path(pipeline_name, label, fqdn)
+    with manifest_lock(path):
+        with span("build_delta", filename=filename):
+            delta_path, members = build_delta_zip(file_path, load_manifest(path))
+        if delta_path is None:
+            log_event("incremental_skip", pipeline=pipeline_name, filename=filename)
+            return None, None
+
+        try:
+            result = PIPELINES[pipeline_name](delta_path, filename)
+        finally:
+            if delta_path != file_path:
+                shutil.rmtree(os.path.dirname(delta_path), ignore_errors=True)
+        save_manifest(path, members)
+        return result
+
+
+# --------------------------------------------------------------------------------
+# Multi-host archives
+# --------------------------------------------------------------------------------
+# Directories (or files) found at the root of a single host's collection: a drive
+# as written by KAPE (C) or Velociraptor (C%3A), or Velociraptor's own layout
+COLLECTION_ROOT_PATTERN = re.compile(
+    r"^(?:[A-Za-z](?:%3A|:)?|uploads|results|collection_context\.json)$", re.IGNORECASE
+)
+
+
+def find_host_roots(infos):
+    """
+    Return the top-level directories of a zip that each hold a host's collection,
+    recognized by a collection root one level down (HOST/C/..., HOST/uploads/...).
+    """
+    roots = set()
+    for info in infos:
+        parts = info.filename.split("/")
+        if (
+            len(parts) > 2
+            and not COLLECTION_ROOT_PATTERN.match(parts[0])
+            and COLLECTION_ROOT_PATTERN.match(parts[1])
+        ):
+            roots.add(parts[0])
+    return roots
+
+
+def split_multi_host_zip(file_path, label):
+    """
+    Split a zip holding several hosts' collections into one zip per host, named
+    `vr_kapefiles_<host>_<label>.zip` with the host's directory as its root.
+
+    The central directory is read first to find the hosts, then every member is
+    streamed once into its host's zip. Members outside a host directory are left out.
+    Returns the temp directory holding the per-host zips and their filenames, or
+    (None, []) if the zip holds fewer than SPLIT_MIN_HOSTS hosts.
+    """
+    with zipfile.ZipFile(file_path) as source:
+        infos = [info for info in source.infolist() if not info.is_dir()]
+        roots = find_host_roots(infos)
+        if len(roots) < SPLIT_MIN_HOSTS:
+            return None, []
+
+        split_dir = tempfile.mkdtemp(prefix="openrelik-pipeline-split-")
+        archives = {}
+        try:
+            for root in sorted(roots):
+                # The host ends up in the filename's <fqdn> part, which can't hold an underscore
+                host = re.sub(r"[^A-Za-z0-9.-]", "-", root)
+                name = f"vr_kapefiles_{host}_{label}.zip"
+                number = 1
+                while any(existing == name for existing, _ in archives.values()):
+                    number += 1
+                    name = f"vr_kapefiles_{host}-{number}_{label}.zip"
+                archives[root] = (name, zipfile.ZipFile(os.path.join(split_dir, name), "w"))
+
+            skipped = 0
+            for info in infos:
+                root, _, member = info.filename.partition("/")
+                if root not in archives:
+                    skipped += 1
+                    continue
+                copy_zip_member(source, info, archives[root][1], name=member)
+        except BaseException:
+            shutil.rmtree(split_dir, ignore_errors=True)
+            raise
+        finally:
+            for _, archive in archives.values():
+                archive.close()
+
+    log_event("split_archive", hosts=len(archives), skipped_members=skipped)
+    return split_dir, [name for name, _ in archives.values()]
+
+
+def run_split_pipeline(pipeline_name, file_path, filename):
+    """
+    Run every host of a multi-host zip through the pipeline as its own workflow,
+    up to SPLIT_WORKERS at once. All hosts go into the sketch of the zip's label
+    (or of the zip's name, without a label), each as its own timeline.
+
+    Journaled jobs record every host that completed, so a resumed job only runs
+    the others. Returns lists of workflow IDs and run details, or None if the zip
+    doesn't hold several hosts.
+    """
+    _, label = extract_fqdn_and_label(filename)
+    if not label or label == "Null":
+        label = os.path.splitext(filename)[0]
+    with span("split_archive", filename=filename):
+        split_dir, host_filenames = split_multi_host_zip(file_path, label)
+    if split_dir is None:
+        return None
+
+    try:
+        if pipeline_name.endswith("-timesketch") and not (SKETCH_MAX_TIMELINES or SKETCH_MAX_EVENTS):
+            # Create the shared sketch up front, concurrent workflows would each create their own
+            if not lookup_sketch_id(label):
+                checkpoint("create_sketch", create_sketch, label)
+
+        job = g.get("job")
+        results = {}
+        pending = []
+        for host_filename in host_filenames:
+            stage = f"host:{host_filename}"
+            if job is not None and stage in job.state["stages"]:
+                results[host_filename] = job.state["stages"][stage]
+            else:
+                pending.append(host_filename)
+
+        backend = current_backend()
+        context = {
+            "request_id": current_request_id(),
+            "priority": g.get("priority"),
+            "requested_priority": g.get("requested_priority"),
+            "hayabusa_profile": g.get("hayabusa_profile"),
+        }
+
+        def run_host(host_filename):
+            # Hosts run on their own threads, each holding a backend slot like an
+            # upload of its own. They aren't journaled stage by stage, only once done.
+            with app.app_context(), use_backend(backend):
+                for key, value in context.items():
+                    setattr(g, key, value)
+                with span("split_host", filename=host_filename):
+                    return dispatch_pipeline(
+                        pipeline_name, os.path.join(split_dir, host_filename), host_filename
+                    )
+
+        errors = []
+        # The archive's own slot is given back meanwhile, so archives fanning out
+        # can't hold every slot while their hosts wait for one
+        with backend_slot_released(backend), ThreadPoolExecutor(max_workers=max(SPLIT_WORKERS, 1)) as executor:
+            futures = {executor.submit(run_host, host_filename): host_filename for host_filename in pending}
+            for future in as_completed(futures):
+                host_filename = futures[future]
+                try:
+                    results[host_filename] = list(future.result())
+                except Exception as e:
+                    print("Error processing %s of %s: %s" % (host_filename, filename, e))
+                    errors.append(e)
+                    continue
+                if job is not None:
+                    job.record(f"host:{host_filename}", results[host_filename])
+        if errors:
+            raise errors[0]
+    finally:
+        shutil.rmtree(split_dir, ignore_errors=True)
+
+    completed = [results[name] for name in host_filenames if results[name][0] is not None]
+    if not completed:
+        return None, None
+    return [workflow_id for workflow_id, _ in completed], [run for _, run in completed]
+
+
+# --------------------------------------------------------------------------------
+# Event deduplication
+# --------------------------------------------------------------------------------
+# Columns identifying an event in a Hayabusa timeline. The rule title is part of the
+# key, so different detections of the same event are all kept.
+DEDUP_KEY_COLUMNS = ("Computer", "Channel", "RecordID", "RuleTitle")
+FINISHED_TASK_STATES = {"SUCCESS", "FAILURE", "REVOKED"}
+
+# Hayabusa details columns can be much longer than the csv module allows by default
+csv.field_size_limit(2**31 - 1)
+
+
+def event_key(row):
+    """
+    Return the identity of a timeline row, or None for rows without host, channel
+    and record ID, which are never deduplicated.
+    """
+    values = [row.get(column) or "" for column in DEDUP_KEY_COLUMNS]
+    if not all(values[:3]):
+        return None
+    return "\x1f".join(values)
+
+
+def read_digests(data):
+    """
+    Split the contents of a seen-events file into its 8-byte digests.
+    """
+    return {data[i:i + 8] for i in range(0, len(data) - len(data) % 8, 8)}
+
+
+class SeenEvents:
+    """
+    The events already sent to a sketch, kept as 8-byte BLAKE2b digests in an
+    append-only file per backend and sketch. The sketch ID is part of the key, so
+    a sketch that rolled over, or was deleted and created again, starts empty.
+
+    The events of an upload that is still running are staged in a file of their
+    own, next to it. They count as seen, but are only appended once the upload
+    succeeded. The file is locked while a run checks and extends it, so runs
+    into the same sketch take turns.
+    """
+
+    def __init__(self, backend_name, sketch_name, sketch_id):
+        key = json.dumps([backend_name, sketch_name, str(sketch_id)])
+        self.base = os.path.join(DEDUP_DIR, "seen", hashlib.sha256(key.encode()).hexdigest())
+        self.path = self.base + ".bin"
+        self.fh = None
+        self.seen = set()
+        self.new = []
+
+    def acquire(self):
+        """
+        Lock and load the sketch's events. Returns False, without waiting, if
+        another run holds them.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fh = open(self.path, "a+b")
+        try:
+            fcntl.flock(self.fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.fh.close()
+            return False
+        self.fh.seek(0)
+        self.seen = read_digests(self.fh.read())
+        for staged_path in glob.glob(glob.escape(self.base) + ".*.pending"):
+            with contextlib.suppress(FileNotFoundError), open(staged_path, "rb") as fh:
+                self.seen |= read_digests(fh.read())
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.fh.close()
+
+    def staged_path(self, workflow_id):
+        return f"{self.base}.{int(workflow_id)}.pending"
+
+    def add(self, key):
+        """
+        Record an event. Returns False if the sketch already has it.
+        """
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        if digest in self.seen:
+            return False
+        self.seen.add(digest)
+        self.new.append(digest)
+        return True
+
+    def stage(self, workflow_id):
+        """
+        Set the events added so far aside for the upload workflow `workflow_id`.
+        """
+        with tempfile.NamedTemporaryFile(
+            "wb", dir=os.path.dirname(self.path), prefix=".", suffix=".tmp", delete=False
+        ) as fh:
+            fh.write(b"".join(self.new))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(fh.name, self.staged_path(workflow_id))
+        self.new = []
+
+    def confirm(self, workflow_id):
+        """
+        Record the events staged for an upload workflow that succeeded.
+        """
+        try:
+            with open(self.staged_path(workflow_id), "rb") as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return
+        self.fh.write(data)
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        os.remove(self.staged_path(workflow_id))
+
+    def discard(self, workflow_id):
+        """
+        Forget the events staged for an upload workflow that failed, so later runs
+        send them again.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.staged_path(workflow_id))
+
+
+def dedup_timeline(sources, destination, seen):
+    """
+    Copy the rows of the Hayabusa CSV timelines in `sources` whose events `seen`
+    doesn't hold yet into one CSV at `destination`. Returns the rows kept and dropped.
+    """
+    kept = dropped = 0
+    writer = None
+    with open(destination, "w", newline="", encoding="utf-8") as out:
+        for source in sources:
+            with open(source, newline="", encoding="utf-8", errors="replace") as fh:
+                reader = csv.DictReader(fh)
+                if writer is None:
+                    writer = csv.DictWriter(out, fieldnames=reader.fieldnames or [], extrasaction="ignore")
+                    writer.writeheader()
+                for row in reader:
+                    key = event_key(row)
+                    if key is None or seen.add(key):
+                        writer.writerow(row)
+                        kept += 1
+                    else:
+                        dropped += 1
+    return kept, dropped
+
+
+def queue_dedup(folder_id, workflow_id, filename, sketch_name, sketch_id, timeline_name):
+    """
+    Hand a started Hayabusa workflow to the dedup watcher, which uploads its unseen
+    events to Timesketch once it finished.
+    """
+    entry = {
+        "backend": current_backend().name,
+        "folder_id": folder_id,
+        "workflow_id": workflow_id,
+        "filename": filename,
+        "sketch_name": sketch_name,
+        "sketch_id": sketch_id,
+        "timeline_name": timeline_name,
+        "request_id": current_request_id(),
+        "priority": current_priority(),
+        "created": time.time(),
+    }
+    return save_dedup_entry(entry)
+
+
+def queue_upload_check(folder_id, workflow_id, sketch_name, sketch_id):
+    """
+    Hand a started Timesketch upload workflow to the dedup watcher, which records
+    its staged events as seen once it succeeded.
+    """
+    entry = {
+        "kind": "upload",
+        "backend": current_backend().name,
+        "folder_id": folder_id,
+        "workflow_id": workflow_id,
+        "sketch_name": sketch_name,
+        "sketch_id": sketch_id,
+        "request_id": current_request_id(),
+        "priority": current_priority(),
+        "created": time.time(),
+    }
+    return save_dedup_entry(entry)
+
+
+def save_dedup_entry(entry):
+    """
+    Write a queued dedup entry atomically, named after its backend and workflow.
+    """
+    pending_dir = os.path.join(DEDUP_DIR, "pending")
+    os.makedirs(pending_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=pending_dir, prefix=".", suffix=".tmp", delete=False) as fh:
+        json.dump(entry, fh)
+    path = os.path.join(pending_dir, f"{safe_name(entry['backend'])}-{int(entry['workflow_id'])}.json")
+    os.replace(fh.name, path)
+    return path
+
+
+def workflow_status(workflow):
+    """
+    Return "success" or "failed" once every task of a workflow finished, None while it runs.
+    """
+    states = {task.get("status_short") for task in workflow.get("tasks") or []}
+    if not states or not states <= FINISHED_TASK_STATES:
+        return None
+    return "success" if states == {"SUCCESS"} else "failed"
+
+
+def timeline_outputs(workflow):
+    """
+    Return the IDs of the CSV timelines a Hayabusa workflow wrote.
+    """
+    return [
+        output["id"] for output in workflow_output_files(workflow)
+        if (output["filename"] or "").lower().endswith(".csv")
+    ]
+
+
+def upload_unseen_events(entry):
+    """
+    Upload the events of a finished Hayabusa workflow that its sketch doesn't
+    hold yet, as a new Timesketch workflow. Returns False while the Hayabusa
+    workflow is still running or another run holds the sketch's events, True
+    once the entry is done with.
+    """
+    backend = next((backend for backend in backends if backend.name == entry["backend"]), None)
+    if backend is None:
+        print("Dropping dedup of workflow %s, backend %s is gone" % (entry["workflow_id"], entry["backend"]))
+        return True
+
+    workflow = call_upstream(
+        backend.openrelik_upstream, "get_workflow", backend.workflows_api.get_workflow,
+        entry["folder_id"], entry["workflow_id"],
+    )
+    status = workflow_status(workflow)
+    if status is None:
+        if time.time() - entry["created"] > DEDUP_MAX_WAIT:
+            print("Giving up on dedup of workflow %s, still running" % entry["workflow_id"])
+            return True
+        return False
+    if status == "failed":
+        print("Skipping dedup of workflow %s, Hayabusa failed" % entry["workflow_id"])
+        return True
+
+    sketch_id = entry["sketch_id"]
+    if not sketch_id:
+        # A new label's sketch. Create it now, so its seen events are keyed by its ID
+        # and every upload goes into it.
+        with use_backend(backend):
+            sketch_id = ensure_sketch(entry["sketch_name"])
+
+    seen = SeenEvents(backend.name, entry["sketch_name"], sketch_id)
+    if not seen.acquire():
+        return False
+    work_dir = tempfile.mkdtemp(prefix="openrelik-pipeline-dedup-")
+    try:
+        with seen:
+            sources = [download_output_file(backend, file_id, work_dir) for file_id in timeline_outputs(workflow)]
+            deduped_path = os.path.join(work_dir, safe_name(entry["timeline_name"]) + ".csv")
+            with span("dedup_timeline", workflow_id=entry["workflow_id"], sketch=entry["sketch_name"]):
+                kept, dropped = dedup_timeline(sources, deduped_path, seen)
+            log_event(
+                "dedup_events", workflow_id=entry["workflow_id"], sketch=entry["sketch_name"],
+                kept=kept, dropped=dropped,
+            )
+            if kept:
+                with use_backend(backend):
+                    folder_id = entry["folder_id"]
+                    file_id = upload_file(deduped_path, folder_id)
+                    workflow_id, workflow_folder_id = create_workflow(folder_id, [file_id])
+                    rename_folder(
+                        workflow_folder_id, f"{entry['filename']} Hayabusa to Timesketch Upload Folder"
+                    )
+                    rename_workflow(
+                        folder_id, workflow_id, f"{entry['filename']} Hayabusa to Timesketch Upload"
+                    )
+                    add_timesketch_tasks_to_workflow(
+                        folder_id, workflow_id, entry["sketch_name"], sketch_id, entry["timeline_name"]
+                    )
+                    run_workflow(folder_id, workflow_id)
+                    # Its events count as seen from now on, but are only recorded
+                    # once the upload succeeded
+                    queue_upload_check(folder_id, workflow_id, entry["sketch_name"], sketch_id)
+                    seen.stage(workflow_id)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return True
+
+
+def confirm_upload(entry):
+    """
+    Record the staged events of a Timesketch upload workflow as seen once it
+    succeeded, or drop them if it failed. Returns False while it is still running
+    or another run holds the sketch's events, True once the entry is done with.
+    """
+    seen = SeenEvents(entry["backend"], entry["sketch_name"], entry["sketch_id"])
+    backend = next((backend for backend in backends if backend.name == entry["backend"]), None)
+    if backend is None:
+        print("Dropping upload check of workflow %s, backend %s is gone" % (entry["workflow_id"], entry["backend"]))
+        seen.discard(entry["workflow_id"])
+        return True
+
+    workflow = call_upstream(
+        backend.openrelik_upstream, "get_workflow", backend.workflows_api.get_workflow,
+        entry["folder_id"], entry["workflow_id"],
+    )
+    status = workflow_status(workflow)
+    if status is None and time.time() - entry["created"] <= DEDUP_MAX_WAIT:
+        return False
+    if status != "success":
+        print("Upload workflow %s didn't succeed, its events will be sent again" % entry["workflow_id"])
+        seen.discard(entry["workflow_id"])
+        return True
+
+    if not seen.acquire():
+        return False
+    with seen:
+        seen.confirm(entry["workflow_id"])
+    log_event("dedup_confirmed", workflow_id=entry["workflow_id"], sketch=entry["sketch_name"])
+    return True
+
+
+def process_pending_dedups():
+    """
+    Finish every queued dedup whose Hayabusa workflow is done. Each entry is
+    locked while it is handled, so several processes can share DEDUP_DIR.
+    """
+    pending_dir = os.path.join(DEDUP_DIR, "pending")
+    try:
+        names = sorted(os.listdir(pending_dir))
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        if draining.is_set():
+            return
+        if not name.endswith(".json") or name.startswith("."):
+            continue
+        path = os.path.join(pending_dir, name)
+        try:
+            fh = open(path)
+        except FileNotFoundError:
+            continue
+        with fh:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            if os.fstat(fh.fileno()).st_nlink == 0:
+                # Another process finished it between open() and flock().
+                continue
+            entry = json.load(fh)
+            try:
+                with app.app_context():
+                    g.request_id = entry.get("request_id") or uuid.uuid4().hex
+                    g.priority = entry.get("priority", "normal")
+                    if entry.get("kind") == "upload":
+                        done = confirm_upload(entry)
+                    else:
+                        done = upload_unseen_events(entry)
+            except Exception as e:
+                print("Error deduplicating workflow %s: %s" % (entry["workflow_id"], e))
+                continue
+            if done:
+                os.remove(path)
+
+
+def watch_dedups():
+    """
+    Periodically finish queued dedups.
+    """
+    while True:
+        if not draining.is_set():
+            try:
+                process_pending_dedups()
+            except Exception as e:
+                print("Error processing dedups in %s: %s" % (DEDUP_DIR, e))
+        time.sleep(DEDUP_POLL_INTERVAL)
+
+
+def start_dedup_watcher():
+    """
+    Start finishing queued dedups in the background.
+    """
+    watcher = threading.Thread(target=watch_dedups, name="dedup-watcher", daemon=True)
+    watcher.start()
+    return watcher
+
+
+# --------------------------------------------------------------------------------
+# Timeline merging
+# --------------------------------------------------------------------------------
+# Columns holding the event time, in Hayabusa's Timesketch and standard CSV output
+MERGE_TIME_COLUMNS = ("datetime", "Timestamp")
+# Column added to merged timelines with the host a row was collected from
+MERGE_HOST_COLUMN = "host"
+
+
+def should_merge(filename):
+    """
+    Whether the Hayabusa timeline of a file goes into a merged timeline.
+    Only KAPE collections with a label are merged.
+    """
+    fqdn, label = extract_fqdn_and_label(filename)
+    if not (MERGE_TIMELINES and fqdn and label and label != "Null"):
+        return False
+    return not MERGE_LABELS or any(fnmatch.fnmatchcase(label, pattern) for pattern in MERGE_LABELS)
+
+
+def queue_merge(folder_id, workflow_id, filename, sketch_name, sketch_id):
+    """
+    Hand a started Hayabusa workflow to the merge watcher, which merges its timeline
+    with those of the other hosts in the sketch once they finished.
+    """
+    pending_dir = os.path.join(MERGE_DIR, "pending")
+    os.makedirs(pending_dir, exist_ok=True)
+    backend = current_backend()
+    fqdn, label = extract_fqdn_and_label(filename)
+    entry = {
+        "backend": backend.name,
+        "folder_id": folder_id,
+        "workflow_id": workflow_id,
+        "filename": filename,
+        "host": fqdn,
+        "label": label,
+        "sketch_name": sketch_name,
+        "sketch_id": sketch_id,
+        "request_id": current_request_id(),
+        "priority": current_priority(),
+        "created": time.time(),
+        "status": None,
+        "timelines": [],
+    }
+    path = os.path.join(pending_dir, f"{safe_name(backend.name)}-{int(workflow_id)}.json")
+    save_merge_entry(path, entry)
+    return path
+
+
+def save_merge_entry(path, entry):
+    """
+    Write a queued merge entry atomically.
+    """
+    with tempfile.NamedTemporaryFile(
+        "w", dir=os.path.dirname(path), prefix=".", suffix=".tmp", delete=False
+    ) as fh:
+        json.dump(entry, fh)
+    os.replace(fh.name, path)
+
+
+def row_time(row):
+    """
+    Return the time of a timeline row, as the ISO 8601 string Hayabusa writes.
+    """
+    for column in MERGE_TIME_COLUMNS:
+        if row.get(column):
+            return row[column]
+    return ""
+
+
+def read_timeline(path, host):
+    """
+    Yield the rows of a Hayabusa CSV timeline, tagged with the host it came from.
+    """
+    with open(path, newline="", encoding="utf-8", errors="replace") as fh:
+        for row in csv.DictReader(fh):
+            row[MERGE_HOST_COLUMN] = host
+            yield row
+
+
+def merge_timelines(sources, destination, seen=None):
+    """
+    K-way merge the Hayabusa CSV timelines in `sources`, (path, host) pairs, into one
+    time-sorted CSV at `destination` with a host column. Hayabusa writes its timelines
+    sorted by time, so one streaming pass holding a row per source is enough. With
+    `seen`, events it already holds are dropped. Returns the rows kept and dropped.
+    """
+    fieldnames = []
+    for path, _ in sources:
+        with open(path, newline="", encoding="utf-8", errors="replace") as fh:
+            for column in next(csv.reader(fh), []):
+                if column not in fieldnames:
+                    fieldnames.append(column)
+    if MERGE_HOST_COLUMN not in fieldnames:
+        fieldnames.append(MERGE_HOST_COLUMN)
+
+    kept = dropped = 0
+    with open(destination, "w", newline="", encoding="utf-8") as out:
+        writer = csv.DictWriter(out, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        rows = heapq.merge(*(read_timeline(path, host) for path, host in sources), key=row_time)
+        for row in rows:
+            if seen is not None:
+                key = event_key(row)
+                if key is not None and not seen.add(key):
+                    dropped += 1
+                    continue
+            writer.writerow(row)
+            kept += 1
+    return kept, dropped
+
+
+def upload_merged_timeline(backend, entries):
+    """
+    Merge the timelines of finished Hayabusa workflows of one sketch and upload the
+    result to Timesketch as a new timeline, through an upload-only workflow. The
+    sketch is created here if it doesn't exist yet, so every batch goes into the
+    same one. Returns False, without merging, if another run holds the sketch's events.
+    """
+    first = entries[0]
+    with use_backend(backend):
+        sketch_id = ensure_sketch(first["sketch_name"])
+    seen = None
+    if DEDUP_EVENTS:
+        seen = SeenEvents(backend.name, first["sketch_name"], sketch_id)
+        if not seen.acquire():
+            return False
+    timeline_name = "%s merged %s-%d" % (first["label"], time.strftime("%Y%m%d-%H%M%S"), int(first["workflow_id"]))
+    work_dir = tempfile.mkdtemp(prefix="openrelik-pipeline-merge-")
+    try:
+        with seen or contextlib.nullcontext():
+            sources = [
+                (download_output_file(backend, file_id, work_dir), entry["host"])
+                for entry in entries
+                for file_id in entry["timelines"]
+            ]
+            merged_path = os.path.join(work_dir, safe_name(timeline_name) + ".csv")
+            with span("merge_timelines", sketch=first["sketch_name"], hosts=len(entries)):
+                kept, dropped = merge_timelines(sources, merged_path, seen)
+            log_event(
+                "merge_timelines", sketch=first["sketch_name"], timeline=timeline_name,
+                hosts=len(entries), kept=kept, dropped=dropped,
+            )
+            if kept:
+                with use_backend(backend):
+                    folder_id = create_folder(f"{timeline_name} Hayabusa Timeline")
+                    file_id = upload_file(merged_path, folder_id)
+                    workflow_id, workflow_folder_id = create_workflow(folder_id, [file_id])
+                    rename_folder(workflow_folder_id, f"{timeline_name} Hayabusa to Timesketch Upload Folder")
+                    rename_workflow(folder_id, workflow_id, f"{timeline_name} Hayabusa to Timesketch Upload")
+                    add_timesketch_tasks_to_workflow(
+                        folder_id, workflow_id, first["sketch_name"], sketch_id, timeline_name
+                    )
+                    run_workflow(folder_id, workflow_id)
+                    if seen is not None:
+                        queue_upload_check(folder_id, workflow_id, first["sketch_name"], sketch_id)
+                        seen.stage(workflow_id)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return True
+
+
+def merge_sketch_timelines(members):
+    """
+    Check on the queued workflows of one sketch, given as (path, entry) pairs, and
+    merge their timelines once MERGE_MAX_HOSTS finished, or once all finished and
+    no host was added for MERGE_WINDOW seconds.
+    """
+    sketch_name, backend_name = members[0][1]["sketch_name"], members[0][1]["backend"]
+    backend = next((backend for backend in backends if backend.name == backend_name), None)
+    if backend is None:
+        print("Dropping merge into sketch %s, backend %s is gone" % (sketch_name, backend_name))
+        for path, _ in members:
+            os.remove(path)
+        return
+
+    now = time.time()
+    finished = []
+    running = False
+    for path, entry in members:
+        if entry["status"] is None:
+            workflow = call_upstream(
+                backend.openrelik_upstream, "get_workflow", backend.workflows_api.get_workflow,
+                entry["folder_id"], entry["workflow_id"],
+            )
+            entry["status"] = workflow_status(workflow)
+            if entry["status"] == "success":
+                entry["timelines"] = timeline_outputs(workflow)
+            elif entry["status"] is None and now - entry["created"] > MERGE_MAX_WAIT:
+                print("Giving up on merging workflow %s, still running" % entry["workflow_id"])
+                entry["status"] = "failed"
+            if entry["status"] is not None:
+                save_merge_entry(path, entry)
+
+        if entry["status"] is None:
+            running = True
+        elif entry["status"] == "success":
+            finished.append((path, entry))
+        else:
+            print("Leaving workflow %s out of the merged timeline, Hayabusa failed" % entry["workflow_id"])
+            os.remove(path)
+
+    quiet = now - max(entry["created"] for _, entry in members) >= MERGE_WINDOW
+    while len(finished) >= MERGE_MAX_HOSTS or (finished and quiet and not running):
+        batch, finished = finished[:MERGE_MAX_HOSTS], finished[MERGE_MAX_HOSTS:]
+        if draining.is_set():
+            return
+        with app.app_context():
+            g.request_id = uuid.uuid4().hex
+            g.priority = "high" if any(entry["priority"] == "high" for _, entry in batch) else "normal"
+            if not upload_merged_timeline(backend, [entry for _, entry in batch]):
+                print("Sketch %s is busy, merging on the next check" % sketch_name)
+                return
+        for path, _ in batch:
+            os.remove(path)
+
+
+def process_pending_merges():
+    """
+    Merge the timelines of every sketch whose queued workflows are ready. Only one
+    process merges at a time, so several processes can share MERGE_DIR.
+    """
+    pending_dir = os.path.join(MERGE_DIR, "pending")
+    os.makedirs(pending_dir, exist_ok=True)
+    with open(os.path.join(MERGE_DIR, "merge.lock"), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        sketches = {}
+        for name in sorted(os.listdir(pending_dir)):
+            if not name.endswith(".json") or name.startswith("."):
+                continue
+            path = os.path.join(pending_dir, name)
+            with open(path) as fh:
+                entry = json.load(fh)
+            # Not keyed by sketch ID: entries queued before a new label's sketch
+            # existed have none
+            key = (entry["backend"], entry["sketch_name"])
+            sketches.setdefault(key, []).append((path, entry))
+
+        for members in sketches.values():
+            if draining.is_set():
+                return
+            members.sort(key=lambda member: member[1]["created"])
+            try:
+                merge_sketch_timelines(members)
+            except Exception as e:
+                print("Error merging timelines into sketch %s: %s" % (members[0][1]["sketch_name"], e))
+
+
+def watch_merges():
+    """
+    Periodically merge the timelines that are ready.
+    """
+    while True:
+        if not draining.is_set():
+            try:
+                process_pending_merges()
+            except Exception as e:
+                print("Error processing merges in %s: %s" % (MERGE_DIR, e))
+        time.sleep(MERGE_POLL_INTERVAL)
+
+
+def start_merge_watcher():
+    """
+    Start merging timelines in the background.
+    """
+    watcher = threading.Thread(target=watch_merges, name="merge-watcher", daemon=True)
+    watcher.start()
+    return watcher
+
+
+# --------------------------------------------------------------------------------
+# Pipelines
+# --------------------------------------------------------------------------------
+def resolve_sketch(filename):
+    """
+    Work out the sketch and timeline names for a file.
+
+    If a label is part of the filename, check to see if sketch exists with the same
+    name and add it to it instead of creating a new sketch. With a rollover limit
+    set, the label's currently active sketch is used instead.
+    Returns (sketch_name, sketch_id, timeline_name).
+    """
+    timeline_name, extension = os.path.splitext(filename)
+    fqdn, label = extract_fqdn_and_label(filename)
+
+    if fqdn and label and label != "Null":
+        timeline_name = fqdn
+        if SKETCH_MAX_TIMELINES or SKETCH_MAX_EVENTS:
+            try:
+                sketch_name, sketch_id = resolve_active_sketch(label)
+                return sketch_name, sketch_id, timeline_name
+            except Exception as e:
+                print("Error resolving the active sketch for %s: %s" % (label, e))
+        sketch_name = label
+    else:
+        sketch_name = filename
+
+    sketch_id = lookup_sketch_id(sketch_name)
+    return sketch_name, sketch_id, timeline_name
+
+
+def run_hayabusa_timesketch_pipeline(file_path, filename):
+    """
+    Upload a file to OpenRelik, process it with Hayabusa and push the result into Timesketch.
+    Returns the workflow ID and the run details.
+    """
+    sketch_name, sketch_id, timeline_name = checkpoint("resolve_sketch", resolve_sketch, filename)
+
+    folder_id, file_id = checkpoint(
+        "upload", upload_to_folder, file_path, filename, f"{filename} Hayabusa Timelines"
+    )
+    workflow_id, workflow_folder_id = checkpoint("create_workflow", create_workflow, folder_id, [file_id])
+
+    checkpoint(
+        "rename_folder", rename_folder,
+        workflow_folder_id, f"{filename} Hayabusa to Timesketch Workflow Folder",
+    )
+    checkpoint(
+        "rename_workflow", rename_workflow,
+        folder_id, workflow_id, f"{filename} Hayabusa to Timesketch Workflow",
+    )
+
+    merge = should_merge(filename)
+    if DEDUP_EVENTS or merge:
+        # Only run Hayabusa here, the dedup or merge watcher uploads the events once it finished
+        if zipfile.is_zipfile(file_path):
+            checkpoint("add_tasks", add_hayabusa_extract_tasks_to_workflow, folder_id, workflow_id, True)
+        else:
+            checkpoint("add_tasks", add_hayabusa_tasks_to_workflow, folder_id, workflow_id, True)
+    elif zipfile.is_zipfile(file_path):
+        checkpoint(
+            "add_tasks", add_hayabusa_extract_ts_tasks_to_workflow,
+            folder_id, workflow_id, sketch_name, sketch_id, timeline_name,
+        )
+    else:
+        checkpoint(
+            "add_tasks", add_hayabusa_ts_tasks_to_workflow,
+            folder_id, workflow_id, sketch_name, sketch_id, timeline_name,
+        )
+    run = checkpoint("run_workflow", run_workflow, folder_id, workflow_id)
+    if merge:
+        checkpoint("queue_merge", queue_merge, folder_id, workflow_id, filename, sketch_name, sketch_id)
+    elif DEDUP_EVENTS:
+        checkpoint(
+            "queue_dedup", queue_dedup,
+            folder_id, workflow_id, filename, sketch_name, sketch_id, timeline_name,
+        )
+
+    return workflow_id, run
+
+
+def run_hayabusa_pipeline(file_path, filename):
+    """
+    Upload a file to OpenRelik and process it with Hayabusa.
+    Returns the workflow ID and the run details.
+    """
+    folder_id, file_id = checkpoint(
+        "upload", upload_to_folder, file_path, filename, f"{filename} Hayabusa Timelines"
+    )
+    workflow_id, workflow_folder_id = checkpoint("create_workflow", create_workflow, folder_id, [file_id])
+
+    checkpoint("rename_folder", rename_folder, workflow_folder_id, f"{filename} Hayabusa Workflow Folder")
+    checkpoint("rename_workflow", rename_workflow, folder_id, workflow_id, f"{filename} Hayabusa Workflow")
+
+    if zipfile.is_zipfile(file_path):
+        checkpoint("add_tasks", add_hayabusa_extract_tasks_to_workflow, folder_id, workflow_id)
+    else:
+        checkpoint("add_tasks", add_hayabusa_tasks_to_workflow, folder_id, workflow_id)
+    run = checkpoint("run_workflow", run_workflow, folder_id, workflow_id)
+
+    return workflow_id, run
+
+
+def run_plaso_timesketch_pipeline(file_path, filename):
+    """
+    Upload a file to OpenRelik, process it with Plaso and push the result into Timesketch.
+    Returns the workflow ID and the run details.
+    """
+    sketch_name, sketch_id, timeline_name = checkpoint("resolve_sketch", resolve_sketch, filename)
+
+    folder_id, file_id = checkpoint(
+        "upload", upload_to_folder, file_path, filename, f"{filename} Plaso Timeline"
+    )
+    workflow_id, workflow_folder_id = checkpoint("create_workflow", create_workflow, folder_id, [file_id])
+
+    checkpoint(
+        "rename_folder", rename_folder, workflow_folder_id, f"{filename} Plaso to Timesketch Workflow Folder"
+    )
+    checkpoint(
+        "rename_workflow", rename_workflow, folder_id, workflow_id, f"{filename} Plaso to Timesketch Workflow"
+    )
+
+    checkpoint(
+        "add_tasks", add_plaso_ts_tasks_to_workflow,
+        folder_id, workflow_id, sketch_name, sketch_id, timeline_name,
+    )
+    run = checkpoint("run_workflow", run_workflow, folder_id, workflow_id)
+
+    return workflow_id, run
+
+
+def run_plaso_pipeline(file_path, filename):
+    """
+    Upload a file to OpenRelik and process it with Plaso.
+    Returns the workflow ID and the run details.
+    """
+    folder_id, file_id = checkpoint(
+        "upload", upload_to_folder, file_path, filename, f"{filename} Plaso Timeline"
+    )
+    workflow_id, workflow_folder_id = checkpoint("create_workflow", create_workflow, folder_id, [file_id])
+
+    checkpoint("rename_folder", rename_folder, workflow_folder_id, f"{filename} Plaso Workflow Folder")
+    checkpoint("rename_workflow", rename_workflow, folder_id, workflow_id, f"{filename} Plaso Workflow")
+
+    checkpoint("add_tasks", add_plaso_tasks_to_workflow, folder_id, workflow_id)
+    run = checkpoint("run_workflow", run_workflow, folder_id, workflow_id)
+
+    return workflow_id, run
+
+
+# Pipelines by name, as used for the drop-folder subdirectories
+PIPELINES = {
+    "hayabusa": run_hayabusa_pipeline,
+    "hayabusa-timesketch": run_hayabusa_timesketch_pipeline,
+    "plaso": run_plaso_pipeline,
+    "plaso-timesketch": run_plaso_timesketch_pipeline,
+}
+
+
+def dispatch_pipeline(pipeline_name, file_path, filename):
+    """
+    Run a file through the named pipeline on the current backend. With
+    INCREMENTAL_TRIAGE, collections of known hosts only send their changed members.
+    """
+    fqdn, label = extract_fqdn_and_label(filename)
+    if INCREMENTAL_TRIAGE and fqdn and label and label != "Null" and zipfile.is_zipfile(file_path):
+        return run_incremental_pipeline(pipeline_name, file_path, filename, label, fqdn)
+    return PIPELINES[pipeline_name](file_path, filename)
+
+
+def run_pipeline(pipeline_name, file_path, filename, job=None):
+    """
+    Run a file through the named pipeline on the backend selected for its label.
+    With SPLIT_MULTI_HOST, zips holding several hosts run as one workflow per host
+    and the workflow IDs and run details are returned as lists.
+    With INCREMENTAL_TRIAGE, collections of known hosts only send their changed members.
+    With JOURNAL_DIR, the run is journaled as a job, pass `job` to resume one.
+    Returns the workflow ID and the run details, or (None, None) if nothing changed.
+    """
+    fqdn, label = extract_fqdn_and_label(filename)
+    g.priority = resolve_priority(label, g.get("requested_priority"))
+    g.hayabusa_profile = resolve_hayabusa_profile(label, g.get("requested_hayabusa_profile"))
+    if job is None and JOURNAL_DIR:
+        job = adopt_orphaned_job(pipeline_name, file_path, filename) or Job.create(
+            pipeline_name, file_path, filename
+        )
+    g.job = job
+
+    try:
+        backend = select_backend(label)
+        if job is not None:
+            backend = job.pin_backend(backend)
+        with use_backend(backend):
+            with span(
+                "pipeline", pipeline=pipeline_name, filename=filename, backend=backend.name,
+                priority=g.priority, job=job.id if job else None,
+            ):
+                result = None
+                if SPLIT_MULTI_HOST and zipfile.is_zipfile(file_path):
+                    result = run_split_pipeline(pipeline_name, file_path, filename)
+                if result is None:
+                    result = dispatch_pipeline(pipeline_name, file_path, filename)
+    except Exception:
+        if job is not None:
+            # A failed upload is reported to its sender, who can retry it. Only
+            # resumed jobs have nobody waiting and are kept for another attempt.
+            if job.state["resumes"]:
+                job.release()
+            else:
+                job.finish()
+        raise
+    finally:
+        g.job = None
+
+    if job is not None:
+        job.finish()
+    return result
+
+
+# --------------------------------------------------------------------------------
+# Drop-folder ingestion
+# --------------------------------------------------------------------------------
+INGEST_PROCESSING_DIR = ".processing"
+INGEST_FAILED_DIR = ".failed"
+INGEST_PARTIAL_SUFFIXES = (".partial", ".tmp", ".part")
+
+
+def is_ingest_candidate(name):
+    """
+    Files are only picked up once the writer renamed them to their final name.
+    Hidden files and files with a partial suffix are still being written.
+    """
+    return not name.startswith(".") and not name.endswith(INGEST_PARTIAL_SUFFIXES)
+
+
+def lock_claim_dir(claim_dir, blocking=True):
+    """
+    Lock a claim directory for as long as its file is processed. Returns the
+    locked file descriptor, or None if another process holds the lock.
+    """
+    fd = os.open(claim_dir, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def release_claim(claim_dir, lock):
+    """
+    Remove a claim directory, with the claimed file if still there, and unlock it.
+    """
+    try:
+        for name in os.listdir(claim_dir):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(claim_dir, name))
+        os.rmdir(claim_dir)
+    except FileNotFoundError:
+        pass
+    finally:
+        os.close(lock)
+
+
+def claim_ingest_file(pipeline_name, filename):
+    """
+    Atomically move a completed file out of the watched directory, into a locked
+    directory of its own under .processing, so files of the same name don't
+    overwrite each other.
+
+    Returns the claimed path and the lock, or (None, None) if another worker got to it first.
+    """
+    processing_dir = os.path.join(INGEST_DIR, INGEST_PROCESSING_DIR, pipeline_name)
+    os.makedirs(processing_dir, exist_ok=True)
+    claim_dir = tempfile.mkdtemp(prefix="claim-", dir=processing_dir)
+    try:
+        lock = lock_claim_dir(claim_dir)
+    except FileNotFoundError:
+        # Removed as an empty claim by another process's recovery
+        return None, None
+    claimed_path = os.path.join(claim_dir, filename)
+    try:
+        os.rename(os.path.join(INGEST_DIR, pipeline_name, filename), claimed_path)
+    except FileNotFoundError:
+        release_claim(claim_dir, lock)
+        return None, None
+    return claimed_path, lock
+
+
+def fail_ingest_claim(pipeline_name, claimed_path):
+    """
+    Move a claim that failed its pipeline to .failed, keeping its directory so
+    files of the same name don't overwrite each other.
+    """
+    claim_dir = os.path.dirname(claimed_path)
+    failed_dir = os.path.join(INGEST_DIR, INGEST_FAILED_DIR, pipeline_name)
+    os.makedirs(failed_dir, exist_ok=True)
+    os.rename(claim_dir, os.path.join(failed_dir, os.path.basename(claim_dir)))
+
+
+def recover_ingest_claims(executor):
+    """
+    Queue the files a stopped process left in .processing again. Claims still locked
+    belong to a running process. With JOURNAL_DIR, their jobs are resumed from the
+    journal instead.
+    """
+    for pipeline_name in PIPELINES:
+        processing_dir = os.path.join(INGEST_DIR, INGEST_PROCESSING_DIR, pipeline_name)
+        try:
+            entries = list(os.scandir(processing_dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                try:
+                    lock = lock_claim_dir(entry.path, blocking=False)
+                except FileNotFoundError:
+                    continue
+                if lock is None:
+                    continue
+                names = os.listdir(entry.path)
+                if not names:
+                    release_claim(entry.path, lock)
+                    continue
+                claimed_path = os.path.join(entry.path, names[0])
+            else:
+                # Claimed before claims got a directory of their own
+                claim_dir = tempfile.mkdtemp(prefix="claim-", dir=processing_dir)
+                try:
+                    lock = lock_claim_dir(claim_dir)
+                except FileNotFoundError:
+                    continue
+                claimed_path = os.path.join(claim_dir, entry.name)
+                try:
+                    os.rename(entry.path, claimed_path)
+                except FileNotFoundError:
+                    release_claim(claim_dir, lock)
+                    continue
+            print("Requeueing %s, left in %s by a stopped process" % (os.path.basename(claimed_path), processing_dir))
+            executor.submit(process_ingest_file, pipeline_name, claimed_path, lock)
+
+
+def process_ingest_file(pipeline_name, claimed_path, lock):
+    """
+    Run a claimed file through its pipeline straight from the drop folder.
+    The file is removed once it is in OpenRelik and kept aside if the pipeline fails.
+    """
+    try:
+        filename = os.path.basename(claimed_path)
+        fqdn, label = extract_fqdn_and_label(filename)
+        # Drop-folder files wait for their label's rate limit and for a slot, where
+        # they are queued by priority and fair share like uploads.
+        while True:
+            try:
+                rate_limit_label(filename)
+                break
+            except RateLimited as e:
+                time.sleep(e.retry_after)
+        admission.acquire(
+            resolve_priority(label), timeout=None,
+            flow=f"label:{label}", weight=fair_share_weight("label", label),
+        )
+        try:
+            with app.app_context():
+                g.request_id = uuid.uuid4().hex
+                workflow_id, run = run_pipeline(pipeline_name, claimed_path, filename)
+        except Exception as e:
+            print("Error ingesting %s through %s: %s" % (filename, pipeline_name, e))
+            fail_ingest_claim(pipeline_name, claimed_path)
+            return
+        finally:
+            admission.release()
+        if workflow_id is None:
+            print("Skipped %s through %s, no changed artifacts" % (filename, pipeline_name))
+        else:
+            print("Ingested %s through %s as workflow %s" % (filename, pipeline_name, workflow_id))
+    finally:
+        release_claim(os.path.dirname(claimed_path), lock)
+
+
+def scan_ingest_dir(executor):
+    """
+    Claim every completed file in the pipeline subdirectories and queue it for processing.
+    Nothing new is claimed while draining.
+    """
+    for pipeline_name in PIPELINES:
+        if draining.is_set():
+            return
+        pipeline_dir = os.path.join(INGEST_DIR, pipeline_name)
+        try:
+            entries = list(os.scandir(pipeline_dir))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if not entry.is_file() or not is_ingest_candidate(entry.name):
+                continue
+            claimed_path, lock = claim_ingest_file(pipeline_name, entry.name)
+            if claimed_path:
+                executor.submit(process_ingest_file, pipeline_name, claimed_path, lock)
+
+
+def watch_ingest_dir():
+    """
+    Watch the drop folder and feed completed files into their pipeline.
+
+    inotify is used to react to renames immediately when inotify_simple is
+    available. A periodic rescan runs either way, so events missed by inotify
+    (or filesystems without it, like most network mounts) are still picked up.
+    """
+    for pipeline_name in PIPELINES:
+        os.makedirs(os.path.join(INGEST_DIR, pipeline_name), exist_ok=True)
+
+    inotify = None
+    if INotify is not None:
+        try:
+            inotify = INotify()
+            for pipeline_name in PIPELINES:
+                inotify.add_watch(
+                    os.path.join(INGEST_DIR, pipeline_name),
+                    inotify_flags.MOVED_TO | inotify_flags.CLOSE_WRITE,
+                )
+        except OSError as e:
+            print("inotify unavailable for %s, falling back to polling: %s" % (INGEST_DIR, e))
+            inotify = None
+
+    executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS)
+    if not JOURNAL_DIR:
+        try:
+            recover_ingest_claims(executor)
+        except Exception as e:
+            print("Error recovering claimed files in %s: %s" % (INGEST_DIR, e))
+    while True:
+        try:
+            scan_ingest_dir(executor)
+        except Exception as e:
+            print("Error scanning ingest directory %s: %s" % (INGEST_DIR, e))
+        if inotify is not None:
+            inotify.read(timeout=int(INGEST_POLL_INTERVAL * 1000))
+        else:
+            time.sleep(INGEST_POLL_INTERVAL)
+
+
+def start_ingest_watcher():
+    """
+    Start the drop-folder watcher in the background.
+    """
+    watcher = threading.Thread(target=watch_ingest_dir, name="ingest-watcher", daemon=True)
+    watcher.start()
+    return watcher
+
+
+# --------------------------------------------------------------------------------
+# Graceful drain and job journal
+# --------------------------------------------------------------------------------
+draining = threading.Event()
+
+
+def install_drain_handler():
+    """
+    Start draining on SIGTERM, then hand the signal on to the previous handler.
+    Under Gunicorn that is the worker's own handler, which stops accepting
+    connections and gives in-flight requests until graceful_timeout to finish.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        if not draining.is_set():
+            draining.set()
+            log_event("draining", pid=os.getpid())
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    try:
+        signal.signal(signal.SIGTERM, handle_sigterm)
+    except ValueError:
+        # Signal handlers can only be installed from the main thread.
+        pass
+
+
+def spool_path(filename):
+    """
+    Return where an upload is saved before it is processed: /tmp, or with JOURNAL_DIR
+    a directory of its own under JOURNAL_DIR/spool, so it survives a restart.
+    """
+    if not JOURNAL_DIR:
+        return os.path.join("/tmp", filename)
+    spool_dir = os.path.join(JOURNAL_DIR, "spool")
+    os.makedirs(spool_dir, exist_ok=True)
+    return os.path.join(tempfile.mkdtemp(prefix="upload-", dir=spool_dir), filename)
+
+
+class Job:
+    """
+    A pipeline run journaled under JOURNAL_DIR/jobs, with the result of every
+    stage it completed, so another process can resume it if this one stops.
+
+    The journal file stays locked while the job runs. A journal nobody holds a
+    lock on belongs to a job whose process went away.
+    """
+
+    def __init__(self, path, fh, state):
+        self.path = path
+        self.fh = fh
+        self.state = state
+
+    @property
+    def id(self):
+        return self.state["id"]
+
+    @classmethod
+    def create(cls, pipeline_name, file_path, filename):
+        jobs_dir = os.path.join(JOURNAL_DIR, "jobs")
+        os.makedirs(jobs_dir, exist_ok=True)
+        state = {
+            "id": uuid.uuid4().hex,
+            "pipeline": pipeline_name,
+            "file_path": file_path,
+            "filename": filename,
+            "request_id": current_request_id(),
+            "priority": g.get("requested_priority"),
+            "hayabusa_profile": g.get("requested_hayabusa_profile"),
+            "upload_digest": g.get("upload_digest"),
+            "created": time.time(),
+            "resumes": 0,
+            "stages": {},
+        }
+        # Lock the journal before it shows up under its final name, so no other
+        # process can take it for an orphan.
+        fd, tmp_path = tempfile.mkstemp(dir=jobs_dir, prefix=".", suffix=".tmp")
+        fh = os.fdopen(fd, "r+")
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        job = cls(os.path.join(jobs_dir, state["id"] + ".json"), fh, state)
+        job.save()
+        os.rename(tmp_path, job.path)
+        return job
+
+    @classmethod
+    def claim(cls, path):
+        """
+        Lock an orphaned journal. Returns the job, or None if it is still running or already done.
+        """
+        try:
+            fh = open(path, "r+")
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fh.close()
+            return None
+        if os.fstat(fh.fileno()).st_nlink == 0:
+            # The job finished between open() and flock().
+            fh.close()
+            return None
+        try:
+            state = json.load(fh)
+        except ValueError:
+            state = None
+        return cls(path, fh, state)
+
+    def save(self):
+        self.fh.seek(0)
+        json.dump(self.state, self.fh, default=str)
+        self.fh.truncate()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def record(self, stage, result):
+        self.state["stages"][stage] = result
+        self.save()
+
+    def pin_backend(self, backend):
+        """
+        Keep a resumed job on the backend it started on, as long as that backend is configured.
+        """
+        for candidate in backends:
+            if candidate.name == self.state.get("backend"):
+                return candidate
+        self.state["backend"] = backend.name
+        self.save()
+        return backend
+
+    def is_spooled(self):
+        spool_dir = os.path.join(JOURNAL_DIR, "spool")
+        return os.path.dirname(os.path.dirname(self.state["file_path"])) == spool_dir
+
+    def finish(self):
+        """
+        Drop the journal and the spooled upload, once the job completed or its sender was told it failed.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+        if self.is_spooled():
+            shutil.rmtree(os.path.dirname(self.state["file_path"]), ignore_errors=True)
+        self.fh.close()
+
+    def release(self):
+        """
+        Unlock the journal and keep it for a later resume.
+        """
+        self.fh.close()
 
+    def give_up(self, reason):
+        """
+        Move the journal to JOURNAL_DIR/failed so it isn't resumed again.
+        """
+        failed_dir = os.path.join(JOURNAL_DIR, "failed")
+        os.makedirs(failed_dir, exist_ok=True)
+        os.replace(self.path, os.path.join(failed_dir, os.path.basename(self.path)))
+        print("Giving up on journaled job %s: %s" % (os.path.basename(self.path), reason))
+        self.fh.close()
 
-def run_workflow(folder_id, workflow_id):
+
+def adopt_orphaned_job(pipeline_name, file_path, filename):
     """
-    Trigger the workflow execution.
+    Take over the journal of an upload whose process stopped before answering it,
+    now that its sender sent the same file again, so the run carries on from its
+    completed stages instead of starting over. Returns the job, or None.
     """
-    return workflows_api.run_workflow(folder_id, workflow_id)
+    digest = g.get("upload_digest")
+    if not digest:
+        return None
+    jobs_dir = os.path.join(JOURNAL_DIR, "jobs")
+    try:
+        names = sorted(os.listdir(jobs_dir))
+    except FileNotFoundError:
+        return None
 
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        job = Job.claim(os.path.join(jobs_dir, name))
+        if job is None:
+            continue
+        state = job.state
+        if (
+            state
+            and state.get("upload_digest") == digest
+            and state["pipeline"] == pipeline_name
+            and state["filename"] == filename
+            and job.is_spooled()
+        ):
+            shutil.rmtree(os.path.dirname(state["file_path"]), ignore_errors=True)
+            state["file_path"] = file_path
+            state["request_id"] = current_request_id()
+            job.save()
+            log_event(
+                "job_adopt", job=state["id"], pipeline=pipeline_name, filename=filename,
+                completed_stages=list(state["stages"]),
+            )
+            return job
+        job.release()
+    return None
 
-def extract_fqdn_and_label(filename):
-    # Check if the filename starts with "vr_kapefiles"
-    if filename.startswith("vr_kapefiles"):
-        # vr_kapefiles_<fqdn>_<label>.zip
-        pattern = r"^vr_kapefiles_([^_]+)_(.+)\.zip$"
-        match = re.match(pattern, filename)
-        if match:
-            fqdn = match.group(1)
-            label = match.group(2)
-            return fqdn, label
-    
-    return None, None
+
+def checkpoint(stage, func, *args):
+    """
+    Run a pipeline stage once per job. When a job is resumed, stages it already
+    completed return their journaled result instead of running again.
+    """
+    job = g.get("job") if has_app_context() else None
+    if job is None:
+        return func(*args)
+    if stage in job.state["stages"]:
+        return job.state["stages"][stage]
+    result = func(*args)
+    job.record(stage, result)
+    return result
+
+
+def resume_orphaned_jobs():
+    """
+    Resume every journaled job whose process went away.
+    """
+    jobs_dir = os.path.join(JOURNAL_DIR, "jobs")
+    try:
+        names = sorted(os.listdir(jobs_dir))
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        if draining.is_set():
+            return
+        if not name.endswith(".json"):
+            continue
+        job = Job.claim(os.path.join(jobs_dir, name))
+        if job is None:
+            continue
+        if job.state is None:
+            job.give_up("unreadable journal")
+            continue
+        if not os.path.exists(job.state["file_path"]):
+            job.give_up("%s no longer exists" % job.state["file_path"])
+            continue
+        if job.is_spooled() and time.time() - job.state["created"] < JOURNAL_RETRY_WINDOW:
+            # An upload whose sender never got an answer. Its sender sends it again,
+            # which takes the job over, so resuming it here would run it twice.
+            job.release()
+            continue
+        if job.state["resumes"] >= JOURNAL_MAX_RESUMES:
+            job.give_up("resumed %d times without success" % job.state["resumes"])
+            continue
+
+        job.state["resumes"] += 1
+        job.save()
+        state = job.state
+        try:
+            with app.app_context():
+                g.request_id = state.get("request_id") or uuid.uuid4().hex
+                g.requested_priority = state.get("priority")
+                g.requested_hayabusa_profile = state.get("hayabusa_profile")
+                log_event(
+                    "job_resume", job=state["id"], pipeline=state["pipeline"],
+                    filename=state["filename"], completed_stages=list(state["stages"]),
+                )
+                workflow_id, run = run_pipeline(
+                    state["pipeline"], state["file_path"], state["filename"], job=job
+                )
+        except Exception as e:
+            print("Error resuming %s through %s: %s" % (state["filename"], state["pipeline"], e))
+            continue
+        print("Resumed %s through %s as workflow %s" % (state["filename"], state["pipeline"], workflow_id))
+        if not job.is_spooled():
+            # A drop-folder file, which is removed once it is in OpenRelik.
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(state["file_path"])
+            claim_dir = os.path.dirname(state["file_path"])
+            if os.path.basename(claim_dir).startswith("claim-"):
+                with contextlib.suppress(OSError):
+                    os.rmdir(claim_dir)
+
+
+def watch_journal():
+    """
+    Periodically resume journaled jobs left behind by stopped processes.
+    """
+    while True:
+        if not draining.is_set():
+            try:
+                resume_orphaned_jobs()
+            except Exception as e:
+                print("Error resuming journaled jobs in %s: %s" % (JOURNAL_DIR, e))
+        time.sleep(JOURNAL_RESUME_INTERVAL)
+
+
+def start_journal_watcher():
+    """
+    Start resuming journaled jobs in the background.
+    """
+    watcher = threading.Thread(target=watch_journal, name="journal-watcher", daemon=True)
+    watcher.start()
+    return watcher
 
 
 # --------------------------------------------------------------------------------
-# Error handlers
+# Admission control
 # --------------------------------------------------------------------------------
-@app.errorhandler(400)
-def bad_request(error):
+PRIORITIES = ("high", "normal")
+
+
+def resolve_priority(label=None, requested=None):
     """
-    Return a 400 error for a Bad Request.
+    Return the priority of a run: the requested one if valid, "high" for labels
+    matching HIGH_PRIORITY_LABELS, "normal" otherwise.
     """
-    return "Bad Request!", 400
+    if requested in PRIORITIES:
+        return requested
+    if label and any(fnmatch.fnmatchcase(label, pattern) for pattern in HIGH_PRIORITY_LABELS):
+        return "high"
+    return "normal"
 
 
-@app.errorhandler(401)
-def unauthorized(error):
+def current_priority():
     """
-    Return a 401 error for an Unauthorized request.
+    Return the priority of the current pipeline run.
     """
-    return "Unauthorized!", 401
+    if has_app_context():
+        return g.get("priority", "normal")
+    return "normal"
 
 
-@app.errorhandler(403)
-def forbidden(error):
+class AdmissionController:
     """
-    Return a 403 error for a Forbidden request.
+    Count the uploads being handled and refuse new ones beyond `limit`, so a
+    burst is pushed back to the senders instead of piling up in this process.
+
+    When all slots are taken, callers may wait for one. Waiting callers are
+    served by priority, then by weighted fair queuing across flows (labels or
+    clients): each caller gets a virtual finish time one 1/weight step after
+    its flow's previous one, so a busy flow can't starve the others.
     """
-    return "Forbidden!", 403
 
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = []
+        self.arrivals = itertools.count()
+        self.virtual_time = 0.0
+        self.flow_finish = {}
+        self.condition = threading.Condition()
 
-@app.errorhandler(404)
-def page_not_found(error):
+    def acquire(self, priority="normal", timeout=0, flow=None, weight=1.0):
+        """
+        Take a slot, waiting up to `timeout` seconds for one (None waits forever).
+        Returns False if no slot became available in time.
+        """
+        with self.condition:
+            if not self.limit:
+                self.in_flight += 1
+                return True
+
+            finish = max(self.virtual_time, self.flow_finish.get(flow, 0.0)) + 1.0 / weight
+            self.flow_finish[flow] = finish
+            if len(self.flow_finish) > 10000:
+                self.flow_finish = {
+                    key: value for key, value in self.flow_finish.items() if value > self.virtual_time
+                }
+            ticket = (PRIORITIES.index(priority), finish, next(self.arrivals))
+            heapq.heappush(self.waiting, ticket)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                while self.in_flight >= self.limit or self.waiting[0] != ticket:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.in_flight += 1
+                self.virtual_time = max(self.virtual_time, finish)
+                return True
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def snapshot(self):
+        with self.condition:
+            return {"limit": self.limit, "in_flight": self.in_flight, "waiting": len(self.waiting)}
+
+
+admission = AdmissionController(MAX_INFLIGHT_UPLOADS)
+
+
+# The filename of the uploaded file, in the part headers at the start of a multipart body
+UPLOAD_FILENAME_PATTERN = re.compile(
+    rb'^content-disposition:[^\r\n]*\bname="file"[^\r\n]*\bfilename="([^"\r\n]*)"',
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def peek_upload_filename():
     """
-    Return a 404 error for a Page Not Found.
+    Return the filename of the upload from the first bytes of the request body,
+    without consuming them, or None if it isn't in there. The request stream is
+    swapped for a buffered one, which the form parser reads from later on.
     """
-    return "Page Not Found!", 404
+    if request.mimetype != "multipart/form-data":
+        return None
+    stream = io.BufferedReader(request.stream, buffer_size=64 * 1024)
+    request.stream = stream
+    match = UPLOAD_FILENAME_PATTERN.search(stream.peek(64 * 1024))
+    return match.group(1).decode("utf-8", "replace") if match else None
 
 
-@app.errorhandler(405)
-def method_not_allowed(error):
+def rate_limit_unpeeked_label(filename):
     """
-    Return a 405 error for Method Not Allowed.
+    Count an upload against its label's rate limit once its body was read, if its
+    filename wasn't found at the start of the body. Others were counted on admission.
     """
-    return "Method Not Allowed!", 405
+    if g.get("peeked_filename") is None:
+        rate_limit_label(filename)
 
 
-@app.errorhandler(413)
-def request_entity_too_large(error):
+def admitted(route):
     """
-    Return a 413 error if the file or payload exceeds the maximum allowed size.
+    Only run the decorated upload route once there is room for another upload.
+    While draining, every upload gets a 503 with Retry-After.
+    Clients and labels over their rate limit get a 429. Others wait up to
+    ADMISSION_QUEUE_TIMEOUT for a slot, then get a 503. Both come with Retry-After,
+    before the body is read. The requested priority is kept for the pipeline run.
+    The label is taken from the filename at the start of the body, so high-priority
+    labels are admitted first.
     """
-    return "File is too large!", 413
 
+    @functools.wraps(route)
+    def wrapper(*args, **kwargs):
+        if draining.is_set():
+            return retry_later("Pipeline is restarting, retry later", DRAIN_RETRY_AFTER)
 
-@app.errorhandler(500)
-def internal_server_error(error):
+        requested = request.args.get("priority") or request.headers.get("X-Priority")
+        if requested is not None and requested not in PRIORITIES:
+            return jsonify({"error": "priority must be one of: %s" % ", ".join(PRIORITIES)}), 400
+        g.requested_priority = requested
+
+        client = request.remote_addr
+        client_limiter.take(client)
+        filename = peek_upload_filename()
+        g.peeked_filename = filename
+        if filename:
+            rate_limit_label(filename)
+        fqdn, label = extract_fqdn_and_label(filename) if filename else (None, None)
+        if not admission.acquire(
+            resolve_priority(label, requested), ADMISSION_QUEUE_TIMEOUT,
+            flow=f"client:{client}", weight=fair_share_weight("client", client),
+        ):
+            return retry_later("Pipeline is saturated, retry later", SATURATED_RETRY_AFTER)
+        try:
+            return route(*args, **kwargs)
+        finally:
+            admission.release()
+
+    return wrapper
+
+
+# --------------------------------------------------------------------------------
+# Upload compression
+# --------------------------------------------------------------------------------
+# Every Windows event log starts with this file header signature
+EVTX_MAGIC = b"ElfFile\x00"
+
+
+def copy_upload(source, destination, digest=None):
     """
-    Return a 500 error for Internal Server Error.
+    Copy an upload in 1 MiB chunks, feeding them to `digest` if given.
     """
-    return "Internal Server Error!", 500
+    while chunk := source.read(1024 * 1024):
+        if digest is not None:
+            digest.update(chunk)
+        destination.write(chunk)
 
 
-@app.errorhandler(503)
-def service_unavailable(error):
+def write_upload(stream, file_path, compress):
     """
-    Return a 503 error for Service Unavailable.
+    Write an upload to `file_path`, or deflated into `<file_path>.zip` if `compress`
+    and it is a raw event log. Returns the path written, the upload's digest with
+    JOURNAL_DIR (None otherwise) and, if it was deflated, its original size.
     """
-    return "Service Unavailable!", 503
+    head = stream.read(len(EVTX_MAGIC))
+    # With JOURNAL_DIR, the upload's digest lets a retry of it take over its journal
+    digest = hashlib.blake2b(head) if JOURNAL_DIR else None
+    if not (compress and head == EVTX_MAGIC):
+        with open(file_path, "wb") as fh:
+            fh.write(head)
+            copy_upload(stream, fh, digest)
+        return file_path, digest and digest.hexdigest(), None
+
+    member = os.path.basename(file_path)
+    if not member.lower().endswith(".evtx"):
+        # The extraction task only picks up *.evtx
+        member += ".evtx"
+    zip_path = file_path + ".zip"
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as archive:
+        with archive.open(member, "w", force_zip64=True) as fh:
+            fh.write(head)
+            copy_upload(stream, fh, digest)
+        original_size = archive.getinfo(member).file_size
+    return zip_path, digest and digest.hexdigest(), original_size
+
+
+def save_upload(file, file_path, compress=False):
+    """
+    Save an uploaded file to `file_path`. With `compress` and COMPRESS_UPLOADS, a raw
+    event log is deflated into `<file_path>.zip` instead, so the pipelines upload the
+    zip and extract it in OpenRelik. Returns the path the upload was saved to.
+
+    Deflating (and hashing, with JOURNAL_DIR) a multi-GB upload keeps a CPU busy
+    for a while, so under gevent it runs on a real thread.
+    """
+    with span("save_upload", filename=file.filename):
+        saved_path, g.upload_digest, original_size = run_off_event_loop(
+            write_upload, file.stream, file_path, compress and COMPRESS_UPLOADS
+        )
+    if original_size is not None:
+        log_event(
+            "compressed_upload", filename=file.filename, bytes=original_size,
+            compressed_bytes=os.path.getsize(saved_path),
+        )
+    return saved_path
 
 
 # --------------------------------------------------------------------------------
 # Routes
 # --------------------------------------------------------------------------------
+UNCHANGED_COLLECTION_MESSAGE = "No artifacts changed since the last collection of this host, nothing to process"
+
+
+def request_hayabusa_profile():
+    """
+    Keep the Hayabusa profile requested with ?profile= or X-Hayabusa-Profile for
+    the pipeline run. Returns an error response if it doesn't exist.
+    """
+    requested = request.args.get("profile") or request.headers.get("X-Hayabusa-Profile")
+    if requested is not None and requested not in hayabusa_profiles:
+        return jsonify({"error": "profile must be one of: %s" % ", ".join(sorted(hayabusa_profiles))}), 400
+    g.requested_hayabusa_profile = requested
+    return None
+
+
 @app.route("/api/hayabusa/timesketch", methods=["POST"])
+@admitted
 def api_hayabusa_timesketch():
     """
     Endpoint to handle file uploads, create a workflow, and run it.
     """
+    error = request_hayabusa_profile()
+    if error:
+        return error
     if "file" not in request.files:
         return jsonify({"error": "No file provided"}), 400
 
     file = request.files["file"]
     filename = file.filename
-    timeline_name, extension = os.path.splitext(filename)
-    file_path = os.path.join("/tmp", filename)
-    file.save(file_path)
-    fqdn, label = extract_fqdn_and_label(filename)
-
-    # If a label is part of the filename, check to see if sketch exists with the same name and add it to it instead of creating a new sketch
-    sketch_id = ""
-    if fqdn and label and label != "Null":
-        sketch_name = label
-        timeline_name = fqdn
-    else:
-        sketch_name = filename
+    rate_limit_unpeeked_label(filename)
+    file_path = save_upload(file, spool_path(filename), compress=True)
 
-    try:
-        sketches = ts_client.list_sketches()
-        for sketch in sketches:
-            if sketch.name == sketch_name:
-                sketch_id = sketch.id
-    except Exception as e:
-        print("Error communicating with timesketch API: %s" % (e))
-
-    folder_id = create_folder(f"{filename} Hayabusa Timelines")
-    file_id = upload_file(file_path, folder_id)
-    workflow_id, workflow_folder_id = create_workflow(folder_id, [file_id])
-
-    rename_folder(
-        workflow_folder_id, f"{filename} Hayabusa to Timesketch Workflow Folder"
-    )
-    rename_workflow(
-        folder_id, workflow_id, f"{filename} Hayabusa to Timesketch Workflow"
-    )
-
-    if zipfile.is_zipfile(file_path):
-        add_hayabusa_extract_ts_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name)
-    else:
-        add_hayabusa_ts_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name)
-    run = run_workflow(folder_id, workflow_id)
+    workflow_id, run = run_pipeline("hayabusa-timesketch", file_path, filename)
+    if workflow_id is None:
+        return jsonify({"message": UNCHANGED_COLLECTION_MESSAGE})
 
     return jsonify(
         {
             "message": "Hayabusa to Timesketch Workflow(s) started successfully",
+            "workflow_id": workflow_id,
         }
     )
 
 
 @app.route("/api/hayabusa", methods=["POST"])
+@admitted
 def api_hayabusa():
     """
     Endpoint to handle file uploads, create a workflow, and run it.
     """
+    error = request_hayabusa_profile()
+    if error:
+        return error
     if "file" not in request.files:
         return jsonify({"error": "No file provided"}), 400
 
     file = request.files["file"]
     filename = file.filename
+    rate_limit_unpeeked_label(filename)
 
-    file_path = os.path.join("/tmp", filename)
-    file.save(file_path)
-
-    folder_id = create_folder(f"{filename} Hayabusa Timelines")
-    file_id = upload_file(file_path, folder_id)
-    workflow_id, workflow_folder_id = create_workflow(folder_id, [file_id])
-
-    rename_folder(workflow_folder_id, f"{filename} Hayabusa Workflow Folder")
-    rename_workflow(folder_id, workflow_id, f"{filename} Hayabusa Workflow")
+    file_path = save_upload(file, spool_path(filename), compress=True)
 
-    if zipfile.is_zipfile(file_path):
-        add_hayabusa_extract_tasks_to_workflow(folder_id, workflow_id, filename)
-    else:
-        add_hayabusa_tasks_to_workflow(folder_id, workflow_id)
-    run = run_workflow(folder_id, workflow_id)
+    workflow_id, run = run_pipeline("hayabusa", file_path, filename)
+    if workflow_id is None:
+        return jsonify({"message": UNCHANGED_COLLECTION_MESSAGE})
 
     return jsonify(
         {
             "message": "Hayabusa Workflow(s) started successfully",
+            "workflow_id": workflow_id,
         }
     )
 
 
 @app.route("/api/plaso/timesketch", methods=["POST"])
+@admitted
 def api_plaso_timesketch():
     """
     Endpoint to handle file uploads, create a workflow, and run it.
@@ -1151,37 +4498,13 @@ def api_plaso_timesketch():
 
     file = request.files["file"]
     filename = file.filename
-    timeline_name, extension = os.path.splitext(filename)
-    fqdn, label = extract_fqdn_and_label(filename)
-
-    # If a label is part of the filename, check to see if sketch exists with the same name and add it to it instead of creating a new sketch
-    sketch_id = ""
-    if fqdn and label and label != "Null":
-        sketch_name = label
-        timeline_name = fqdn
-    else:
-        sketch_name = filename
-
-    try:
-        sketches = ts_client.list_sketches()
-        for sketch in sketches:
-            if sketch.name == sketch_name:
-                sketch_id = sketch.id
-    except Exception as e:
-        print("Error communicating with timesketch API: %s" % (e))
-
-    file_path = os.path.join("/tmp", filename)
-    file.save(file_path)
-
-    folder_id = create_folder(f"{filename} Plaso Timeline")
-    file_id = upload_file(file_path, folder_id)
-    workflow_id, workflow_folder_id = create_workflow(folder_id, [file_id])
+    rate_limit_unpeeked_label(filename)
 
-    rename_folder(workflow_folder_id, f"{filename} Plaso to Timesketch Workflow Folder")
-    rename_workflow(folder_id, workflow_id, f"{filename} Plaso to Timesketch Workflow")
+    file_path = save_upload(file, spool_path(filename))
 
-    add_plaso_ts_tasks_to_workflow(folder_id, workflow_id, sketch_name, sketch_id, timeline_name)
-    run = run_workflow(folder_id, workflow_id)
+    workflow_id, run = run_pipeline("plaso-timesketch", file_path, filename)
+    if workflow_id is None:
+        return jsonify({"message": UNCHANGED_COLLECTION_MESSAGE})
 
     return jsonify(
         {
@@ -1193,6 +4516,7 @@ def api_plaso_timesketch():
 
 
 @app.route("/api/plaso", methods=["POST"])
+@admitted
 def api_plaso():
     """
     Endpoint to handle file uploads, create a workflow, and run it.
@@ -1202,19 +4526,13 @@ def api_plaso():
 
     file = request.files["file"]
     filename = file.filename
+    rate_limit_unpeeked_label(filename)
 
-    file_path = os.path.join("/tmp", filename)
-    file.save(file_path)
+    file_path = save_upload(file, spool_path(filename))
 
-    folder_id = create_folder(f"{filename} Plaso Timeline")
-    file_id = upload_file(file_path, folder_id)
-    workflow_id, workflow_folder_id = create_workflow(folder_id, [file_id])
-
-    rename_folder(workflow_folder_id, f"{filename} Plaso Workflow Folder")
-    rename_workflow(folder_id, workflow_id, f"{filename} Plaso Workflow")
-
-    add_plaso_tasks_to_workflow(folder_id, workflow_id)
-    run = run_workflow(folder_id, workflow_id)
+    workflow_id, run = run_pipeline("plaso", file_path, filename)
+    if workflow_id is None:
+        return jsonify({"message": UNCHANGED_COLLECTION_MESSAGE})
 
     return jsonify(
         {
@@ -1225,6 +4543,368 @@ def api_plaso():
     )
 
 
+# --------------------------------------------------------------------------------
+# Result retrieval
+# --------------------------------------------------------------------------------
+def safe_name(value):
+    return re.sub(r"[^A-Za-z0-9._-]", "_", str(value))
+
+
+def workflow_index_path(workflow_id, backend_name):
+    return os.path.join(
+        RESULTS_CACHE_DIR, "workflows", f"{int(workflow_id)}.{safe_name(backend_name)}.json"
+    )
+
+
+def remember_workflow(workflow_id, folder_id):
+    """
+    Record which backend and folder a workflow was created in, so its results can
+    be fetched by workflow ID alone.
+    """
+    backend = current_backend()
+    path = workflow_index_path(workflow_id, backend.name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as fh:
+        json.dump({"backend": backend.name, "folder_id": folder_id}, fh)
+    os.replace(fh.name, path)
+
+
+def locate_workflow(workflow_id):
+    """
+    Return the backend and folder ID of a workflow, or (None, None) if unknown.
+    Workflows created by this pipeline are looked up in the index. Others need
+    `?folder_id=`, plus `?backend=` when there are several backends, and the
+    DEBUG_TOKEN: they could be anyone's, and are read with the pipeline's API key.
+    """
+    by_name = {backend.name: backend for backend in backends}
+    backend_name = request.args.get("backend")
+    if backend_name is not None and backend_name not in by_name:
+        return None, None
+    candidates = [by_name[backend_name]] if backend_name else backends
+
+    folder_id = request.args.get("folder_id", type=int)
+    if folder_id is not None:
+        if not has_debug_token():
+            return None, None
+        return candidates[0], folder_id
+
+    found = []
+    for backend in candidates:
+        try:
+            with open(workflow_index_path(workflow_id, backend.name)) as fh:
+                found.append((backend, json.load(fh)["folder_id"]))
+        except FileNotFoundError:
+            continue
+    if len(found) != 1:
+        return None, None
+    return found[0]
+
+
+UNKNOWN_WORKFLOW_MESSAGE = (
+    "Unknown workflow. Workflows this pipeline didn't create need ?folder_id= "
+    "(and ?backend= if there are several backends) and the debug token"
+)
+
+
+def list_output_files(backend, folder_id, workflow_id):
+    """
+    Return the output files of a workflow's tasks.
+    """
+    workflow = call_upstream(
+        backend.openrelik_upstream, "get_workflow", backend.workflows_api.get_workflow,
+        folder_id, workflow_id,
+    )
+    return workflow_output_files(workflow)
+
+
+def cached_result_path(backend, file_id):
+    return os.path.join(RESULTS_CACHE_DIR, "files", safe_name(backend.name), str(int(file_id)))
+
+
+def load_cached_result(backend, file_id):
+    """
+    Return the metadata of a cached output file and mark it as recently used,
+    or None if it isn't cached.
+    """
+    path = cached_result_path(backend, file_id)
+    try:
+        with open(path + ".json") as fh:
+            meta = json.load(fh)
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return meta
+
+
+def fetch_result(backend, file_id, meta):
+    """
+    Stream an output file from OpenRelik into the cache, then evict the least
+    recently used files above RESULTS_CACHE_MAX_BYTES.
+    """
+    path = cached_result_path(backend, file_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with span("fetch_result", file_id=file_id, backend=backend.name):
+        temp_path = download_output_file(backend, file_id, os.path.dirname(path))
+    with open(path + ".json", "w") as fh:
+        json.dump(meta, fh)
+    os.replace(temp_path, path)
+    evict_results(keep=path)
+
+
+def stream_result(backend, file_id, meta, size, lock):
+    """
+    Stream an output file from OpenRelik to the client while it is written into
+    the cache, so the client doesn't wait for the whole download. `lock` is
+    released once the response is closed. Concurrent requests for the file wait
+    for it and are then served from the cache.
+    """
+    path = cached_result_path(backend, file_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    upstream = call_upstream(
+        backend.openrelik_upstream, "download_file", request_output_file, backend, file_id
+    )
+    fh = tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(path), prefix=".tmp-", delete=False)
+    complete = False
+
+    def generate():
+        nonlocal complete
+        for chunk in upstream.iter_content(chunk_size=1024 * 1024):
+            fh.write(chunk)
+            yield chunk
+        fh.close()
+        with open(path + ".json", "w") as meta_fh:
+            json.dump(meta, meta_fh)
+        os.replace(fh.name, path)
+        complete = True
+        evict_results(keep=path)
+
+    def cleanup():
+        upstream.close()
+        fh.close()
+        if not complete:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(fh.name)
+        lock.release()
+
+    response = Response(generate(), mimetype="application/octet-stream")
+    response.headers.set("Content-Disposition", "attachment", filename=meta["filename"] or str(file_id))
+    response.set_etag(f"{safe_name(backend.name)}-{file_id}")
+    if size is not None:
+        response.content_length = size
+    response.call_on_close(cleanup)
+    return response
+
+
+def evict_results(keep=None):
+    """
+    Remove cached output files, least recently used first, until the cache fits
+    RESULTS_CACHE_MAX_BYTES. `keep` is never removed, so a file larger than the
+    whole cache can still be served once.
+    """
+    entries = []
+    for root, dirs, files in os.walk(os.path.join(RESULTS_CACHE_DIR, "files")):
+        for name in files:
+            if name.endswith(".json") or name.startswith(".tmp-"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= RESULTS_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        for victim in (path, path + ".json"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(victim)
+        total -= size
+        log_event("result_evicted", path=path, bytes=size)
+
+
+@app.route("/api/workflows/<int:workflow_id>/results", methods=["GET"])
+def api_workflow_results(workflow_id):
+    """
+    List the output files of a workflow, with the URL to download each one from.
+    """
+    backend, folder_id = locate_workflow(workflow_id)
+    if backend is None:
+        return jsonify({"error": UNKNOWN_WORKFLOW_MESSAGE}), 404
+    with use_backend(backend):
+        files = list_output_files(backend, folder_id, workflow_id)
+    for output in files:
+        output["cached"] = load_cached_result(backend, output["id"]) is not None
+        output["url"] = f"/api/workflows/{workflow_id}/results/{output['id']}"
+    return jsonify({"workflow_id": workflow_id, "backend": backend.name, "files": files})
+
+
+@app.route("/api/workflows/<int:workflow_id>/results/<int:file_id>", methods=["GET"])
+def api_workflow_result(workflow_id, file_id):
+    """
+    Download an output file of a workflow. Supports Range requests.
+    Cached files are served without asking OpenRelik. Uncached files are streamed
+    through while they are cached, Range requests for them wait for the whole file.
+    """
+    backend, folder_id = locate_workflow(workflow_id)
+    if backend is None:
+        return jsonify({"error": UNKNOWN_WORKFLOW_MESSAGE}), 404
+
+    meta = load_cached_result(backend, file_id)
+    hit = meta is not None and meta["workflow_id"] == workflow_id
+    log_event("result_cache", hit=hit, file_id=file_id, backend=backend.name)
+    if not hit:
+        # One download per file, concurrent requests for it wait and then share it
+        lock = key_lock(("result", backend.name, file_id))
+        lock.acquire()
+        streaming = False
+        try:
+            meta = load_cached_result(backend, file_id)
+            if meta is None or meta["workflow_id"] != workflow_id:
+                with use_backend(backend):
+                    outputs = list_output_files(backend, folder_id, workflow_id)
+                    output = next((output for output in outputs if output["id"] == file_id), None)
+                    if output is None:
+                        return jsonify({"error": "No such output file in this workflow"}), 404
+                    meta = {"workflow_id": workflow_id, "filename": output["filename"]}
+                    if request.range is None:
+                        response = stream_result(backend, file_id, meta, output["size"], lock)
+                        streaming = True
+                        return response
+                    fetch_result(backend, file_id, meta)
+        finally:
+            if not streaming:
+                lock.release()
+
+    return send_file(
+        cached_result_path(backend, file_id),
+        as_attachment=True,
+        download_name=meta["filename"] or str(file_id),
+        etag=f"{safe_name(backend.name)}-{file_id}",
+        conditional=True,
+    )
+
+
+# --------------------------------------------------------------------------------
+# Debug routes
+# --------------------------------------------------------------------------------
+def has_debug_token():
+    """
+    Whether the request carries DEBUG_TOKEN as a bearer token.
+    """
+    return bool(DEBUG_TOKEN) and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {DEBUG_TOKEN}"
+    )
+
+
+def require_debug_token():
+    """
+    Abort unless the request carries DEBUG_TOKEN as a bearer token.
+    The debug routes don't exist at all when no DEBUG_TOKEN is configured.
+    """
+    if not DEBUG_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {DEBUG_TOKEN}"):
+        abort(401)
+
+
+@app.route("/debug/profile", methods=["GET", "POST", "DELETE"])
+def debug_profile():
+    """
+    Arm profiling for the next N requests (POST), disarm it (DELETE), or show the
+    current state and the captured profiles (GET).
+    """
+    require_debug_token()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    control_path = os.path.join(PROFILE_DIR, "control.json")
+
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        mode = body.get("mode", "cprofile")
+        if mode not in ("cprofile", "sampling"):
+            return jsonify({"error": "mode must be 'cprofile' or 'sampling'"}), 400
+        try:
+            remaining = int(body.get("requests", 1))
+        except (TypeError, ValueError):
+            return jsonify({"error": "requests must be an integer"}), 400
+        control = {
+            "remaining": remaining,
+            "mode": mode,
+            "tracemalloc": bool(body.get("tracemalloc", False)),
+        }
+        with open(control_path, "a+") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            fh.truncate()
+            json.dump(control, fh)
+    elif request.method == "DELETE" and os.path.exists(control_path):
+        os.remove(control_path)
+
+    control = None
+    if os.path.exists(control_path):
+        with open(control_path) as fh:
+            fcntl.flock(fh, fcntl.LOCK_SH)
+            control = json.load(fh)
+    profiles = sorted(name for name in os.listdir(PROFILE_DIR) if name != "control.json")
+    return jsonify({"control": control, "profiles": profiles})
+
+
+@app.route("/debug/profile/<path:name>", methods=["GET"])
+def debug_profile_download(name):
+    """
+    Download a captured profile.
+    """
+    require_debug_token()
+    return send_from_directory(PROFILE_DIR, name, as_attachment=True)
+
+
+@app.route("/debug/limits", methods=["GET"])
+def debug_limits():
+    """
+    Show the admission queue, who is being throttled per label and per client, and
+    the adaptive concurrency limit of each upstream. Counters are kept per worker process.
+    """
+    require_debug_token()
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "admission": admission.snapshot(),
+            "labels": label_limiter.snapshot(),
+            "clients": client_limiter.snapshot(),
+            "upstreams": {name: limiter.snapshot() for name, limiter in adaptive_limiters.items()},
+        }
+    )
+
+
+@app.route("/debug/cache", methods=["GET"])
+def debug_cache():
+    """
+    Show the hit rate of the lookup caches. Counters are kept per worker process.
+    """
+    require_debug_token()
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "folders": folder_cache.stats(),
+            "sketches": sketch_cache.stats(),
+        }
+    )
+
+
+install_drain_handler()
+if INGEST_DIR:
+    start_ingest_watcher()
+if JOURNAL_DIR:
+    start_journal_watcher()
+if DEDUP_EVENTS:
+    start_dedup_watcher()
+if MERGE_TIMELINES:
+    start_merge_watcher()
+
+
 # --------------------------------------------------------------------------------
 # Main entry point
 # --------------------------------------------------------------------------------
@@ -0,0 +1,237 @@
+"""
+Lightweight stand-ins for OpenRelik and Timesketch.
+
+They implement just enough of both APIs for the pipeline routes to run end to
+end: folders, chunked uploads, workflows and their output files for OpenRelik,
+login and sketches for Timesketch. Every request can be delayed and a fraction of them can fail
+with a 503, to see how the pipeline behaves against a slow or flaky upstream.
+
+Run standalone with:
+    python benchmarks/fake_servers.py --openrelik-port 18710 --timesketch-port 18000
+"""
+import argparse
+import itertools
+import logging
+import random
+import threading
+import time
+
+from flask import Flask, jsonify, redirect, request
+from werkzeug.serving import make_server
+
+
+def add_fault_injection(app, latency, jitter, failure_rate):
+    """
+    Delay every API request by `latency` +/- `jitter` seconds and answer a
+    `failure_rate` fraction of them with a 503. Login pages are left alone so
+    clients can always connect.
+    """
+    app.stats = {"requests": 0, "failures": 0}
+    stats_lock = threading.Lock()
+
+    @app.before_request
+    def inject_faults():
+        if not request.path.startswith("/api/"):
+            return None
+        delay = latency + random.uniform(-jitter, jitter)
+        if delay > 0:
+            time.sleep(delay)
+        with stats_lock:
+            app.stats["requests"] += 1
+            if random.random() < failure_rate:
+                app.stats["failures"] += 1
+                return "Service Unavailable!", 503
+
+
+def make_openrelik_app(latency=0.0, jitter=0.0, failure_rate=0.0):
+    """
+    Build a fake OpenRelik API server.
+    """
+    app = Flask("fake-openrelik")
+    ids = itertools.count(1)
+    folders = {}
+    workflows = {}
+    output_files = {}
+    lock = threading.Lock()
+    add_fault_injection(app, latency, jitter, failure_rate)
+
+    def new_folder(display_name, parent_id=None):
+        with lock:
+            folder = {"id": next(ids), "display_name": display_name, "parent_id": parent_id}
+            folders[folder["id"]] = folder
+        return folder
+
+    @app.route("/api/v1/folders/", methods=["POST"])
+    def create_root_folder():
+        return jsonify(new_folder(request.json["display_name"])), 201
+
+    @app.route("/api/v1/folders/all/", methods=["GET"])
+    def list_root_folders():
+        roots = [folder for folder in folders.values() if folder["parent_id"] is None]
+        return jsonify({"folders": roots})
+
+    @app.route("/api/v1/folders/<int:folder_id>", methods=["GET", "PATCH"])
+    def folder(folder_id):
+        if folder_id not in folders:
+            return jsonify({"detail": "Folder not found"}), 404
+        if request.method == "PATCH":
+            folders[folder_id].update(request.json)
+        return jsonify(folders[folder_id])
+
+    @app.route("/api/v1/folders/<int:folder_id>/folders/", methods=["GET", "POST"])
+    def subfolders(folder_id):
+        if request.method == "POST":
+            return jsonify(new_folder(request.json["display_name"], folder_id)), 201
+        children = [folder for folder in folders.values() if folder["parent_id"] == folder_id]
+        return jsonify(children)
+
+    @app.route("/api/v1/files/upload", methods=["POST"])
+    def upload_chunk():
+        # Drain the chunk like the real server would, without keeping it.
+        stream = request.files["file"].stream
+        while stream.read(1024 * 1024):
+            pass
+        if request.args["resumableChunkNumber"] != request.args["resumableTotalChunks"]:
+            return "", 200
+        with lock:
+            file_id = next(ids)
+        return jsonify({"id": file_id}), 201
+
+    @app.route("/api/v1/folders/<int:folder_id>/workflows/", methods=["POST"])
+    def create_workflow(folder_id):
+        workflow_folder = new_folder("Workflow folder", folder_id)
+        with lock:
+            workflow = {
+                "id": next(ids),
+                "display_name": "Untitled workflow",
+                "folder": {"id": workflow_folder["id"]},
+                "files": request.json["file_ids"],
+                "spec_json": "{}",
+                "tasks": [],
+            }
+            workflows[workflow["id"]] = workflow
+        return jsonify(workflow)
+
+    @app.route("/api/v1/folders/<int:folder_id>/workflows/<int:workflow_id>", methods=["GET", "PATCH"])
+    def workflow(folder_id, workflow_id):
+        if workflow_id not in workflows:
+            return jsonify({"detail": "Workflow not found"}), 404
+        if request.method == "PATCH":
+            workflows[workflow_id].update(request.json)
+        return jsonify(workflows[workflow_id])
+
+    @app.route("/api/v1/folders/<int:folder_id>/workflows/<int:workflow_id>/run/", methods=["POST"])
+    def run_workflow(folder_id, workflow_id):
+        if workflow_id not in workflows:
+            return jsonify({"detail": "Workflow not found"}), 404
+        # Pretend the workflow finished at once with one output file.
+        with lock:
+            file_id = next(ids)
+            output_files[file_id] = f"workflow {workflow_id} output\n".encode() * 4096
+            workflows[workflow_id]["tasks"] = [
+                {
+                    "display_name": "Workflow task",
+                    "status_short": "SUCCESS",
+                    "output_files": [
+                        {
+                            "id": file_id,
+                            "display_name": f"workflow-{workflow_id}.csv",
+                            "filesize": len(output_files[file_id]),
+                        }
+                    ],
+                }
+            ]
+        return jsonify(workflows[workflow_id])
+
+    @app.route("/api/v1/files/<int:file_id>/download_stream", methods=["GET"])
+    def download_stream(file_id):
+        if file_id not in output_files:
+            return jsonify({"detail": "File not found"}), 404
+        app.stats["downloads"] = app.stats.get("downloads", 0) + 1
+        return output_files[file_id], 200, {"Content-Type": "application/octet-stream"}
+
+    app.folders = folders
+    app.workflows = workflows
+    app.output_files = output_files
+    return app
+
+
+def make_timesketch_app(latency=0.0, jitter=0.0, failure_rate=0.0):
+    """
+    Build a fake Timesketch server.
+    """
+    app = Flask("fake-timesketch")
+    ids = itertools.count(1)
+    sketches = {}
+    lock = threading.Lock()
+    add_fault_injection(app, latency, jitter, failure_rate)
+
+    @app.route("/login/", methods=["GET"])
+    def login_form():
+        return '<form><input id="csrf_token" name="csrf_token" value="fake-token"></form>'
+
+    @app.route("/login/", methods=["POST"])
+    def login():
+        return redirect("/")
+
+    @app.route("/", methods=["GET"])
+    def index():
+        return "Timesketch"
+
+    @app.route("/api/v1/sketches/", methods=["GET", "POST"])
+    def sketch_list():
+        if request.method == "POST":
+            with lock:
+                sketch = {"id": next(ids), "name": request.json["name"], "timelines": []}
+                sketches[sketch["id"]] = sketch
+            return jsonify({"objects": [sketch]}), 201
+        return jsonify({"objects": list(sketches.values()), "meta": {"next_page": None}})
+
+    @app.route("/api/v1/sketches/<int:sketch_id>/", methods=["GET"])
+    def sketch(sketch_id):
+        if sketch_id not in sketches:
+            return jsonify({"message": "Sketch not found"}), 404
+        return jsonify({"objects": [sketches[sketch_id]], "meta": {"stats_per_timeline": {}}})
+
+    @app.route("/api/v1/sketches/<int:sketch_id>/archive/", methods=["GET"])
+    def sketch_archive(sketch_id):
+        return jsonify({"meta": {"is_archived": False}})
+
+    app.sketches = sketches
+    return app
+
+
+def serve_in_background(app, host, port):
+    """
+    Serve `app` from a daemon thread. Returns the server so it can be shut down.
+    """
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--openrelik-port", type=int, default=18710)
+    parser.add_argument("--timesketch-port", type=int, default=18000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- seconds on top of --latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    faults = dict(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate)
+    serve_in_background(make_openrelik_app(**faults), args.host, args.openrelik_port)
+    serve_in_background(make_timesketch_app(**faults), args.host, args.timesketch_port)
+    print(
+        "Fake OpenRelik on http://%s:%d, fake Timesketch on http://%s:%d"
+        % (args.host, args.openrelik_port, args.host, args.timesketch_port),
+        flush=True,
+    )
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
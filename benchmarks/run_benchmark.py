@@ -0,0 +1,301 @@
+"""
+Benchmark the pipeline routes against local stand-in OpenRelik and Timesketch servers.
+
+The pipeline is started under Gunicorn exactly like in the container, pointed
+at the fake servers from fake_servers.py. Velociraptor-style bursts of
+`vr_kapefiles_<fqdn>_<label>.zip` uploads are replayed against every route
+and throughput, p50/p99 latency and the peak RSS of the pipeline processes
+are reported per route.
+
+Example:
+    python benchmarks/run_benchmark.py --sizes 1M,16M,64M --burst 50 --concurrency 20 --latency 0.02
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests_toolbelt import MultipartEncoder
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROUTES = ["/api/hayabusa", "/api/hayabusa/timesketch", "/api/plaso", "/api/plaso/timesketch"]
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(value):
+    """
+    Parse sizes like 512K, 16M or 1G into bytes.
+    """
+    value = value.strip().upper()
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process {process.args[:3]} exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def process_tree_rss(pid):
+    """
+    Resident set size in bytes of `pid` and all of its descendants (Linux only).
+    """
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # The command name may contain spaces, the parent PID follows the closing paren.
+                parents[int(entry)] = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {child for child, parent in parents.items() if parent in tree} - tree
+        tree |= children
+        changed = bool(children)
+
+    rss = 0
+    for member in tree:
+        try:
+            with open(f"/proc/{member}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return rss
+
+
+class RSSSampler(threading.Thread):
+    """
+    Track the peak RSS of a process tree until stopped.
+    """
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, process_tree_rss(self.pid))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def make_collection(directory, size):
+    """
+    Write a KAPE-like zip holding `size` bytes of incompressible data.
+    """
+    path = os.path.join(directory, f"collection-{size}.zip")
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as archive:
+        with archive.open("C/Windows/System32/winevt/Logs/Security.evtx", "w", force_zip64=True) as member:
+            remaining = size
+            while remaining > 0:
+                chunk = os.urandom(min(remaining, 1024 * 1024))
+                member.write(chunk)
+                remaining -= len(chunk)
+    return path
+
+
+def upload(url, path, filename):
+    """
+    Stream one file to a route. Returns (latency in seconds, status code or error).
+    """
+    started = time.perf_counter()
+    try:
+        with open(path, "rb") as fh:
+            encoder = MultipartEncoder({"file": (filename, fh, "application/zip")})
+            response = requests.post(
+                url, data=encoder, headers={"Content-Type": encoder.content_type}, timeout=3600
+            )
+        outcome = response.status_code
+    except requests.RequestException as e:
+        outcome = type(e).__name__
+    return time.perf_counter() - started, outcome
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def benchmark_route(base_url, route, collections, args, pipeline_pid):
+    """
+    Replay the configured bursts against one route and summarize them.
+    """
+    sampler = RSSSampler(pipeline_pid)
+    sampler.start()
+    latencies = []
+    outcomes = {}
+    total_bytes = 0
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        host_number = 0
+        for burst in range(args.bursts):
+            futures = []
+            for _ in range(args.burst):
+                size, path = collections[host_number % len(collections)]
+                filename = f"vr_kapefiles_host{host_number}.bench.local_{args.label}.zip"
+                futures.append(pool.submit(upload, base_url + route, path, filename))
+                total_bytes += size
+                host_number += 1
+            for future in futures:
+                latency, outcome = future.result()
+                latencies.append(latency)
+                outcomes[str(outcome)] = outcomes.get(str(outcome), 0) + 1
+            if burst + 1 < args.bursts:
+                time.sleep(args.burst_interval)
+
+    elapsed = time.perf_counter() - started
+    return {
+        "route": route,
+        "requests": len(latencies),
+        "outcomes": outcomes,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "throughput_mbps": total_bytes / (1024**2) / elapsed if elapsed else 0.0,
+        "p50_s": percentile(latencies, 0.50),
+        "p99_s": percentile(latencies, 0.99),
+        "peak_rss_mb": sampler.stop() / (1024**2),
+    }
+
+
+def print_report(results):
+    header = "%-26s %8s %9s %9s %9s %9s %10s  %s" % (
+        "route", "requests", "req/s", "MB/s", "p50 (s)", "p99 (s)", "RSS (MB)", "outcomes",
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            "%-26s %8d %9.2f %9.2f %9.3f %9.3f %10.1f  %s"
+            % (
+                result["route"],
+                result["requests"],
+                result["throughput_rps"],
+                result["throughput_mbps"],
+                result["p50_s"],
+                result["p99_s"],
+                result["peak_rss_mb"],
+                json.dumps(result["outcomes"], sort_keys=True),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--routes", default=",".join(ROUTES), help="Comma separated routes to benchmark")
+    parser.add_argument("--sizes", default="1M,16M", help="Comma separated collection sizes, cycled per upload")
+    parser.add_argument("--burst", type=int, default=20, help="Uploads per burst")
+    parser.add_argument("--bursts", type=int, default=3, help="Bursts per route")
+    parser.add_argument("--burst-interval", type=float, default=1.0, help="Seconds between bursts")
+    parser.add_argument("--concurrency", type=int, default=10, help="Concurrent uploads")
+    parser.add_argument("--label", default="bench", help="Velociraptor label put into the filenames")
+    parser.add_argument("--latency", type=float, default=0.0, help="Upstream latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Upstream latency jitter in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of upstream requests failing with 503")
+    parser.add_argument("--worker-class", default="gevent", help="Gunicorn worker class for the pipeline")
+    parser.add_argument("--workers", type=int, default=1, help="Gunicorn worker processes for the pipeline")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    openrelik_port, timesketch_port, pipeline_port = free_port(), free_port(), free_port()
+    processes = []
+    workdir = tempfile.mkdtemp(prefix="openrelik-pipeline-bench-")
+
+    try:
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable, os.path.join(REPO_DIR, "benchmarks", "fake_servers.py"),
+                    "--openrelik-port", str(openrelik_port),
+                    "--timesketch-port", str(timesketch_port),
+                    "--latency", str(args.latency),
+                    "--jitter", str(args.jitter),
+                    "--failure-rate", str(args.failure_rate),
+                ],
+                stdout=subprocess.DEVNULL,
+            )
+        )
+        wait_for_port(openrelik_port, processes[-1])
+        wait_for_port(timesketch_port, processes[-1])
+
+        env = dict(
+            os.environ,
+            OPENRELIK_API_URL=f"http://127.0.0.1:{openrelik_port}",
+            TIMESKETCH_URL=f"http://127.0.0.1:{timesketch_port}",
+            GUNICORN_BIND=f"127.0.0.1:{pipeline_port}",
+            GUNICORN_WORKER_CLASS=args.worker_class,
+            GUNICORN_WORKERS=str(args.workers),
+        )
+        pipeline = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--access-logfile", os.devnull, "app:app"],
+            cwd=REPO_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL,
+        )
+        processes.append(pipeline)
+        wait_for_port(pipeline_port, pipeline)
+
+        collections = []
+        for size in (parse_size(value) for value in args.sizes.split(",")):
+            collections.append((size, make_collection(workdir, size)))
+
+        results = []
+        for route in args.routes.split(","):
+            results.append(
+                benchmark_route(f"http://127.0.0.1:{pipeline_port}", route, collections, args, pipeline.pid)
+            )
+
+        print_report(results)
+        if args.json:
+            with open(args.json, "w") as fh:
+                json.dump({"arguments": vars(args), "results": results}, fh, indent=2)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
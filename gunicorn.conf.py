@@ -0,0 +1,22 @@
+# --------------------------------------------------------------------------------
+# Gunicorn configuration for the OpenRelik pipeline
+# --------------------------------------------------------------------------------
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+accesslog = "-"
+loglevel = "info"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+# On SIGTERM the pipeline drains: new uploads get 503 + Retry-After while in-flight
+# uploads get this many seconds to finish. Keep the container's stop timeout
+# (stop_grace_period in docker-compose.yml) above it.
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "300"))
+
+# "sync" serves one request per worker process. "gevent" runs every worker on an
+# event loop: the OpenRelik and Timesketch clients are monkey-patched to yield
+# while waiting on the network, so a single process can hold hundreds of slow
+# uploads at once. Request bodies are spooled to disk by Werkzeug, which keeps
+# memory flat regardless of how many uploads are in flight.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
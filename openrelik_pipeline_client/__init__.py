@@ -0,0 +1,15 @@
+"""
+Client library and command line tool for bulk submission to the OpenRelik pipeline.
+
+    from openrelik_pipeline_client import PipelineClient, walk
+
+    client = PipelineClient("http://pipeline:5000")
+    items = [{"path": path, "pipeline": "plaso-timesketch"} for path in walk(["/evidence"], "*.zip")]
+    for result in client.submit_many(items, workers=8):
+        print(result["path"], result["status"], result.get("workflow_id"))
+
+Run `python -m openrelik_pipeline_client --help` for the command line tool.
+"""
+from .client import ROUTES, PipelineClient, SubmissionState, read_manifest, walk
+
+__all__ = ["ROUTES", "PipelineClient", "SubmissionState", "read_manifest", "walk"]
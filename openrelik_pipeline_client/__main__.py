@@ -0,0 +1,128 @@
+"""
+Bulk-submit files to the OpenRelik pipeline.
+
+Walks directories (or reads a manifest), uploads the files concurrently and
+prints one status line per file. With --state, outcomes are recorded so a
+repeated run only sends files that haven't been submitted yet.
+
+Example:
+    python -m openrelik_pipeline_client --url http://pipeline:5000 --pipeline plaso-timesketch \
+        --pattern "*.zip" --label case-42 --workers 8 --state backfill.jsonl /mnt/evidence
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+from .client import ROUTES, PipelineClient, SubmissionState, read_manifest, walk
+
+
+def labelled_filename(path, label):
+    """
+    Name a zip `vr_kapefiles_<host>_<label>.zip`, so the pipeline files it under
+    the label's sketch with the file's stem as timeline name.
+    """
+    stem, extension = os.path.splitext(os.path.basename(path))
+    if extension.lower() != ".zip":
+        return None
+    host = re.sub(r"^vr_kapefiles_", "", stem).replace("_", "-")
+    return f"vr_kapefiles_{host}_{label}.zip"
+
+
+def build_items(args):
+    """
+    Turn the command line into submission items.
+    """
+    if args.manifest:
+        items = list(read_manifest(args.manifest))
+    else:
+        items = [{"path": path} for path in walk(args.paths, args.pattern)]
+
+    for item in items:
+        item.setdefault("pipeline", args.pipeline)
+        if args.priority:
+            item.setdefault("priority", args.priority)
+        if args.profile:
+            item.setdefault("profile", args.profile)
+        if args.label and "filename" not in item:
+            filename = labelled_filename(item["path"], args.label)
+            if filename:
+                item["filename"] = filename
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("paths", nargs="*", help="Files or directories to submit")
+    parser.add_argument(
+        "--url", default=os.getenv("OPENRELIK_PIPELINE_URL"), help="Pipeline URL (or OPENRELIK_PIPELINE_URL)"
+    )
+    parser.add_argument("--pipeline", choices=sorted(ROUTES), default="plaso-timesketch")
+    parser.add_argument("--manifest", help="Submit the files listed in this manifest instead of walking paths")
+    parser.add_argument("--pattern", default="*", help="Glob for files to pick up while walking directories")
+    parser.add_argument("--label", help="Upload zips as vr_kapefiles_<host>_<label>.zip to group them in one sketch")
+    parser.add_argument("--priority", choices=["high", "normal"], help="Priority of the submitted files")
+    parser.add_argument("--profile", help="Hayabusa profile for Hayabusa pipelines, e.g. critical-only")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent uploads")
+    parser.add_argument("--max-attempts", type=int, default=8, help="Attempts per file on 429/503 and network errors")
+    parser.add_argument("--state", help="Record outcomes in this JSON lines file and skip files already submitted")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    args = parser.parse_args()
+
+    if not args.url:
+        parser.error("--url or OPENRELIK_PIPELINE_URL is required")
+    if not args.paths and not args.manifest:
+        parser.error("give paths to submit or --manifest")
+
+    items = build_items(args)
+    state = SubmissionState(args.state) if args.state else None
+    skipped = 0
+    if state is not None:
+        pending = [item for item in items if not state.is_done(item)]
+        skipped = len(items) - len(pending)
+        items = pending
+
+    client = PipelineClient(args.url, max_attempts=args.max_attempts, pool_size=max(args.workers, 1))
+    counts = {"submitted": 0, "failed": 0}
+    total_bytes = 0
+    started = time.monotonic()
+    for result in client.submit_many(items, workers=args.workers):
+        counts[result["status"]] += 1
+        total_bytes += result.get("bytes", 0)
+        if state is not None and result.get("bytes") is not None:
+            state.record(result)
+        if args.json:
+            print(json.dumps(result), flush=True)
+        else:
+            print(
+                "%-9s %-4s %s%s%s"
+                % (
+                    result["status"],
+                    result.get("status_code") or "-",
+                    result["path"],
+                    " workflow=%s" % result["workflow_id"] if result.get("workflow_id") else "",
+                    " (%s)" % result["message"] if result["status"] == "failed" else "",
+                ),
+                flush=True,
+            )
+
+    elapsed = time.monotonic() - started
+    print(
+        "%d submitted, %d failed, %d skipped as already submitted, %.1f MB in %.1fs (%.1f MB/s)"
+        % (
+            counts["submitted"],
+            counts["failed"],
+            skipped,
+            total_bytes / 1024**2,
+            elapsed,
+            total_bytes / 1024**2 / elapsed if elapsed else 0.0,
+        ),
+        file=sys.stderr,
+    )
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
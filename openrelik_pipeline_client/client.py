@@ -0,0 +1,235 @@
+"""
+Submit files to the OpenRelik pipeline.
+
+Files are streamed from disk, so their size doesn't matter for memory. The
+client follows the pipeline's backpressure contract: `429` and `503` responses
+are retried after the `Retry-After` delay, or with jittered exponential backoff
+when there is none.
+"""
+import fnmatch
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+
+# Pipeline names as used by the drop folder, mapped to their routes
+ROUTES = {
+    "hayabusa": "/api/hayabusa",
+    "hayabusa-timesketch": "/api/hayabusa/timesketch",
+    "plaso": "/api/plaso",
+    "plaso-timesketch": "/api/plaso/timesketch",
+}
+
+# Responses worth retrying. A 500 is not retried: the pipeline may already
+# have started a workflow for the file.
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+
+class PipelineClient:
+    """
+    Client for the pipeline's upload routes.
+
+    `max_attempts` bounds the attempts per file. Between attempts the client waits
+    for the server's Retry-After hint, or for a jittered backoff starting at
+    `base_delay` and capped at `max_delay` seconds.
+    """
+
+    def __init__(
+        self, base_url, max_attempts=8, base_delay=1.0, max_delay=300.0, timeout=3600, pool_size=16
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def retry_delay(self, attempt, response=None):
+        """
+        Seconds to wait before the next attempt: the server's hint if it sent one
+        (plus some jitter, so a burst of clients doesn't come back all at once),
+        otherwise full-jitter exponential backoff.
+        """
+        if response is not None:
+            try:
+                hint = float(response.headers["Retry-After"])
+                return min(self.max_delay, hint + random.uniform(0, self.base_delay))
+            except (KeyError, ValueError):
+                pass
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def submit(self, path, pipeline, filename=None, priority=None, profile=None):
+        """
+        Upload one file to a pipeline.
+
+        `filename` is the name the pipeline sees, which decides the sketch and
+        timeline names (`vr_kapefiles_<fqdn>_<label>.zip`). It defaults to the
+        file's own name. `profile` picks the Hayabusa profile of Hayabusa
+        pipelines. Returns a result dict with the outcome.
+        """
+        filename = filename or os.path.basename(path)
+        url = self.base_url + ROUTES[pipeline]
+        params = {}
+        if priority:
+            params["priority"] = priority
+        if profile and pipeline.startswith("hayabusa"):
+            params["profile"] = profile
+        result = {
+            "path": path,
+            "filename": filename,
+            "pipeline": pipeline,
+            "bytes": os.path.getsize(path),
+        }
+
+        started = time.monotonic()
+        for attempt in range(self.max_attempts):
+            response = None
+            try:
+                with open(path, "rb") as fh:
+                    encoder = MultipartEncoder({"file": (filename, fh, "application/octet-stream")})
+                    response = self.session.post(
+                        url,
+                        data=encoder,
+                        params=params,
+                        headers={"Content-Type": encoder.content_type},
+                        timeout=self.timeout,
+                    )
+            except requests.RequestException as e:
+                result.update(status="failed", status_code=None, message=str(e))
+            else:
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {"error": response.text[:200]}
+                result.update(
+                    status="submitted" if response.ok else "failed",
+                    status_code=response.status_code,
+                    message=body.get("message") or body.get("error"),
+                    workflow_id=body.get("workflow_id"),
+                )
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    break
+
+            if attempt + 1 < self.max_attempts:
+                time.sleep(self.retry_delay(attempt, response))
+
+        result.update(attempts=attempt + 1, seconds=round(time.monotonic() - started, 3))
+        return result
+
+    def submit_many(self, items, workers=4):
+        """
+        Submit items concurrently with at most `workers` uploads in flight.
+
+        Each item is a dict with `path` and `pipeline`, and optionally `filename`,
+        `priority` and `profile`. Results are yielded as uploads complete.
+        """
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(
+                    self.submit,
+                    item["path"],
+                    item["pipeline"],
+                    item.get("filename"),
+                    item.get("priority"),
+                    item.get("profile"),
+                ): item
+                for item in items
+            }
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except Exception as e:
+                    item = futures[future]
+                    yield dict(item, status="failed", status_code=None, message=str(e))
+
+
+def walk(paths, pattern="*"):
+    """
+    Yield every file under `paths` (files or directories, walked recursively)
+    whose name matches the glob `pattern`. Hidden files and directories are skipped.
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(name for name in dirs if not name.startswith("."))
+            for name in sorted(files):
+                if not name.startswith(".") and fnmatch.fnmatch(name, pattern):
+                    yield os.path.join(root, name)
+
+
+def read_manifest(manifest_path):
+    """
+    Read items from a manifest. Each line is either a path, or a JSON object
+    with `path` and optionally `filename`, `pipeline`, `priority` and `profile`.
+    Blank lines and lines starting with # are ignored. Relative paths are
+    relative to the manifest.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            item = json.loads(line) if line.startswith("{") else {"path": line}
+            item["path"] = os.path.join(base_dir, item["path"])
+            yield item
+
+
+class SubmissionState:
+    """
+    Outcome of every submitted file, appended to a JSON lines file.
+
+    A file counts as done once it was submitted and hasn't changed since
+    (same size and modification time), so an interrupted or partly failed
+    run can be repeated and only sends what is left.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line cut short by an interrupted run.
+                        continue
+                    key = (record["path"], record["pipeline"])
+                    if record["status"] == "submitted":
+                        self.done[key] = (record["size"], record["mtime"])
+                    else:
+                        self.done.pop(key, None)
+
+    @staticmethod
+    def fingerprint(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    def is_done(self, item):
+        key = (os.path.abspath(item["path"]), item["pipeline"])
+        try:
+            return self.done.get(key) == self.fingerprint(item["path"])
+        except OSError:
+            return False
+
+    def record(self, result):
+        size, mtime = self.fingerprint(result["path"])
+        record = dict(result, path=os.path.abspath(result["path"]), size=size, mtime=mtime)
+        with self.lock:
+            with open(self.path, "a") as fh:
+                fh.write(json.dumps(record) + "\n")
+            if record["status"] == "submitted":
+                self.done[(record["path"], record["pipeline"])] = (size, mtime)